@@ -0,0 +1,871 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# Data structures and analytics for the pressure and flow samples.
+
+import bisect
+import numpy as np
+from collections import deque, namedtuple
+
+
+# =========== Ring buffers =============
+
+# Fixed-size circular buffer of the most recent values, backed by a preallocated NumPy array.
+# Every value is written twice, at i and i+capacity, so the latest [capacity] values are always
+# in one contiguous slice: view() returns them, oldest first, without copying, and append() is O(1).
+class RingBuffer:
+
+    def __init__(self, capacity, fill=0.0, dtype=np.float64):
+        self.capacity = capacity
+        self.data = np.full(2*capacity, fill, dtype=dtype)
+        self.start = 0 # index of the oldest value, which is the next one to be overwritten
+
+    def __len__(self):
+        return self.capacity
+
+    # Add a value, discarding the oldest
+    def append(self, value):
+        i = self.start
+        self.data[i] = value
+        self.data[i + self.capacity] = value
+        self.start = i + 1 if i + 1 < self.capacity else 0
+
+    # Add a block of values (any sequence or NumPy array), discarding as many of the oldest
+    def extend(self, values):
+        values = np.asarray(values)
+        n = len(values)
+        if n >= self.capacity:
+            # The block replaces everything
+            self.data[:self.capacity] = values[n-self.capacity:]
+            self.data[self.capacity:] = values[n-self.capacity:]
+            self.start = 0
+            return
+        # Copy in up to two pieces: up to the end of the buffer, then wrapping round to the start
+        i = self.start
+        first = min(n, self.capacity - i)
+        self.data[i:i+first] = values[:first]
+        self.data[i+self.capacity:i+self.capacity+first] = values[:first]
+        rest = n - first
+        self.data[:rest] = values[first:]
+        self.data[self.capacity:self.capacity+rest] = values[first:]
+        self.start = (i + n) % self.capacity
+
+    # The latest [capacity] values, oldest first, as a read-only view into the buffer (not a copy).
+    # The view's contents change as new values are added.
+    def view(self):
+        v = self.data[self.start:self.start+self.capacity]
+        v.flags.writeable = False
+        return v
+
+    # The most recent value
+    def last(self):
+        return self.data[self.start + self.capacity - 1]
+
+    # Set every value back to [value]
+    def fill(self, value):
+        self.data.fill(value)
+        self.start = 0
+
+
+# =========== Rolling statistics =============
+
+# Maximum of the last [window] values, updated in O(1) (amortised) per value.
+# Keeps a monotonic deque of (index, value) pairs with decreasing values: a new value removes every
+# smaller value before it, since they can never be the maximum again, and the front is the current maximum.
+# The deque never holds more than [window] pairs.
+class RollingMax:
+
+    def __init__(self, window):
+        self.window = window
+        self.candidates = deque()
+        self.count = 0
+
+    # Add a value and return the maximum of the last [window] values
+    def push(self, value):
+        candidates = self.candidates
+        while candidates and candidates[-1][1] <= value:
+            candidates.pop()
+        candidates.append((self.count, value))
+        if candidates[0][0] <= self.count - self.window:
+            candidates.popleft() # the front value has left the window
+        self.count += 1
+        return candidates[0][1]
+
+    # Maximum of the last [window] values, or 0 if there aren't any yet
+    def max(self):
+        return self.candidates[0][1] if self.candidates else 0
+
+
+# Mean of the last [capacity] values (or of all of them, until there are that many), in O(1) per value.
+# Keeps a running sum over fixed-size storage. The sum is recomputed from the stored values each time
+# the storage wraps round, so floating point rounding errors can't build up.
+class RollingMean:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.values = [0.0] * capacity
+        self.count = 0  # number of values stored, up to capacity
+        self.next = 0   # where the next value goes
+        self.total = 0.0
+
+    def __len__(self):
+        return self.count
+
+    # Add a value, discarding the oldest if full
+    def push(self, value):
+        i = self.next
+        self.total += value - self.values[i]
+        self.values[i] = value
+        if self.count < self.capacity:
+            self.count += 1
+        self.next = i + 1
+        if self.next == self.capacity:
+            self.next = 0
+            self.total = sum(self.values)
+
+    # Mean of the stored values, or 0 if there aren't any
+    def mean(self):
+        return 0 if self.count == 0 else self.total/self.count
+
+    # Discard all the values
+    def clear(self):
+        self.values = [0.0] * self.capacity
+        self.count = 0
+        self.next = 0
+        self.total = 0.0
+
+
+# =========== Filters =============
+
+# First-order low-pass IIR filter with [cutoff] frequency (Hz), for samples [period] seconds apart.
+# Each output moves towards its input by a fixed fraction, y[n] = y[n-1] + alpha * (x[n] - y[n-1]), and the state
+# carries over between calls, so samples can be given one at a time with push() or in NumPy arrays with processBlock()
+# and the results are the same (to rounding). The filter starts at the first value rather than at zero.
+class LowPassFilter:
+
+    MAX_GAIN = 1e150 # largest scaling used in processBlock(), well within the range of a double
+
+    def __init__(self, cutoff, period):
+        self.alpha = 1 - np.exp(-2 * np.pi * cutoff * period)
+        self.decay = 1 - self.alpha
+        self.value = None # the last output
+        # processBlock() works in chunks of up to [chunk] samples, with the powers of decay precomputed for them
+        self.chunk = 4096
+        if self.decay > 0:
+            self.chunk = max(1, min(self.chunk, int(np.log(self.MAX_GAIN) / -np.log(self.decay))))
+        k = np.arange(self.chunk)
+        self.powers = self.decay ** (k + 1)                                           # decay**(n+1)
+        self.growth = self.decay ** -k if self.decay > 0 else np.zeros(self.chunk)   # decay**-n
+        self.work = np.empty(self.chunk)
+
+    # Filter one value
+    def push(self, x):
+        if self.value is None:
+            self.value = x
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+    # Filter an array of values into [out] (which can be [x] itself), and return it.
+    # Unrolling the recursion, y[n] = decay**(n+1) * (y[-1] + alpha/decay * sum(decay**-k * x[k] for k <= n)),
+    # which is a cumulative sum: so each chunk is a few NumPy operations in preallocated arrays.
+    def processBlock(self, x, out):
+        n = len(x)
+        if n == 0:
+            return out
+        if self.decay == 0:
+            out[:] = x # the cutoff is so high that the filter passes everything
+            self.value = float(out[-1])
+            return out
+        if self.value is None:
+            self.value = float(x[0])
+        for start in range(0, n, self.chunk):
+            m = min(self.chunk, n - start)
+            work = self.work[:m]
+            np.multiply(x[start:start+m], self.growth[:m], out=work)
+            np.cumsum(work, out=work)
+            work *= self.alpha / self.decay
+            work += self.value
+            np.multiply(work, self.powers[:m], out=out[start:start+m])
+            self.value = float(out[start+m-1])
+        return out
+
+
+# Running median of the last [window] values (an odd number), to remove short spikes without smearing them out.
+# The output lags the input by (window-1)/2 samples. The last [window] values are kept both in arrival order and
+# sorted, and the sorted list is updated in place, so push() costs O(window) and doesn't allocate anything.
+# processBlock() gives the same results as push(), for a NumPy array at a time.
+class MedianFilter:
+
+    def __init__(self, window):
+        if window < 1 or window % 2 == 0:
+            raise ValueError("The median filter window must be a positive odd number")
+        self.window = window
+        self.recent = [0.0] * window # the last [window] values, oldest at [next] once full
+        self.sorted = []
+        self.next = 0
+        self.work = np.empty(0)
+
+    # Filter one value
+    def push(self, x):
+        if len(self.sorted) == self.window:
+            del self.sorted[bisect.bisect_left(self.sorted, self.recent[self.next])]
+        bisect.insort(self.sorted, x)
+        self.recent[self.next] = x
+        self.next = (self.next + 1) % self.window
+        return self.sorted[len(self.sorted) // 2]
+
+    # Filter an array of values into [out] (which can't be [x] itself), and return it
+    def processBlock(self, x, out):
+        n = len(x)
+        w = self.window
+        # Until there are [window] values, only push() gives the same results
+        start = 0
+        while len(self.sorted) < w and start < n:
+            out[start] = self.push(float(x[start]))
+            start += 1
+        if start == n:
+            return out
+        # The window for each value is the [window]-1 values before it and itself
+        if len(self.work) < w - 1 + n:
+            self.work = np.empty(w - 1 + n)
+        work = self.work[:w - 1 + n - start]
+        work[:w-1] = self.recent[self.next+1:] + self.recent[:self.next] # oldest first, skipping the very oldest
+        work[w-1:] = x[start:]
+        np.median(np.lib.stride_tricks.sliding_window_view(work, w), axis=1, out=out[start:n])
+        # Keep the last [window] values for next time
+        self.recent[:] = work[-w:].tolist()
+        self.sorted = sorted(self.recent)
+        self.next = 0
+        return out
+
+
+# The filtering for one signal (e.g. a patient's flow) before it is analysed: a median filter over [median] samples
+# to remove spikes, then a low-pass filter with [cutoff] Hz, for samples [period] seconds apart.
+# A median of 1 or a cutoff of None leaves that stage out. Samples can be given with push() or processBlock(),
+# or both, as the state carries over.
+class SignalFilter:
+
+    def __init__(self, period, median=1, cutoff=None):
+        self.median = MedianFilter(median) if median > 1 else None
+        self.lowPass = LowPassFilter(cutoff, period) if cutoff is not None else None
+        self.out = np.empty(0)
+
+    # Filter one value
+    def push(self, x):
+        if self.median is not None:
+            x = self.median.push(x)
+        if self.lowPass is not None:
+            x = self.lowPass.push(x)
+        return x
+
+    # Filter an array of values. Returns an array that is reused by the next call, so copy it to keep it.
+    def processBlock(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        n = len(x)
+        if len(self.out) < n:
+            self.out = np.empty(n)
+        out = self.out[:n]
+        if self.median is not None:
+            self.median.processBlock(x, out)
+        else:
+            out[:] = x
+        if self.lowPass is not None:
+            self.lowPass.processBlock(out, out)
+        return out
+
+
+# =========== Breath detection =============
+
+# Summary of one breath, from the start of its inspiration to the start of the next inspiration.
+# Times are in seconds on the same clock as the samples, pressures in cm H2O, volumes in mL,
+# respiratory rate (rr) in breaths per minute, and ie is the I:E ratio (inspiration time / expiration time).
+BreathRecord = namedtuple('BreathRecord', ['start', 'expStart', 'end', 'ppeak', 'peep', 'vti', 'vte', 'rr', 'ie'])
+
+# Flow is in L/min and time in seconds, so this converts flow x time to mL
+ML_PER_LPM_SECOND = 1000/60
+
+
+# Volume (mL) of flow above zero and below zero between two samples (t0, f0) and (t1, f1), using the
+# trapezoidal rule over the actual time between them. If the flow crosses zero, the line between the samples is
+# split where it crosses, so each volume only includes its own side. Returns (inspired, expired), both >= 0.
+def splitVolume(t0, f0, t1, f1):
+    dt = t1 - t0
+    if (f0 >= 0) == (f1 >= 0):
+        area = (f0 + f1) / 2 * dt * ML_PER_LPM_SECOND
+        return (area, 0.0) if f0 >= 0 else (0.0, -area)
+    tz = dt * f0 / (f0 - f1) # time from t0 to the zero crossing
+    a0 = f0 * tz / 2 * ML_PER_LPM_SECOND
+    a1 = f1 * (dt - tz) / 2 * ML_PER_LPM_SECOND
+    return (a0, -a1) if f0 >= 0 else (a1, -a0)
+
+# The same as splitVolume() for arrays of samples, giving the volumes between each sample and the one before it
+def splitVolumes(t0, f0, t1, f1):
+    dt = t1 - t0
+    crossing = (f0 >= 0) != (f1 >= 0)
+    # Time to the zero crossing (only used where there is one; avoids dividing by zero elsewhere)
+    tz = np.where(crossing, dt * f0 / np.where(crossing, f0 - f1, 1.0), 0.0)
+    area = np.where(crossing, 0.0, (f0 + f1) / 2 * dt)
+    a0 = np.where(crossing, f0 * tz / 2, 0.0)
+    a1 = np.where(crossing, f1 * (dt - tz) / 2, 0.0)
+    total = area + a0 + a1
+    inspired = (np.where(crossing, np.maximum(a0, 0) + np.maximum(a1, 0), np.maximum(area, 0))) * ML_PER_LPM_SECOND
+    expired = inspired - total * ML_PER_LPM_SECOND
+    return inspired, expired
+
+
+# Splits a stream of pressure and flow samples into breaths, and returns a BreathRecord for each one.
+# Inspiration starts when flow crosses from negative to zero or above, and expiration when it goes negative,
+# but a crossing only counts once at least [minVolume] mL has flowed the new way since it: until then it is pending,
+# and if the flow turns back first, it was noise around zero flow rather than a real change of direction.
+# As the flow can hover just the other side of zero for a while before it really changes direction, the phase is
+# timed from the first sample after the crossing with at least [startFlow] L/min the new way, if there is one
+# before the crossing is confirmed.
+# PEEP is the last pressure before the next inspiration starts, at the end of the breath's expiration.
+# Vti and Vte are found by integrating the flow over the samples' own timestamps (trapezoidal rule),
+# so they stay accurate whatever the sampling rate and however irregular the samples are.
+# Breaths whose expiration is shorter than [minExpTime] seconds are ignored, as they aren't real breaths either.
+# Samples can be given one at a time with push(), or as NumPy arrays with processBlock(), which gives the
+# same results much faster; the two can be mixed, as the state carries over between calls.
+# A breath's record is returned once the next inspiration is confirmed, a sample or two after it starts.
+class BreathDetector:
+
+    def __init__(self, minExpTime=1.0, minVolume=20.0, startFlow=2.0):
+        self.minExpTime = minExpTime
+        self.minVolume = minVolume
+        self.startFlow = startFlow
+        self.prevTime = None
+        self.prevFlow = 0.0
+        self.prevPress = 0.0
+        self.startBreath(None) # no breath has started until the first inspiration is seen
+        self.pending = None # 'insp' or 'exp' while a zero crossing is waiting to be confirmed, otherwise None
+
+    # Reset the totals for a new breath, starting at time t
+    def startBreath(self, t):
+        self.start = t # time the current breath started, or None
+        self.expStart = None
+        self.expiring = False
+        self.pMax = -np.inf
+        self.vti = 0.0 # volume inspired so far (mL)
+        self.vte = 0.0 # volume expired so far (mL)
+
+    # Finish the current breath at time t, with end-expiratory pressure peep
+    # Returns its record, or None if it was incomplete or too short
+    def endBreath(self, t, peep):
+        if self.start is None or self.expStart is None or t - self.expStart < self.minExpTime:
+            return None
+        duration = t - self.start
+        inspTime = self.expStart - self.start
+        expTime = t - self.expStart
+        return BreathRecord(start=self.start, expStart=self.expStart, end=t,
+                            ppeak=float(self.pMax), peep=float(peep), vti=self.vti, vte=self.vte,
+                            rr=60/duration if duration > 0 else 0.0,
+                            ie=inspTime/expTime if expTime > 0 else 0.0)
+
+    # Flow crossed zero at time t, upwards if [inspiring], with pressure [pressBefore] just before it.
+    # A crossing into the phase the breath is already in cancels a pending one: the volumes since then stay with
+    # the current breath. Otherwise it starts a pending change of phase.
+    def crossing(self, t, inspiring, pressBefore):
+        if self.pending == 'insp':
+            self.vti += self.pendingVti
+            self.pMax = max(self.pMax, self.pendingPMax)
+        self.pending = None
+        self.pendingReached = False # whether the flow has reached startFlow since the crossing
+        if inspiring and (self.expiring or self.start is None):
+            self.pending = 'insp'
+            self.pendingTime = t
+            self.pendingPeep = pressBefore
+            self.pendingVti = 0.0 # inspired since the crossing, which goes to the next breath if it is real
+            self.pendingPMax = -np.inf
+        elif not inspiring and not self.expiring:
+            self.pending = 'exp'
+            self.pendingTime = t
+            self.pendingVte = 0.0 # expired since the crossing, which stays with this breath either way
+
+    # The flow reached startFlow the way a pending crossing went, at time t with pressure [pressBefore] just before it:
+    # time the phase from then, if it hasn't already
+    def reachedFlow(self, t, pressBefore):
+        if not self.pendingReached:
+            self.pendingReached = True
+            self.pendingTime = t
+            self.pendingPeep = pressBefore
+
+    # Add the volumes and highest pressure of some samples between crossings.
+    # Returns the record of the breath that ended, if they confirmed the start of the next inspiration, otherwise None
+    def addVolumes(self, inspired, expired, pMax):
+        self.vte += expired # any expired volume before an inspiration starts belongs to the breath before it
+        if self.pending == 'insp':
+            self.pendingVti += inspired
+            self.pendingPMax = max(self.pendingPMax, pMax)
+            if self.pendingVti < self.minVolume:
+                return None
+            record = self.endBreath(self.pendingTime, self.pendingPeep)
+            self.startBreath(self.pendingTime)
+            self.vti = self.pendingVti
+            self.pMax = self.pendingPMax
+            self.pending = None
+            return record
+        self.vti += inspired
+        self.pMax = max(self.pMax, pMax)
+        if self.pending == 'exp':
+            self.pendingVte += expired
+            if self.pendingVte >= self.minVolume:
+                self.expiring = True
+                self.expStart = self.pendingTime
+                self.pending = None
+        return None
+
+    # Process one sample; returns the BreathRecord of the breath it completed, or None
+    def push(self, t, pressure, flow):
+        inspired, expired = splitVolume(self.prevTime, self.prevFlow, t, flow) if self.prevTime is not None else (0.0, 0.0)
+        if (flow >= 0) != (self.prevFlow >= 0): # zero crossing
+            self.crossing(t, flow >= 0, self.prevPress)
+        if self.pending is not None and (flow >= self.startFlow if self.pending == 'insp' else flow <= -self.startFlow):
+            self.reachedFlow(t, self.prevPress)
+        record = self.addVolumes(inspired, expired, pressure)
+        self.prevTime = t
+        self.prevFlow = flow
+        self.prevPress = pressure
+        return record
+
+    # Process a block of samples given as equal-length arrays; returns a list of the BreathRecords completed.
+    # The block is cut at every zero crossing, and the totals for each piece are found with NumPy,
+    # so only the crossings (a few per breath) are handled in Python.
+    def processBlock(self, t, pressure, flow):
+        t = np.asarray(t, dtype=np.float64)
+        pressure = np.asarray(pressure, dtype=np.float64)
+        flow = np.asarray(flow, dtype=np.float64)
+        n = len(flow)
+        if n == 0:
+            return []
+
+        # Volumes between each sample and the one before it (including the last one of the previous block)
+        prevT = np.empty(n)
+        prevT[0] = self.prevTime if self.prevTime is not None else t[0]
+        prevT[1:] = t[:-1]
+        prevF = np.empty(n)
+        prevF[0] = self.prevFlow
+        prevF[1:] = flow[:-1]
+        inspired, expired = splitVolumes(prevT, prevF, t, flow)
+
+        # Find the zero crossings
+        neg = flow < 0
+        prevNeg = prevF < 0
+        inspStarts = ~neg & prevNeg
+        expStarts = neg & ~prevNeg
+
+        # Pieces between crossings: each one is all inspiration or all expiration
+        starts = np.flatnonzero(inspStarts | expStarts)
+        if len(starts) == 0 or starts[0] != 0:
+            starts = np.concatenate(([0], starts))
+        inspSums = np.add.reduceat(inspired, starts)
+        expSums = np.add.reduceat(expired, starts)
+        pMaxes = np.maximum.reduceat(pressure, starts)
+
+        records = []
+        ends = np.append(starts[1:], n)
+        for start, end, inspSum, expSum, pMax in zip(starts, ends, inspSums, expSums, pMaxes):
+            if inspStarts[start] or expStarts[start]:
+                self.crossing(float(t[start]), bool(inspStarts[start]),
+                              float(pressure[start-1]) if start > 0 else self.prevPress)
+            if self.pending is not None and not self.pendingReached:
+                # The first sample in this piece that reaches startFlow, if it comes before the crossing is confirmed
+                if self.pending == 'insp':
+                    beyond = np.flatnonzero(flow[start:end] >= self.startFlow)
+                    volumes, needed = inspired, self.minVolume - self.pendingVti
+                else:
+                    beyond = np.flatnonzero(flow[start:end] <= -self.startFlow)
+                    volumes, needed = expired, self.minVolume - self.pendingVte
+                if len(beyond) > 0:
+                    k = start + beyond[0]
+                    if float(volumes[start:k].sum()) < needed:
+                        self.reachedFlow(float(t[k]), float(pressure[k-1]) if k > 0 else self.prevPress)
+            record = self.addVolumes(float(inspSum), float(expSum), float(pMax))
+            if record is not None:
+                records.append(record)
+        self.prevTime = float(t[-1])
+        self.prevFlow = float(flow[-1])
+        self.prevPress = float(pressure[-1])
+        return records
+
+
+# =========== Volume and loops =============
+
+# Running volume (mL) since the start of the current breath, from the flow one sample at a time.
+# Each sample only adds the trapezoid between it and the one before, over the actual time between them,
+# so the cost per sample is constant. The volume goes back to zero when inspiration starts, i.e. when the flow
+# crosses from negative to zero or above after at least [minExpTime] seconds of expiration (as BreathDetector does),
+# so any leak or sensor offset can only make it drift within one breath. The volume also has to have fallen by at
+# least [minVolume] mL from its peak, so noise around zero flow at the end of inspiration or expiration can't start
+# a breath.
+class VolumeIntegrator:
+
+    def __init__(self, minExpTime=1.0, minVolume=20.0):
+        self.minExpTime = minExpTime
+        self.minVolume = minVolume
+        self.prevTime = None
+        self.prevFlow = 0.0
+        self.volume = 0.0
+        self.peak = 0.0 # largest volume so far in this breath
+        self.expStart = None # time expiration started, or None during inspiration
+        self.newBreath = False # whether the last sample started a breath
+
+    # Add one sample (time in seconds, flow in L/min) and return the volume so far in this breath
+    def push(self, t, flow):
+        self.newBreath = False
+        if self.prevTime is not None:
+            if (self.prevFlow < 0 <= flow and self.expStart is not None and t - self.expStart >= self.minExpTime
+                    and self.peak - self.volume >= self.minVolume):
+                self.newBreath = True
+                self.expStart = None
+                self.volume = self.peak = 0.0
+            else:
+                self.volume += (self.prevFlow + flow) / 2 * (t - self.prevTime) * ML_PER_LPM_SECOND
+                if self.volume > self.peak:
+                    self.peak = self.volume
+                if flow < 0 and self.expStart is None:
+                    self.expStart = t
+        self.prevTime = t
+        self.prevFlow = flow
+        return self.volume
+
+
+# The pressure, flow and volume of every sample in the current breath and in the one before it, for drawing
+# P-V and F-V loops. Samples are added to the end of preallocated arrays, so adding one only writes one element,
+# and current() and previous() return views of the arrays rather than copies.
+# A breath with more than [capacity] samples stops growing once the arrays are full.
+class BreathLoops:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.loops = [np.zeros((3, capacity)), np.zeros((3, capacity))] # rows: pressure, flow, volume
+        self.counts = [0, 0]
+        self.current = 0 # which of the two is the current breath
+        self.breaths = 0 # how many breaths have started
+
+    # Add one sample to the current breath
+    def add(self, pressure, flow, volume):
+        n = self.counts[self.current]
+        if n < self.capacity:
+            self.loops[self.current][:, n] = (pressure, flow, volume)
+            self.counts[self.current] = n + 1
+
+    # Start a new breath: the current one becomes the previous one, and the old previous one is reused
+    def newBreath(self):
+        self.current = 1 - self.current
+        self.counts[self.current] = 0
+        self.breaths += 1
+
+    # (pressures, flows, volumes) for the breath so far
+    def currentLoop(self):
+        return self.loops[self.current][:, :self.counts[self.current]]
+
+    # (pressures, flows, volumes) for the breath before it
+    def previousLoop(self):
+        previous = 1 - self.current
+        return self.loops[previous][:, :self.counts[previous]]
+
+
+# =========== Trends =============
+
+# The part of a trend returned by TrendStore.query(): equal-length arrays of bucket start times,
+# and the lowest, highest and mean value in each bucket (all three are the same for raw values)
+Trend = namedtuple('Trend', ['times', 'min', 'max', 'mean'])
+
+# One level of a TrendStore: the min, max and mean of every channel over fixed [width]-second buckets,
+# for the last [capacity] buckets. Values are added to the bucket in progress, which is stored, and passed on
+# to the next (coarser) level if there is one, once a value for a later bucket arrives.
+class TrendTier:
+
+    def __init__(self, width, capacity, channels, next=None):
+        self.width = width
+        self.next = next
+        self.times = RingBuffer(capacity, np.nan)
+        self.mins = [RingBuffer(capacity, np.nan) for _ in range(channels)]
+        self.maxes = [RingBuffer(capacity, np.nan) for _ in range(channels)]
+        self.means = [RingBuffer(capacity, np.nan) for _ in range(channels)]
+        self.count = 0 # buckets stored, up to capacity
+        self.bucket = None # start time of the bucket in progress
+
+    # Add the values of one bucket from the level below (or a single sample, with count 1)
+    def add(self, t, lows, highs, sums, count):
+        bucket = t - t % self.width
+        if bucket != self.bucket:
+            if self.bucket is not None:
+                self.close()
+            self.bucket = bucket
+            self.lows = list(lows)
+            self.highs = list(highs)
+            self.sums = list(sums)
+            self.n = count
+            return
+        for i, (low, high) in enumerate(zip(lows, highs)):
+            if low < self.lows[i]:
+                self.lows[i] = low
+            if high > self.highs[i]:
+                self.highs[i] = high
+            self.sums[i] += sums[i]
+        self.n += count
+
+    # Store the bucket in progress, and pass it on
+    def close(self):
+        self.times.append(self.bucket)
+        for i in range(len(self.sums)):
+            self.mins[i].append(self.lows[i])
+            self.maxes[i].append(self.highs[i])
+            self.means[i].append(self.sums[i] / self.n)
+        self.count = min(self.count + 1, self.times.capacity)
+        if self.next is not None:
+            self.next.add(self.bucket, self.lows, self.highs, self.sums, self.n)
+
+    # Size of the stored data, in bytes
+    def nbytes(self):
+        return self.times.data.nbytes * (1 + 3 * len(self.mins))
+
+
+# Long-term history of a few channels (e.g. pressure and flow) in a fixed amount of memory.
+# The last [rawSeconds] of values are kept as they are, for samples [period] seconds apart; older history is kept
+# as the min, max and mean over buckets, e.g. of 1 second for the last 6 hours and 1 minute for the last week,
+# given as [tiers] of (bucket width, seconds kept). Everything is allocated up front; if [maxBytes] is given
+# and the history would take more, every level keeps proportionally less time to fit.
+# Adding a value costs the same however long the history, and a query only reads the buckets it returns,
+# from the coarsest level it needs, so even a chart of the last 24 hours takes milliseconds.
+class TrendStore:
+
+    def __init__(self, names, period, rawSeconds=300, tiers=((1, 6*3600), (60, 7*24*3600)), maxBytes=None):
+        self.names = list(names)
+        channels = len(self.names)
+        capacities = [max(1, int(rawSeconds / period))] + [max(1, int(seconds / width)) for width, seconds in tiers]
+        if maxBytes is not None:
+            # Each slot of each ring buffer takes two doubles
+            size = 16 * (capacities[0] * (1 + channels) + sum(capacities[1:]) * (1 + 3 * channels))
+            if size > maxBytes:
+                capacities = [max(1, int(c * maxBytes / size)) for c in capacities]
+        self.rawTimes = RingBuffer(capacities[0], np.nan)
+        self.raw = [RingBuffer(capacities[0], np.nan) for _ in range(channels)]
+        self.rawCount = 0
+        # Build the levels coarsest first, so that each one can be linked to the next
+        self.tiers = []
+        following = None
+        for (width, seconds), capacity in reversed(list(zip(tiers, capacities[1:]))):
+            following = TrendTier(width, capacity, channels, following)
+            self.tiers.insert(0, following)
+
+    # Add one value for each channel, at time t (which should never go backwards)
+    def add(self, t, *values):
+        self.rawTimes.append(t)
+        for ring, value in zip(self.raw, values):
+            ring.append(value)
+        if self.rawCount < self.rawTimes.capacity:
+            self.rawCount += 1
+        if self.tiers:
+            self.tiers[0].add(t, values, values, values, 1)
+
+    # Size of the stored data, in bytes
+    def nbytes(self):
+        return self.rawTimes.data.nbytes * (1 + len(self.raw)) + sum(tier.nbytes() for tier in self.tiers)
+
+    # The history of channel [name] between times [start] and [end], as a Trend, from the most detailed level
+    # that goes back to [start] (or has kept everything since the first value) and has no more than [maxPoints]
+    # values in that time (if it's given). If no level qualifies, the coarsest one with any data is used.
+    # Buckets are only included once they are complete, so the coarse levels lag a little behind the raw values.
+    def query(self, name, start=-np.inf, end=np.inf, maxPoints=None):
+        channel = self.names.index(name)
+        levels = [(self.rawTimes, self.raw[channel], self.raw[channel], self.raw[channel], self.rawCount)]
+        levels += [(tier.times, tier.mins[channel], tier.maxes[channel], tier.means[channel], tier.count)
+                   for tier in self.tiers]
+        chosen = None
+        for times, mins, maxes, means, count in levels:
+            if count == 0:
+                continue
+            t = times.view()[-count:]
+            first = np.searchsorted(t, start, side='left')
+            last = np.searchsorted(t, end, side='right')
+            chosen = (t, mins, maxes, means, count, first, last)
+            complete = count < times.capacity # nothing has been discarded yet
+            if (t[0] <= start or complete) and (maxPoints is None or last - first <= maxPoints):
+                break
+        if chosen is None:
+            empty = np.zeros(0)
+            return Trend(empty, empty, empty, empty)
+        t, mins, maxes, means, count, first, last = chosen
+        return Trend(t[first:last].copy(), mins.view()[-count:][first:last].copy(),
+                     maxes.view()[-count:][first:last].copy(), means.view()[-count:][first:last].copy())
+
+
+# =========== Alarms =============
+
+# A change of alarm state: when it happened, which alarm, the new state and the value that caused it,
+# and for some alarms when the condition that set it off started (None if not known)
+AlarmEvent = namedtuple('AlarmEvent', ['time', 'name', 'state', 'value', 'onset'], defaults=(None,))
+
+# Alarm states
+ALARM_NOT_SET = 'notset'  # no limits set, so never alarms
+ALARM_NORMAL = 'normal'   # limits set, and the value is within them
+ALARM_ON = 'alarm'        # the value is outside the limits
+
+
+# State machine for one alarm, such as high Ppeak or Vte out of range.
+# update() is called with each new value and only reports a change of state, so the caller only has to
+# touch the display when something actually changes. To stop an alarm flickering on and off when the value
+# hovers around a limit, the value has to be back inside the limits by [hysteresis] before the alarm clears,
+# and a new state has to be seen on [debounce] updates in a row before it takes effect.
+# Every change of state is appended to [events] (any list or deque) as an AlarmEvent, apart from an alarm being
+# armed (going from ALARM_NOT_SET to ALARM_NORMAL when its limits are set), which every alarm does at startup.
+class AlarmMonitor:
+
+    def __init__(self, name, hysteresis=0, debounce=1, events=None):
+        self.name = name
+        self.hysteresis = hysteresis
+        self.debounce = debounce
+        self.events = events if events is not None else []
+        self.low = None
+        self.high = None
+        self.state = ALARM_NOT_SET
+        self.pending = 0 # updates in a row that called for a change of state
+
+    # Set the alarm limits; either can be None for no limit on that side
+    def setLimits(self, low, high):
+        self.low = low
+        self.high = high
+        self.pending = 0
+
+    # Check a new value (at time t, with the condition behind it starting at [onset] if known);
+    # returns the new state if it has changed, otherwise None
+    def update(self, value, t, onset=None):
+        if self.low is None and self.high is None:
+            newState = ALARM_NOT_SET
+        elif self.state == ALARM_ON:
+            # Stay on until the value is back inside the limits by the hysteresis margin
+            inside = ((self.low is None or value >= self.low + self.hysteresis) and
+                      (self.high is None or value <= self.high - self.hysteresis))
+            newState = ALARM_NORMAL if inside else ALARM_ON
+        else:
+            outside = ((self.low is not None and value < self.low) or
+                       (self.high is not None and value > self.high))
+            newState = ALARM_ON if outside else ALARM_NORMAL
+
+        if newState == self.state:
+            self.pending = 0
+            return None
+        # Debounce changes into and out of the alarm state (but not setting or clearing the limits)
+        if self.state != ALARM_NOT_SET and newState != ALARM_NOT_SET:
+            self.pending += 1
+            if self.pending < self.debounce:
+                return None
+        self.pending = 0
+        armed = self.state == ALARM_NOT_SET and newState == ALARM_NORMAL
+        self.state = newState
+        if not armed:
+            self.events.append(AlarmEvent(t, self.name, newState, value, onset if newState == ALARM_ON else None))
+        return newState
+
+
+# =========== Per-sample alarms =============
+
+# The alarms checked on every sample by SampleAlarms
+PRESSURE_HIGH = 'Pressure high'
+DISCONNECT = 'Disconnect'
+APNEA = 'Apnea'
+SENSOR_SILENT = 'No sensor data'
+SAMPLE_ALARMS = (PRESSURE_HIGH, DISCONNECT, APNEA, SENSOR_SILENT)
+ALARM_STATES = (ALARM_NOT_SET, ALARM_NORMAL, ALARM_ON)
+
+
+# Alarms for one patient that are checked on every sample as it is read, rather than on the moving averages,
+# so how quickly they go on only depends on the sampling and never on how busy the display is:
+#   PRESSURE_HIGH when the pressure is above [pressureLimit].value on [debounce] samples in a row
+#                 (pressureLimit is a ctypes double, which can be in shared memory, and NaN for no limit);
+#   DISCONNECT    when the pressure stays below [disconnectPressure] for [disconnectTime] seconds;
+#   APNEA         when no breath of at least [apneaVolume] mL starts for [apneaTime] seconds;
+#   SENSOR_SILENT when check() finds no sample has been added for [silenceTime] seconds.
+# Any of the pressures and times can be None to leave that alarm out.
+# Each one is an AlarmMonitor, and every change of state is returned as an AlarmEvent whose onset, when an alarm
+# goes on, is the time its condition was first met: so time - onset is the detection latency. At most it is
+# (debounce - 1) sample periods for PRESSURE_HIGH, one sample period for the others, and one check() interval
+# for SENSOR_SILENT, plus the time taken to read the samples.
+class SampleAlarms:
+
+    def __init__(self, pressureLimit, disconnectPressure=None, disconnectTime=1.0, apneaTime=None, apneaVolume=50.0,
+                 silenceTime=None, debounce=1, hysteresis=0, start=0.0):
+        self.pressureLimit = pressureLimit
+        self.disconnectPressure = disconnectPressure
+        self.disconnectTime = disconnectTime
+        self.apneaTime = apneaTime
+        self.apneaVolume = apneaVolume
+        self.silenceTime = silenceTime
+        self.pending = [] # changes of state since the last call
+        self.high = AlarmMonitor(PRESSURE_HIGH, hysteresis, debounce, self.pending)
+        self.disconnect = AlarmMonitor(DISCONNECT, 0, 1, self.pending)
+        self.apnea = AlarmMonitor(APNEA, 0, 1, self.pending)
+        self.silent = AlarmMonitor(SENSOR_SILENT, 0, 1, self.pending)
+        if disconnectPressure is not None:
+            self.disconnect.setLimits(None, disconnectTime)
+        if apneaTime is not None:
+            self.apnea.setLimits(None, apneaTime)
+        if silenceTime is not None:
+            self.silent.setLimits(None, silenceTime)
+        self.limit = None # the pressure limit in use
+        self.highSince = None # time of the first of the samples in a row above the pressure limit
+        self.lowSince = None  # time the pressure went below disconnectPressure
+        self.breaths = VolumeIntegrator(minVolume=apneaVolume)
+        self.lastBreath = start  # time the last breath started
+        self.breathStart = None  # time the current breath started, until it has taken in apneaVolume
+        self.lastSample = start  # time of the last sample
+
+    # Check one sample (t is its time, and now the time it is being checked, both in seconds).
+    # Returns a list of the AlarmEvents for any alarms that changed state, which is usually empty.
+    def update(self, t, pressure, flow, now):
+        self.lastSample = t
+        limit = self.pressureLimit.value
+        limit = None if limit != limit else limit # NaN for no limit
+        if limit != self.limit:
+            self.high.setLimits(None, limit)
+            self.limit = limit
+        if limit is not None:
+            if pressure > limit:
+                if self.highSince is None:
+                    self.highSince = t
+            else:
+                self.highSince = None
+            self.high.update(pressure, now, self.highSince)
+        elif self.high.state != ALARM_NOT_SET:
+            self.high.update(pressure, now)
+
+        if self.disconnectPressure is not None:
+            if pressure >= self.disconnectPressure:
+                self.lowSince = None
+                self.disconnect.update(0.0, now)
+            else:
+                if self.lowSince is None:
+                    self.lowSince = t
+                self.disconnect.update(t - self.lowSince, now, self.lowSince + self.disconnectTime)
+
+        self.breaths.push(t, flow)
+        if self.breaths.newBreath:
+            self.breathStart = t
+        if self.breathStart is not None and self.breaths.volume >= self.apneaVolume:
+            # Only count a breath once it has taken in apneaVolume, so the flow settling to zero after the last
+            # breath can't count as another one
+            self.lastBreath = self.breathStart
+            self.breathStart = None
+        if self.apneaTime is not None:
+            self.apnea.update(t - self.lastBreath, now, self.lastBreath + self.apneaTime)
+
+        if self.silenceTime is not None:
+            self.silent.update(0.0, now)
+        return self.changes()
+
+    # Check that samples are still arriving, at time [now]: call this regularly whether or not there are any.
+    # Returns a list of AlarmEvents, as update() does.
+    def check(self, now):
+        if self.silenceTime is not None:
+            self.silent.update(now - self.lastSample, now, self.lastSample + self.silenceTime)
+        return self.changes()
+
+    # The changes of state since the last call
+    def changes(self):
+        if not self.pending:
+            return ()
+        events = self.pending[:]
+        self.pending.clear()
+        return events
@@ -0,0 +1,323 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# Benchmarks for the acquisition-to-display pipeline of VentGUI.py, run without a screen.
+# Measures the throughput of MainWindow.updateData(), the latency of each stage of handling a sample,
+# and the jitter of the Qt timer and the sampling scheduler, for a range of graph and moving window sizes.
+# Results are printed as JSON (or saved with --output) so that runs can be compared by a script.
+#
+# Run from the VentGUI directory, e.g.
+#     python3 VentBench.py --output bench.json
+#     python3 VentBench.py --quick
+
+import os
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen') # no screen needed; must be set before Qt is loaded
+
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+
+from PyQt5 import QtWidgets, QtCore
+import VentGUI
+import VentComms
+from VentSim import LungSimulator
+from VentEmulator import SensorEmulator
+
+
+# =========== Utility functions =============
+
+# Summary statistics, in microseconds, of a list of durations in nanoseconds
+def summarise(durationsNs):
+    us = np.asarray(durationsNs, dtype=np.float64) / 1000
+    return {
+        'count': len(us),
+        'meanUs': float(us.mean()),
+        'p50Us': float(np.percentile(us, 50)),
+        'p99Us': float(np.percentile(us, 99)),
+        'maxUs': float(us.max()),
+    }
+
+# Time [fn] on each of [count] calls, returning a list of durations in nanoseconds
+def timeCalls(fn, count):
+    durations = []
+    clock = time.perf_counter_ns
+    for _ in range(count):
+        start = clock()
+        fn()
+        durations.append(clock() - start)
+    return durations
+
+# Make a MainWindow with the given settings, with its own timers and acquisition thread stopped
+# so that the benchmarks can feed it samples and redraw it directly
+def makeWindow(graphPoints, movingWindowPpeak, movingWindowPEEP, movingWindowVte):
+    VentGUI.graphPoints = graphPoints
+    VentGUI.movingWindowPpeak = movingWindowPpeak
+    VentGUI.movingWindowPEEP = movingWindowPEEP
+    VentGUI.movingWindowVte = movingWindowVte
+    window = VentGUI.MainWindow()
+    window.timer.stop()
+    window.renderTimer.stop()
+    window.statsTimer.stop()
+    window.dumpTimer.stop()
+    window.acquisition.stop()
+    return window
+
+# Simulated samples for the window's first patient, as a list of (address, timestamp, pressure, flow)
+def makeSamples(window, count):
+    period = VentGUI.sampleInterval()
+    source = VentGUI.AcquisitionThread(period, [window.patient.address])
+    samples = []
+    for i in range(count):
+        for address, pressure, flow in source.readSensors():
+            samples.append((address, i * period / 1000, pressure, flow))
+    return samples
+
+
+# =========== Benchmarks =============
+
+# Samples per second that updateData() can process, including the graph updates,
+# with [chunk] samples arriving between each redraw
+def benchThroughput(app, window, samples, chunk):
+    queue = window.acquisition.samples
+    start = time.perf_counter()
+    for i in range(0, len(samples), chunk):
+        queue.extend(samples[i:i+chunk])
+        window.updateData()
+        window.renderGraphs()
+        app.processEvents() # let the graphs repaint, as they would between timer ticks
+    elapsed = time.perf_counter() - start
+    perSample = elapsed / len(samples)
+    return {
+        'samples': len(samples),
+        'samplesPerSecond': len(samples) / elapsed,
+        'usPerSample': perSample * 1e6,
+        # Fraction of the GUI thread used at the configured sampling interval, for one patient
+        'loadAtInterval': perSample / (VentGUI.sampleInterval() / 1000),
+    }
+
+# Latency of each stage of handling one sample, measured separately
+def benchStages(app, window, samples):
+    patient = window.patient
+    feed = iter(samples * 2)
+    results = {}
+
+    # Getting a sample (simulated, as there are no sensors)
+    source = VentGUI.AcquisitionThread(VentGUI.sampleInterval(), [patient.address])
+    results['sample'] = summarise(timeCalls(source.readSensors, len(samples)))
+
+    # Analytics: the patient's stats and breath detection
+    def analytics():
+        address, timestamp, pressure, flow = next(feed)
+        patient.addSample(timestamp, pressure, flow)
+    results['analytics'] = summarise(timeCalls(analytics, len(samples)))
+
+    # Signal emission alone, with the graph slots disconnected
+    window.newPress.disconnect(window.plotPressure)
+    window.newFlow.disconnect(window.plotFlow)
+    def emit():
+        window.newPress.emit(1.0)
+        window.newFlow.emit(1.0)
+    results['emit'] = summarise(timeCalls(emit, len(samples)))
+    window.newPress.connect(window.plotPressure)
+    window.newFlow.connect(window.plotFlow)
+
+    # Passing the latest data to both graphs
+    def setData():
+        window.pressureLine.setData(patient.graphTimes(), patient.pressData.view())
+        window.flowLine.setData(patient.graphTimes(), patient.flowData.view())
+    results['setData'] = summarise(timeCalls(setData, len(samples)))
+
+    # Repainting both graphs
+    def repaint():
+        setData()
+        window.pressGraphWidget.repaint()
+        window.flowGraphWidget.repaint()
+    results['repaint'] = summarise(timeCalls(repaint, max(1, len(samples)//10)))
+    return results
+
+# How much faster than real time [seconds] of simulated data for [patients] patients can be processed,
+# with a redraw at the display rate; below 1, the GUI couldn't keep up with that many patients
+def benchPatients(app, patients, seconds):
+    VentGUI.ADDRESSES = list(range(1, patients+1))
+    window = makeWindow(VentGUI.graphPoints, VentGUI.movingWindowPpeak, VentGUI.movingWindowPEEP, VentGUI.movingWindowVte)
+    period = window.acquisition.patientPeriod
+    simulator = LungSimulator(patients, period, variation=VentGUI.simVariation, **VentGUI.simSettings)
+    times, pressures, flows = simulator.block(int(seconds * 1000 / period))
+    # Samples in the order they would arrive: every patient at each time
+    samples = [(address, t, p, f) for i, t in enumerate(times.tolist())
+               for address, p, f in zip(VentGUI.ADDRESSES, pressures[:, i].tolist(), flows[:, i].tolist())]
+    chunk = max(1, round(patients * 1000 / VentGUI.displayFPS / period))
+    result = benchThroughput(app, window, samples, chunk)
+    window.close()
+    return {
+        'patients': patients,
+        'seconds': seconds,
+        'usPerSample': result['usPerSample'],
+        'realTimeFactor': seconds / (result['samples'] / result['samplesPerSecond']),
+    }
+
+# Round-trip time of the real serial code, talking to the emulated cable on a pseudo-terminal for [seconds]:
+# one transaction per tick reading flow and pressure from [patients] patients, pipelined or not,
+# with [latency] seconds before each reply, [turnaround] seconds of quiet bus before each reply,
+# and faults added at [faultRate]. Commands for several patients are only sent in one burst if [queuesReplies].
+def benchSerial(patients, pipelined, seconds, latency=0.0, faultRate=0.0, turnaround=0.0, queuesReplies=False):
+    import serial
+    addresses = list(range(1, patients+1))
+    emulator = SensorEmulator(addresses, latency, 115200, faultRate, faultRate, seed=1, turnaround=turnaround)
+    port = serial.Serial(emulator.start(), 115200, timeout=0.05)
+    transaction = VentComms.Transaction(port, pipelined, queuesReplies=queuesReplies)
+    for address in addresses:
+        transaction.add(address, 'flow')
+        transaction.add(address, 'pressure')
+    durations = []
+    errors = dict.fromkeys(transaction.errors, 0)
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        start = time.perf_counter_ns()
+        transaction.execute()
+        durations.append(time.perf_counter_ns() - start)
+        for name, n in transaction.errors.items():
+            errors[name] += n
+    port.close()
+    emulator.stop()
+    return {
+        'patients': patients,
+        'pipelined': pipelined,
+        'bursting': transaction.bursting,
+        'latencyMs': latency * 1000,
+        'turnaroundMs': turnaround * 1000,
+        'faultRate': faultRate,
+        'transaction': summarise(durations),
+        'errors': errors,
+    }
+
+# Jitter of the GUI timer while the whole app is running: the acquisition thread, updateData() and repainting
+def benchTimerJitter(app, interval, duration):
+    VentGUI.interval = interval
+    window = VentGUI.MainWindow()
+    ticks = []
+    window.timer.timeout.connect(lambda: ticks.append(time.perf_counter_ns()))
+    QtCore.QTimer.singleShot(int(duration * 1000), app.quit)
+    app.exec_()
+    scheduler = window.acquisition.scheduler
+    sampleRate = scheduler.rate()
+    window.close()
+    periods = np.diff(ticks) / 1e6 # in ms
+    if len(periods) == 0:
+        return {'interval': interval, 'ticks': len(ticks)}
+    lateness = periods - interval
+    return {
+        'interval': interval,
+        'ticks': len(ticks),
+        'meanPeriodMs': float(periods.mean()),
+        'stdPeriodMs': float(periods.std()),
+        'p99LatenessMs': float(np.percentile(lateness, 99)),
+        'maxLatenessMs': float(lateness.max()),
+        'overruns': int((periods > 2 * interval).sum()), # ticks that came more than one interval late
+        # The sampling loop's own ticks, which are scheduled separately from the Qt timer
+        'sampleRateHz': sampleRate,
+        'targetRateHz': 1000 / VentGUI.sampleInterval(),
+        'missedTicks': scheduler.missed,
+        'schedulerOverruns': scheduler.overruns,
+    }
+
+
+# ============== main() funcion =======================
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VentGUI acquisition-to-display pipeline")
+    parser.add_argument('--output', help="file to save the JSON results in (default: print them)")
+    parser.add_argument('--quick', action='store_true', help="fewer, shorter runs, as a smoke test")
+    parser.add_argument('--samples', type=int, default=5000, help="samples per throughput/latency run")
+    parser.add_argument('--graph-points', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--windows', type=int, nargs='+', default=[20, 200], help="moving window sizes")
+    parser.add_argument('--intervals', type=int, nargs='+', default=[50, 10], help="timer intervals in ms")
+    parser.add_argument('--jitter-seconds', type=float, default=5)
+    parser.add_argument('--patients', type=int, nargs='+', default=[1, 10, 50], help="simulated patients to load-test")
+    parser.add_argument('--patient-seconds', type=float, default=20, help="seconds of data per patient load test")
+    parser.add_argument('--serial-seconds', type=float, default=5, help="seconds per emulated serial test (0 for none)")
+    parser.add_argument('--serial-latency', type=float, default=1, help="emulated cable's reply latency, in ms")
+    parser.add_argument('--serial-turnaround', type=float, default=0.5, help="emulated bus turnaround, in ms")
+    parser.add_argument('--serial-queues', action='store_true',
+                        help="let the emulated cables queue replies, so several patients' commands can be pipelined")
+    parser.add_argument('--serial-faults', type=float, default=0.01, help="chance of a dropped byte or corrupt reply")
+    parser.add_argument('--high-rate', type=int, metavar='HZ', help="benchmark high-rate mode at this sampling rate")
+    args = parser.parse_args()
+    if args.high_rate:
+        VentGUI.HIGH_RATE = True
+        VentGUI.highRateHz = args.high_rate
+    if args.quick:
+        args.samples = 500
+        args.graph_points = [100]
+        args.windows = [20]
+        args.intervals = [50]
+        args.jitter_seconds = 1
+        args.patients = [1, 10]
+        args.patient_seconds = 5
+        args.serial_seconds = 1
+
+    app = QtWidgets.QApplication(sys.argv)
+    defaultInterval = VentGUI.interval
+    defaultSizes = (VentGUI.graphPoints, VentGUI.movingWindowPpeak, VentGUI.movingWindowPEEP, VentGUI.movingWindowVte)
+    results = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'interval': defaultInterval,
+        'sampleInterval': VentGUI.sampleInterval(),
+        'pipeline': [],
+        'patients': [],
+        'serial': [],
+        'timer': [],
+    }
+
+    for points in args.graph_points:
+        for window in args.windows:
+            w = makeWindow(points, window, max(1, window//4), max(1, window//4))
+            samples = makeSamples(w, args.samples)
+            run = {'graphPoints': points, 'movingWindowPpeak': window}
+            # Samples per redraw at the configured sampling interval and display rate
+            chunk = max(1, round(1000 / VentGUI.displayFPS / VentGUI.sampleInterval()))
+            run['throughput'] = benchThroughput(app, w, samples, chunk)
+            run['stages'] = benchStages(app, w, samples)
+            results['pipeline'].append(run)
+            w.close()
+            print("graphPoints=%d window=%d: %.1f us/sample" % (points, window, run['throughput']['usPerSample']), file=sys.stderr)
+
+    # Load tests and timer jitter are measured with the default graph and window sizes
+    VentGUI.graphPoints, VentGUI.movingWindowPpeak, VentGUI.movingWindowPEEP, VentGUI.movingWindowVte = defaultSizes
+    defaultAddresses = VentGUI.ADDRESSES
+    for patients in args.patients:
+        run = benchPatients(app, patients, args.patient_seconds)
+        results['patients'].append(run)
+        print("patients=%d: %.1fx real time" % (patients, run['realTimeFactor']), file=sys.stderr)
+    VentGUI.ADDRESSES = defaultAddresses
+
+    # The serial code path, against the emulated cable
+    if args.serial_seconds > 0:
+        for patients in (1, 3):
+            for pipelined in (False, True):
+                run = benchSerial(patients, pipelined, args.serial_seconds, args.serial_latency/1000, args.serial_faults,
+                                  args.serial_turnaround/1000, args.serial_queues)
+                results['serial'].append(run)
+                print("serial patients=%d pipelined=%s bursting=%s: %.0f us/transaction" %
+                      (patients, pipelined, run['bursting'], run['transaction']['meanUs']), file=sys.stderr)
+
+    for interval in args.intervals:
+        run = benchTimerJitter(app, interval, args.jitter_seconds)
+        results['timer'].append(run)
+        print("interval=%d ms: %d ticks" % (interval, run['ticks']), file=sys.stderr)
+    VentGUI.interval = defaultInterval
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
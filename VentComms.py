@@ -0,0 +1,317 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# RS485 protocol for the sensor cable: command table, checksums, reply frame decoding, pipelined command transactions,
+# and polling the slower status commands in the bus time the samples leave free.
+
+import math
+import struct
+import time
+from collections import deque
+
+
+# =========== Command frames =============
+
+# Every command is sent as a frame: [address, command, payload length, payload bytes..., CRC-8]
+# Table of the known commands: name -> (command byte, length of the reply frame in bytes)
+COMMANDS = {
+    'sw_version':               (0x01, 7),
+    'hw_version':               (0x02, 6),
+    'test':                     (0x05, 6),
+    'pressure':                 (0x07, 6),
+    'hard_reset_board':         (0x0B, 4),
+    'hard_reset_sensor':        (0x0C, 4),
+    'soft_reset_sensor':        (0x0D, 4),
+    'start_flowsensor':         (0x0E, 4),
+    'flow':                     (0x10, 8),
+    'raw_flow':                 (0x11, 6),
+    'flowsensor_scale':         (0x12, 6),
+    'flowsensor_offset':        (0x13, 6),
+    'heater_state':             (0x14, 5),
+    'heater_power':             (0x15, 5),
+    'temperature':              (0x16, 6),
+    'temperature_scale':        (0x18, 6),
+    'temperature_offset':       (0x19, 6),
+    'force_temperature_update': (0x1B, 6),
+}
+
+
+# CRC-8 used by the cable (polynomial 0x31, initial value 0); this is the last byte of every frame
+def crc8Bitwise(data):
+    crc = 0
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x31) & 0xFF if (crc & 0x80) else (crc << 1) & 0xFF
+    return crc
+
+# The CRC-8 of every single byte, so that crc8() takes one table lookup per byte instead of eight shifts
+CRC_TABLE = bytes(crc8Bitwise([b]) for b in range(256))
+
+def crc8(data):
+    crc = 0
+    for b in data:
+        crc = CRC_TABLE[crc ^ b]
+    return crc
+
+# Build the bytes for one command, including its checksum
+def buildCommand(address, name, payload=b''):
+    frame = bytearray([address, COMMANDS[name][0], len(payload)]) + bytes(payload)
+    frame.append(crc8(frame))
+    return bytes(frame)
+
+
+# =========== Decoding replies =============
+
+# A reply frame has the same layout as a command: [address, command, payload length, payload bytes..., CRC-8].
+# Replies are checked and decoded in place, on the buffer they were read into (bytes or a memoryview),
+# without copying or converting them.
+
+# Check whether [data] holds a valid reply to command [name] from [address] at [offset]: the header matches,
+# the whole frame is there, and its checksum is right
+def validFrame(data, offset, address, name):
+    length = COMMANDS[name][1]
+    end = offset + length
+    return (end <= len(data) and data[offset] == address and data[offset+1] == COMMANDS[name][0]
+            and data[offset+2] == length - 4 and crc8(memoryview(data)[offset:end-1]) == data[end-1])
+
+# Find the next valid reply to command [name] from [address] in [data] (bytes), starting at [offset]
+# and before [limit] if it is given.
+# If the bytes at [offset] aren't one (because bytes were lost or corrupted), look further on for the
+# reply's header, so that one bad frame doesn't lose all the replies after it.
+# Returns the offset of the reply, or -1 if there isn't one.
+def findFrame(data, offset, address, name, limit=None):
+    if validFrame(data, offset, address, name):
+        return offset
+    header = bytes([address, COMMANDS[name][0], COMMANDS[name][1] - 4])
+    end = len(data) if limit is None else min(len(data), limit + len(header) - 1) # so the header starts before limit
+    start = offset
+    while True:
+        start = data.find(header, start + 1, end)
+        if start < 0 or validFrame(data, start, address, name):
+            return start
+
+# The reply to command [name] from [address] if [reply] is one, otherwise None
+def checkReply(reply, address, name):
+    return reply if validFrame(reply, 0, address, name) else None
+
+# Raw readings, from the bytes between the header and the checksum
+PRESSURE = struct.Struct('<3xH') # 16-bit unsigned, little-endian
+FLOW = struct.Struct('<3xi')     # 32-bit signed, little-endian, in thousandths of a litre per minute
+
+# Convert a pressure reply to cm H2O, or return None if there is no reply (or it is too short)
+def decodePressure(reply):
+    if reply is None or len(reply) < COMMANDS['pressure'][1]:
+        return None
+    Dp, = PRESSURE.unpack_from(reply)
+    return 1.01972*(((Dp-1638)/32.7675)-200) # Apply scaling factor and convert to CM H2O
+
+# Convert a flow reply to litres per minute, or return None if there is no reply (or it is too short)
+def decodeFlow(reply):
+    if reply is None or len(reply) < COMMANDS['flow'][1]:
+        return None
+    F, = FLOW.unpack_from(reply)
+    return F/1000
+
+# Commands whose reply is the command frame itself, to show that it was done
+ACKNOWLEDGED = ('hard_reset_board', 'hard_reset_sensor', 'soft_reset_sensor', 'start_flowsensor')
+
+# Convert the reply to any other command to a number, or return None if there is no reply:
+# temperatures in degrees C, the heater state (0 off, 1 on) and power (%), 1 for an acknowledged command,
+# and the payload bytes as a big-endian integer for the rest.
+# Note: the temperature format is an assumption that hasn't been checked against a cable. It is taken to be
+# hundredths of a degree (from temperature_scale's default of 100), little-endian like the pressure and flow
+# readings. Check it, and the scale and offset, against a real cable before relying on the temperatures shown.
+def decodeStatus(reply, name):
+    if reply is None or len(reply) < COMMANDS[name][1]:
+        return None
+    if name in ACKNOWLEDGED:
+        return 1
+    payload = bytes(reply[3:COMMANDS[name][1]-1])
+    if name in ('temperature', 'force_temperature_update'):
+        return int.from_bytes(payload, 'little') / 100
+    if name in ('heater_state', 'heater_power'):
+        return payload[0]
+    return int.from_bytes(payload, 'big')
+
+# A value from decodeStatus() as text to show, e.g. '37.0 C' or version '1.0.0'
+def formatStatus(name, value):
+    if name in ('temperature', 'force_temperature_update'):
+        return "%.1f C" % value
+    if name == 'heater_state':
+        return "on" if value else "off"
+    if name == 'heater_power':
+        return "%d%%" % value
+    if name in ACKNOWLEDGED:
+        return "done"
+    payload = int(value).to_bytes(COMMANDS[name][1] - 4, 'big')
+    if name in ('sw_version', 'hw_version'):
+        return ".".join(str(b) for b in payload)
+    return payload.hex()
+
+
+# =========== Pipelined transactions =============
+
+# A list of commands (for any addresses on the bus) that are sent together.
+# Pipelined, all of the commands are written in one burst and all the replies are read back in one go,
+# then found in what was read by their headers and checksums. This costs one bus round-trip per transaction
+# instead of one per command. Non-pipelined, each command is written and its reply read in turn.
+# The bus is half-duplex and shared, so if the commands are for more than one address, a second cable could start
+# replying while the rest of the burst is still being sent, and the two would collide. A transaction is therefore
+# only pipelined if all of its commands are for one address, or if [queuesReplies] says the hardware is documented
+# to hold its replies until the bus is quiet; otherwise it is sent a command at a time even if [pipelined] is set.
+# A transaction can be executed as often as needed, so build it once and reuse it every tick.
+# Replies are waited for until their time on the wire plus [margin] seconds (for the cable's turnaround
+# and the serial driver), rather than the port's own timeout, and no later than execute()'s timeout if it is given.
+# After each execute(), errors holds how many replies were missing or bad, by type:
+# timeouts (nothing arrived), shortReads (part of it arrived), badFrames (it arrived but was corrupt),
+# and resyncs (a reply was found after skipping bytes that weren't part of it).
+class Transaction:
+
+    def __init__(self, port, pipelined=False, margin=0.02, queuesReplies=False):
+        self.port = port
+        self.pipelined = pipelined
+        self.queuesReplies = queuesReplies
+        self.margin = margin
+        self.wire = 0.0 # time on the wire for all of the commands and replies, in seconds
+        self.wires = [] # the same for each command
+        self.commands = []
+        self.expected = [] # (address, name, reply length) for each command
+        self.replyLengths = []
+        self.burst = b''
+        self.errors = {'timeouts': 0, 'shortReads': 0, 'badFrames': 0, 'resyncs': 0}
+
+    # Queue a command, and return its index in the list of replies
+    def add(self, address, name, payload=b''):
+        self.commands.append(buildCommand(address, name, payload))
+        self.expected.append((address, name, COMMANDS[name][1]))
+        self.replyLengths.append(COMMANDS[name][1])
+        self.wires.append(wireTime(name, self.port.baudrate, len(payload)))
+        self.wire += self.wires[-1]
+        self.burst = b''.join(self.commands)
+        return len(self.commands) - 1
+
+    # Whether the commands are sent in one burst: only if pipelined, and safe on the bus (see above)
+    @property
+    def bursting(self):
+        return self.pipelined and (self.queuesReplies or len({address for address, _, _ in self.expected}) <= 1)
+
+    # Count a reply that wasn't found, given how many bytes were left to find it in
+    def missing(self, remaining, length):
+        if remaining == 0:
+            self.errors['timeouts'] += 1
+        elif remaining < length:
+            self.errors['shortReads'] += 1
+        else:
+            self.errors['badFrames'] += 1
+
+    # Send the commands and return a list with one reply per command, in the order they were added.
+    # Each reply is a memoryview of the valid frame in the bytes that were read (no copy is made),
+    # or None if it timed out or was corrupt.
+    # [timeout] limits how long to wait for all of the replies, in seconds, as well as the wire time plus the margin.
+    def execute(self, timeout=None):
+        portTimeout = self.port.timeout
+        try:
+            return self.transact(time.monotonic() + timeout if timeout is not None else math.inf)
+        finally:
+            self.port.timeout = portTimeout
+
+    # execute(), waiting for all of the replies until the time [deadline] (time.monotonic()) at the latest
+    def transact(self, deadline):
+        for name in self.errors:
+            self.errors[name] = 0
+        self.port.reset_input_buffer() # discard any late bytes from a previous transaction
+        replies = []
+        if not self.bursting:
+            for command, (address, name, length), wire in zip(self.commands, self.expected, self.wires):
+                self.port.write(command)
+                self.port.timeout = max(0.0, min(deadline - time.monotonic(), wire + self.margin))
+                data = self.port.read(length)
+                if validFrame(data, 0, address, name):
+                    replies.append(memoryview(data))
+                else:
+                    replies.append(None)
+                    self.missing(len(data), length)
+            return replies
+        self.port.write(self.burst)
+        self.port.timeout = max(0.0, min(deadline - time.monotonic(), self.wire + self.margin))
+        data = self.port.read(sum(self.replyLengths))
+        view = memoryview(data)
+        pos = 0      # where to look for the next reply: just after the last one that was found
+        nominal = 0  # where the next reply should start, if nothing had gone wrong
+        for address, name, length in self.expected:
+            # A reply can arrive early, if bytes before it were lost, but no later than the end of where it should
+            # be, so it can't be confused with a later reply to the same command
+            found = findFrame(data, pos, address, name, nominal + length)
+            if found < 0:
+                replies.append(None)
+                self.missing(max(0, len(data) - nominal), length)
+                nominal += length
+                continue
+            if found != nominal:
+                self.errors['resyncs'] += 1
+            replies.append(view[found:found+length])
+            pos = nominal = found + length
+        return replies
+
+
+# =========== Multi-rate polling =============
+
+# Bus time for a command with [payloadLength] bytes of payload and its reply, at [baudrate] (10 bits per byte), in s
+def wireTime(name, baudrate, payloadLength=0):
+    return (4 + payloadLength + COMMANDS[name][1]) * 10 / baudrate
+
+# Chooses the low-priority commands to send in the bus time that each tick's samples leave free.
+# [polls] maps status command names to how often to send each one to every address, in seconds,
+# e.g. {'temperature': 1, 'heater_state': 1}; each patient's polls are spread out over that time, so they don't
+# all land on the same tick. One-off commands can be queued with request() (e.g. the versions, or turning the
+# heater on), and go ahead of the polls, in the order they were requested.
+# Each tick, take() gives the commands whose bus time fits in the time left before the next tick's samples are due.
+# A command that doesn't fit waits for a later tick, so the samples are never delayed; a poll that is more than
+# a whole interval overdue is counted in [late] and then rescheduled from now, rather than sent again and again
+# to catch up.
+class StatusPoller:
+
+    # [overhead] is the time each transaction takes on top of its bytes on the wire (the cable's turnaround,
+    # serial driver latency and so on), in seconds
+    def __init__(self, addresses, polls, start, baudrate=115200, overhead=0.002):
+        self.baudrate = baudrate
+        self.overhead = overhead
+        self.requests = deque() # (address, name, payload)
+        self.polls = [] # [time due, address, name, interval]
+        addresses = list(addresses)
+        for name, interval in polls.items():
+            for i, address in enumerate(addresses):
+                self.polls.append([start + interval * i / len(addresses), address, name, interval])
+        self.late = 0
+
+    # Queue a one-off command, e.g. request(0x01, 'heater_state', [1]) to turn a heater on
+    def request(self, address, name, payload=b''):
+        if name not in COMMANDS:
+            raise ValueError("Unknown command: " + name)
+        self.requests.append((address, name, bytes(payload)))
+
+    # The commands to send now, at time [now], as a list of (address, name, payload), that fit in [slack] seconds
+    def take(self, now, slack):
+        budget = slack - self.overhead
+        commands = []
+        while self.requests:
+            address, name, payload = self.requests[0]
+            cost = wireTime(name, self.baudrate, len(payload))
+            if cost > budget:
+                return commands
+            budget -= cost
+            commands.append(self.requests.popleft())
+        for poll in sorted(self.polls):
+            due, address, name, interval = poll
+            if due > now:
+                break
+            cost = wireTime(name, self.baudrate)
+            if cost > budget:
+                break
+            budget -= cost
+            commands.append((address, name, b''))
+            poll[0] = due + interval
+            if poll[0] <= now:
+                self.late += 1
+                poll[0] = now + interval
+        return commands
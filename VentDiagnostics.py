@@ -0,0 +1,176 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# Low-overhead instrumentation for a running unit: latency histograms for each stage of the pipeline,
+# and counters for problems such as late ticks and short serial reads.
+# VentGUI.py shows them on a hidden overlay (tap the logo three times) and can dump them to a file periodically.
+
+import functools
+import json
+import os
+import time
+
+
+# =========== Latency histograms =============
+
+# Histogram of durations in nanoseconds, in power-of-two buckets: bucket k counts durations from 2**(k-1) up to
+# 2**k ns, so recording one is a few integer operations and the memory used never grows.
+# Percentiles are accurate to within a factor of two; the mean and maximum are exact.
+# Each histogram should only be recorded into from one thread.
+class LatencyHistogram:
+
+    BUCKETS = 40 # up to 2**39 ns, about 9 minutes
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    # Record one duration, in nanoseconds
+    def record(self, ns):
+        self.counts[min(ns.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    # Add another histogram's durations to this one
+    def add(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    # The histogram as a list that can be saved as JSON or sent to another process, and back
+    def state(self):
+        return [list(self.counts), self.count, self.total, self.max]
+
+    @classmethod
+    def fromState(cls, state):
+        h = cls()
+        counts, h.count, h.total, h.max = state
+        h.counts = list(counts)
+        return h
+
+    # Upper bound of the bucket holding the [p]th percentile (0-100), in nanoseconds
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        target = self.count * p / 100
+        seen = 0
+        for k, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(2**k, self.max)
+        return self.max
+
+    # Summary in microseconds
+    def summary(self):
+        return {
+            'count': self.count,
+            'meanUs': self.total / self.count / 1000 if self.count else 0.0,
+            'p50Us': self.percentile(50) / 1000,
+            'p99Us': self.percentile(99) / 1000,
+            'maxUs': self.max / 1000,
+            'buckets': {str(2**k): n for k, n in enumerate(self.counts) if n}, # upper bound in ns: count
+        }
+
+
+# =========== Diagnostics registry =============
+
+# Named latency histograms and counters, created when first used.
+# Look a histogram up once and keep it, so the hot path only calls record().
+# Another process's diagnostics can be included with setRemote(), e.g. those of the acquisition process.
+class Diagnostics:
+
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.remote = {} # source name: the latest state() from that process
+
+    # The histogram called [name]
+    def histogram(self, name):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = LatencyHistogram()
+        return h
+
+    # Add [n] to the counter called [name]
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    # Decorator that records every call of a function in the histogram called [name]
+    def timed(self, name):
+        h = self.histogram(name)
+        clock = time.perf_counter_ns
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = clock()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    h.record(clock() - start)
+            return wrapper
+        return decorate
+
+    # Everything recorded so far in this process, as a dict that can be sent to another one as JSON
+    def state(self):
+        return {'histograms': {name: h.state() for name, h in list(self.histograms.items())},
+                'counters': dict(self.counters)}
+
+    # Include the diagnostics from another process, given as the latest state() that it sent, called [source].
+    # Its histograms and counters are added to any of the same names here.
+    def setRemote(self, source, state):
+        self.remote[source] = state
+
+    # The histograms and counters from this process and every remote one, added together
+    def merged(self):
+        histograms = {}
+        for name, h in list(self.histograms.items()):
+            histograms[name] = LatencyHistogram.fromState(h.state())
+        counters = dict(self.counters)
+        for state in self.remote.values():
+            for name, hState in state['histograms'].items():
+                h = LatencyHistogram.fromState(hState)
+                if name in histograms:
+                    histograms[name].add(h)
+                else:
+                    histograms[name] = h
+            for name, n in state['counters'].items():
+                counters[name] = counters.get(name, 0) + n
+        return histograms, counters
+
+    # Everything recorded so far, as a dict that can be saved as JSON
+    def snapshot(self):
+        histograms, counters = self.merged()
+        return {
+            'started': self.started,
+            'time': time.time(),
+            'latency': {name: h.summary() for name, h in sorted(histograms.items())},
+            'counters': dict(sorted(counters.items())),
+        }
+
+    # A short text summary, one line per histogram and counter
+    def report(self):
+        histograms, counters = self.merged()
+        lines = []
+        for name, h in sorted(histograms.items()):
+            s = h.summary()
+            lines.append("%-14s n=%-8d mean %7.0f  p99 <%7.0f  max %7.0f us" %
+                         (name, s['count'], s['meanUs'], s['p99Us'], s['maxUs']))
+        for name, n in sorted(counters.items()):
+            lines.append("%-14s %d" % (name, n))
+        return "\n".join(lines)
+
+    # Save the snapshot to [path] as JSON, replacing the file in one step so a reader never sees half of it
+    def dump(self, path):
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(temp, path)
+
+
+# The diagnostics for the whole app
+diagnostics = Diagnostics()
@@ -0,0 +1,206 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# Emulator of the sensor cable on a pseudo-terminal, so that the real serial code can be run,
+# benchmarked and soak-tested on any Linux machine without the hardware.
+# It answers every command in VentComms.COMMANDS for its addresses, with pressure and flow from
+# simulated patients (VentSim.py), and can add reply latency, bus turnaround, wire time at a given baud rate,
+# dropped bytes and corrupt frames.
+#
+# To run it on its own, and point VentGUI.py's SERIAL_PORT at the device it prints:
+#     python3 VentEmulator.py --latency 2 --turnaround 0.5 --drop 0.01 --corrupt 0.01
+
+import argparse
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+from VentComms import COMMANDS, crc8
+from VentSim import LungSimulator
+
+
+# Command byte -> (name, reply length)
+BY_CODE = {code: (name, length) for name, (code, length) in COMMANDS.items()}
+
+# Fixed replies for the commands that don't read a sensor, as payload bytes
+FIXED_PAYLOADS = {
+    'sw_version': bytes([1, 0, 0]),
+    'hw_version': bytes([1, 0]),
+    'test': bytes([0x55, 0xAA]),
+    'raw_flow': bytes([0, 0]),
+    'flowsensor_scale': struct.pack('<H', 1000),
+    'flowsensor_offset': struct.pack('<H', 0),
+    'heater_power': bytes([50]),
+    'temperature_scale': struct.pack('<H', 100),
+    'temperature_offset': struct.pack('<H', 0),
+}
+
+# Commands whose reply is the command frame itself
+ECHOED = ('hard_reset_board', 'hard_reset_sensor', 'soft_reset_sensor', 'start_flowsensor')
+
+
+# Make a reply frame: [address, command, payload length, payload..., CRC-8]
+def replyFrame(address, code, payload):
+    frame = bytearray([address, code, len(payload)]) + payload
+    frame.append(crc8(frame))
+    return bytes(frame)
+
+
+# The emulated cable, answering on a new pseudo-terminal. start() opens it and returns the device path
+# to give to serial.Serial(). Commands are read and answered in order, as the cable does, so a burst of
+# pipelined commands gets a burst of replies.
+# [latency] is the delay before each reply in seconds, and commands and replies take as long to send as they would
+# at [baudrate] (10 bits per byte), so timings are realistic even though a pty has no real baud rate.
+# The bus is half-duplex, so each reply also waits until the bus has been quiet for [turnaround] seconds, after the
+# commands that were written to it (all of a pipelined burst) and after the reply before it.
+# [dropRate] and [corruptRate] are the chances that a reply loses a random byte or has a random bit flipped.
+# Commands with a bad checksum, or for other addresses, aren't answered.
+class SensorEmulator:
+
+    def __init__(self, addresses=(0x01,), latency=0.0, baudrate=115200, dropRate=0.0, corruptRate=0.0,
+                 seed=None, simulator=None, turnaround=0.0):
+        self.addresses = list(addresses)
+        self.latency = latency
+        self.turnaround = turnaround
+        self.busQuiet = 0.0 # when the bus stops being driven by the last command or reply (time.monotonic())
+        self.baudrate = baudrate
+        self.dropRate = dropRate
+        self.corruptRate = corruptRate
+        self.random = random.Random(seed)
+        self.simulator = simulator if simulator is not None else LungSimulator(len(self.addresses), 10, seed=seed)
+        self.rows = {address: i for i, address in enumerate(self.addresses)}
+        self.heater = {address: 0 for address in self.addresses}
+        self.startTime = time.monotonic()
+        self.counts = {'commands': 0, 'badCommands': 0, 'replies': 0, 'droppedBytes': 0, 'corruptFrames': 0}
+        self.running = False
+        self.thread = None
+        self.master = None
+        self.slave = None
+
+    # Open the pseudo-terminal and start answering; returns the device path
+    def start(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave) # no echo or line editing, as on a real serial port
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return os.ttyname(self.slave)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(1)
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    # Read commands as they arrive, and answer each complete one
+    def run(self):
+        buffer = bytearray()
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return # closed
+            # The commands are on the bus for their wire time, after anything already on it
+            self.busQuiet = max(self.busQuiet, time.monotonic()) + len(data) * 10 / self.baudrate
+            buffer += data
+            while len(buffer) >= 4:
+                length = 4 + buffer[2]
+                if len(buffer) < length:
+                    break
+                frame = bytes(buffer[:length])
+                if crc8(frame[:-1]) != frame[-1] or frame[1] not in BY_CODE:
+                    # Not a valid command: skip a byte and look for one starting at the next
+                    self.counts['badCommands'] += 1
+                    del buffer[0]
+                    continue
+                del buffer[:length]
+                self.counts['commands'] += 1
+                reply = self.answer(frame)
+                if reply is not None:
+                    self.send(reply)
+
+    # The reply to one valid command frame, or None if there is none
+    def answer(self, frame):
+        address, code, payload = frame[0], frame[1], frame[3:-1]
+        if address not in self.rows:
+            return None
+        name, length = BY_CODE[code]
+        if name in ECHOED:
+            return frame
+        if name in ('pressure', 'flow'):
+            pressures, flows = self.simulator.sample([time.monotonic() - self.startTime])
+            row = self.rows[address]
+            if name == 'pressure':
+                # The inverse of VentComms.decodePressure()
+                Dp = round((float(pressures[row, 0]) / 1.01972 + 200) * 32.7675 + 1638)
+                data = struct.pack('<H', min(max(Dp, 0), 0xFFFF))
+            else:
+                data = struct.pack('<i', round(float(flows[row, 0]) * 1000))
+        elif name == 'heater_state':
+            if payload:
+                self.heater[address] = 1 if payload[0] else 0
+            data = bytes([self.heater[address]])
+        elif name in ('temperature', 'force_temperature_update'):
+            data = struct.pack('<H', 3700) # 37.00 C
+        else:
+            data = FIXED_PAYLOADS[name]
+        return replyFrame(address, code, data[:length - 4].ljust(length - 4, b'\0'))
+
+    # Send a reply after the latency and once the bus has been quiet for the turnaround,
+    # taking as long as it would on the wire, with any faults added
+    def send(self, reply):
+        reply = bytearray(reply)
+        if self.corruptRate and self.random.random() < self.corruptRate:
+            reply[self.random.randrange(len(reply))] ^= 1 << self.random.randrange(8)
+            self.counts['corruptFrames'] += 1
+        if self.dropRate and self.random.random() < self.dropRate:
+            del reply[self.random.randrange(len(reply))]
+            self.counts['droppedBytes'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        now = time.monotonic()
+        start = max(now, self.busQuiet + self.turnaround)
+        if start > now:
+            time.sleep(start - now)
+        try:
+            os.write(self.master, reply)
+        except OSError:
+            return # closed
+        self.counts['replies'] += 1
+        self.busQuiet = start + len(reply) * 10 / self.baudrate
+        remaining = self.busQuiet - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate the sensor cable on a pseudo-terminal")
+    parser.add_argument('--addresses', type=lambda a: int(a, 0), nargs='+', default=[0x01])
+    parser.add_argument('--latency', type=float, default=0, help="delay before each reply, in ms")
+    parser.add_argument('--turnaround', type=float, default=0, help="quiet time on the bus before each reply, in ms")
+    parser.add_argument('--baudrate', type=int, default=115200)
+    parser.add_argument('--drop', type=float, default=0, help="chance of a reply losing a byte")
+    parser.add_argument('--corrupt', type=float, default=0, help="chance of a reply having a bit flipped")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    emulator = SensorEmulator(args.addresses, args.latency/1000, args.baudrate, args.drop, args.corrupt, args.seed,
+                              turnaround=args.turnaround/1000)
+    print("Emulating the sensor cable on", emulator.start(), flush=True)
+    try:
+        while True:
+            time.sleep(10)
+            print(emulator.counts, flush=True)
+    except KeyboardInterrupt:
+        emulator.stop()
+
+if __name__ == '__main__':
+    main()
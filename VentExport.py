@@ -0,0 +1,260 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# Exporting a session's samples and per-breath stats, as CSV files for spreadsheets and as columnar binary files
+# for analysis scripts. Everything is written by a background thread in batches, so the sampling loop and the GUI
+# never wait for the disk, however slow the SD card is.
+#
+# To load an export in Python, e.g. for QA:
+#     from VentExport import readColumns
+#     samples = readColumns('exports/export-20200501-120000', 'samples')
+
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+from VentRecorder import RECORD_DTYPE, BREATH_DTYPE
+from VentDiagnostics import diagnostics
+
+
+# =========== Export formats =============
+
+# An export is a directory holding, for each table (samples and breaths):
+# - [table].csv, with a header row, and times as UTC dates and times (ISO 8601) to the millisecond;
+# - [table].[column] for each column, the raw little-endian values one after another (see schema.json),
+#   which np.fromfile() reads back directly.
+# schema.json gives the format name, each table's columns and their NumPy types, and the wall-clock time
+# (time.time()) and sample clock time (time.monotonic()) when the export started, so that the sample times in
+# the columnar files can be converted to dates.
+COLUMNS_FORMAT = 'GVS columns 1'
+TABLES = {'samples': RECORD_DTYPE, 'breaths': BREATH_DTYPE}
+
+# Make a new export directory name in [directory], based on the current date and time
+def newExportPath(directory):
+    return os.path.join(directory, time.strftime('export-%Y%m%d-%H%M%S'))
+
+# Read one table from an export as a dict of NumPy arrays, one per column. If the export was still being written
+# or stopped mid-write, the columns are cut to the rows that are complete in all of them.
+def readColumns(directory, table):
+    with open(os.path.join(directory, 'schema.json')) as f:
+        schema = json.load(f)
+    if schema.get('format') != COLUMNS_FORMAT:
+        raise ValueError(directory + " is not a columnar export")
+    columns = {name: np.fromfile(os.path.join(directory, table + '.' + name), dtype=np.dtype(dtype))
+               for name, dtype in schema['tables'][table]}
+    rows = min(len(values) for values in columns.values())
+    return {name: values[:rows] for name, values in columns.items()}
+
+
+# Writes the CSV files
+class CsvWriter:
+
+    HEADERS = {
+        'samples': "time,patient,pressure,flow\n",
+        'breaths': "time,patient,ppeak,peep,vti,vte,rr,ie\n",
+    }
+
+    def __init__(self, directory, wallStart, clockStart):
+        self.wallStart = wallStart
+        self.clockStart = clockStart
+        self.files = {}
+        for table, header in self.HEADERS.items():
+            self.files[table] = open(os.path.join(directory, table + '.csv'), 'w', newline='')
+            self.files[table].write(header)
+
+    # Sample clock times as UTC dates and times
+    def dates(self, times):
+        ms = np.round((self.wallStart + (times - self.clockStart)) * 1000).astype('datetime64[ms]')
+        return np.datetime_as_string(ms, unit='ms', timezone='UTC')
+
+    def write(self, table, rows):
+        if table == 'samples':
+            lines = ["%s,%d,%.2f,%.2f\n" % row for row in
+                     zip(self.dates(rows['time']), rows['address'].tolist(),
+                         rows['pressure'].tolist(), rows['flow'].tolist())]
+        else:
+            # A breath's time is when it ended
+            lines = ["%s,%d,%.2f,%.2f,%.1f,%.1f,%.2f,%.3f\n" % row for row in
+                     zip(self.dates(rows['end']), rows['address'].tolist(), rows['ppeak'].tolist(),
+                         rows['peep'].tolist(), rows['vti'].tolist(), rows['vte'].tolist(),
+                         rows['rr'].tolist(), rows['ie'].tolist())]
+        self.files[table].write(''.join(lines))
+
+    def sync(self):
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+# Writes the columnar files
+class ColumnWriter:
+
+    def __init__(self, directory, wallStart, clockStart):
+        schema = {
+            'format': COLUMNS_FORMAT,
+            'wallStart': wallStart,
+            'clockStart': clockStart,
+            'tables': {table: [[name, dtype.fields[name][0].str] for name in dtype.names]
+                       for table, dtype in TABLES.items()},
+        }
+        with open(os.path.join(directory, 'schema.json'), 'w') as f:
+            json.dump(schema, f, indent=1)
+        self.files = {(table, name): open(os.path.join(directory, table + '.' + name), 'ab')
+                      for table, dtype in TABLES.items() for name in dtype.names}
+
+    def write(self, table, rows):
+        for name in rows.dtype.names:
+            self.files[(table, name)].write(np.ascontiguousarray(rows[name]))
+
+    def sync(self):
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+# =========== Exporter =============
+
+# The rows of one table waiting to be written: the batch being filled, and a fixed number of spare batches.
+# A full batch is handed to the writer thread, which gives it back once it is written, so the memory used is
+# bounded. If the writer falls so far behind that there is no spare batch, the full one is dropped and counted.
+class ExportTable:
+
+    def __init__(self, name, dtype, batchSize, batches):
+        self.name = name
+        self.spare = queue.SimpleQueue()
+        for i in range(batches - 1):
+            self.spare.put(np.zeros(batchSize, dtype))
+        self.batch = np.zeros(batchSize, dtype)
+        self.count = 0 # rows in the current batch
+        self.dropped = 0 # rows dropped because the writer couldn't keep up
+
+
+# Exports samples and breaths to a new directory [directory], in each of [formats] ('csv' and/or 'columns').
+# addSample() and addBreath() only copy the values into a preallocated batch; full batches, and the partial ones
+# every [flushInterval] seconds of samples, are written by a background thread, which also makes sure everything
+# written is on disk (fsync) every [syncInterval] seconds, so a power cut loses at most that much.
+# If writing fails, e.g. the disk is full or the SD card is pulled out, the error is kept in [error] and counted,
+# and the export stops: nothing more is written, and the rows added after it are discarded.
+# Call close() at the end to write and sync the rest.
+class SessionExporter:
+
+    def __init__(self, directory, formats=('csv', 'columns'), batchSize=1024, batches=16,
+                 flushInterval=1.0, syncInterval=5.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.flushInterval = flushInterval
+        self.syncInterval = syncInterval
+        wallStart, clockStart = time.time(), time.monotonic()
+        writers = {'csv': CsvWriter, 'columns': ColumnWriter}
+        unknown = set(formats) - set(writers)
+        if unknown:
+            raise ValueError("Unknown export formats: " + ", ".join(sorted(unknown)))
+        self.writers = [writers[f](directory, wallStart, clockStart) for f in formats]
+        self.samples = ExportTable('samples', RECORD_DTYPE, batchSize, batches)
+        self.breaths = ExportTable('breaths', BREATH_DTYPE, max(1, batchSize // 16), batches)
+        self.lastFlush = clockStart
+        self.error = None # the OSError that stopped the export, if any
+        self.queue = queue.SimpleQueue() # (table, batch, rows) for the writer, or None to stop
+        self.writeTime = diagnostics.histogram('exportWrite')
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Add one sample
+    def addSample(self, address, timestamp, pressure, flow):
+        table = self.samples
+        table.batch[table.count] = (timestamp, address, pressure, flow)
+        table.count += 1
+        if table.count == len(table.batch):
+            self.submit(table)
+        if timestamp - self.lastFlush >= self.flushInterval:
+            self.lastFlush = timestamp
+            self.flush()
+
+    # Add the stats for a complete breath (a BreathRecord) from the patient with sensor [address]
+    def addBreath(self, address, breath):
+        table = self.breaths
+        table.batch[table.count] = (address,) + tuple(breath)
+        table.count += 1
+        if table.count == len(table.batch):
+            self.submit(table)
+
+    # Hand the rows added so far to the writer
+    def flush(self):
+        for table in (self.samples, self.breaths):
+            if table.count > 0:
+                self.submit(table)
+
+    # Hand a table's current batch to the writer, and start filling a spare one
+    def submit(self, table):
+        if self.error is not None:
+            table.count = 0 # the export has stopped
+            return
+        try:
+            spare = table.spare.get_nowait()
+        except queue.Empty:
+            table.dropped += table.count
+            diagnostics.count('exportDropped', table.count)
+            table.count = 0
+            return
+        self.queue.put((table, table.batch, table.count))
+        table.batch = spare
+        table.count = 0
+
+    # Write everything that is left, and stop the writer
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    # The writer thread: write each batch in every format, and sync the files periodically. After an error, the
+    # batches still queued are given back unwritten.
+    def run(self):
+        lastSync = time.monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.syncInterval)
+            except queue.Empty:
+                item = () # nothing to write, but it may be time to sync
+            if item is None:
+                break
+            if item:
+                table, batch, count = item
+                if self.error is None:
+                    start = time.perf_counter_ns()
+                    try:
+                        for writer in self.writers:
+                            writer.write(table.name, batch[:count])
+                    except OSError as e:
+                        self.fail(e)
+                    self.writeTime.record(time.perf_counter_ns() - start)
+                table.spare.put(batch)
+            if self.error is None and time.monotonic() - lastSync >= self.syncInterval:
+                try:
+                    for writer in self.writers:
+                        writer.sync()
+                except OSError as e:
+                    self.fail(e)
+                lastSync = time.monotonic()
+        for writer in self.writers:
+            try:
+                if self.error is None:
+                    writer.sync()
+                writer.close()
+            except OSError as e:
+                self.fail(e)
+
+    # Stop the export because of [error] (writer thread)
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+            diagnostics.count('exportErrors')
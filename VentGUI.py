@@ -2,30 +2,94 @@
 # Developed for the Galway Vent Share project: www.galwayventshare.com
 
 
-from PyQt5 import Qt, QtWidgets, QtCore, uic
+# Note: only import what is needed at startup; e.g. PyQt5.Qt loads every Qt module, and uic is only needed
+# if the precompiled screens are missing (see loadUi() below), so they are left out to start up faster
+from PyQt5 import QtWidgets, QtCore
 from PyQt5.QtCore import pyqtSignal, pyqtSlot
-from PyQt5.QtGui import QPalette, QIcon, QPixmap, QRegion
+from PyQt5.QtGui import QIcon, QPixmap, QRegion
 
 import pyqtgraph as pg
 import sys  # We need sys so that we can pass argv to QApplication
-from random import uniform
-from numpy import array
+import os
+import importlib.util
+import ctypes
 import math
-
-import serial
+from numpy import arange, nan
+import time
+import json
+import threading
+from collections import deque
+
+import VentComms
+from VentSim import LungSimulator
+from VentAnalytics import RingBuffer, RollingMax, RollingMean, BreathDetector, BreathRecord, TrendStore, \
+    VolumeIntegrator, BreathLoops, SignalFilter
+from VentAnalytics import AlarmMonitor, SampleAlarms, ALARM_NOT_SET, ALARM_NORMAL, ALARM_ON
+from VentRecorder import SessionRecorder, ReplaySource, newSessionPath, RECORD_DTYPE, BREATH_DTYPE
+from VentDiagnostics import diagnostics
+from VentSchedule import DeadlineScheduler
+# VentTelemetry, VentExport and VentShared load asyncio, multiprocessing and shared memory, which are slow to import,
+# so they are only imported when TELEMETRY_PORT, EXPORT_SESSION or ACQUISITION_PROCESS is turned on (see below)
 
 
 # =========== Overall settings and utility functions =============
 
 # Some important overall settings
-REALSENSORS=False      # if True, read data from sensors; if false, generate random numbers
+REALSENSORS=False      # if True, read data from sensors; if false, simulate the patients (see VentSim.py)
+SERIAL_PORT = '/dev/ttyUSB0' # serial port the sensor cable is on, or the device printed by VentEmulator.py
 interval = 50          # update interval 50ms
-graphPoints = 100      # how many points to display on the graph
+graphPoints = 100      # how many points to display on the graph (at the normal sampling rate)
+HIGH_RATE = False      # if True, sample at highRateHz instead of once per interval; the screen still updates every interval
+highRateHz = 200       # sampling rate in high-rate mode, 100-500 Hz
+displayFPS = 30        # how many times per second the graphs are redrawn, whatever the sampling rate
+maxLoopSeconds = 20    # longest breath that is drawn in full on the P-V and F-V loops, in seconds
+statsInterval = 250    # how often the Ppeak, Vte and PEEP values on screen are updated, in ms
+alarmHysteresisPpeak = 1  # how far back inside its limit Ppeak has to come before its alarm goes off (cm H2O)
+alarmHysteresisVte = 10   # the same for Vte (mL)
+alarmHysteresisPEEP = 0.5 # the same for PEEP (cm H2O)
+alarmDebounce = 1      # how many breaths in a row must agree before a Ppeak, Vte or PEEP alarm goes on or off
+maxAlarmEvents = 1000  # how many alarm changes to keep in the alarm event log
+pressureAlarmDebounce = 2 # samples in a row above the Ppeak alarm limit before the high pressure alarm goes on
+disconnectPressure = 2 # alarm if the pressure stays below this (cm H2O) for disconnectTime seconds; None for off
+disconnectTime = 1
+apneaTime = 20         # alarm if no breath starts for this many seconds; None for off
+silenceTime = 1        # alarm if a patient's sensor gives no valid reading for this many seconds; None for off
 movingWindowPpeak = 20 # Size of the window for estimation of Ppeak
 movingWindowPEEP = 5   # size of moving window for PEEP display
 movingWindowVte = 5    # size of moving window for Vte display
-P_old = 0
+filterMedian = 3       # samples in the median filter that removes spikes from pressure and flow before analysis; 1 for none
+filterCutoffHz = 5     # cutoff of the low-pass filter after it, in Hz; None for none
+trendHours = 24       # how far back the trend graphs of Ppeak, PEEP and Vte go, in hours
+trendPoints = 1500    # most points on each trend graph; if every breath would be more, per-minute min/max/mean are shown
+trendRefresh = 5000   # how often the trend graphs are redrawn while they are shown, in ms
 ADDRESS = 0x01        # Address for sensor comms
+ADDRESSES = [ADDRESS] # Addresses of all the patients' sensors sharing the RS485 bus, e.g. [0x01, 0x02, 0x03]
+patientsPerTick = 0   # how many patients to poll on each tick, taking turns (round-robin); 0 polls all of them every tick
+statusPolls = {'temperature': 1, 'heater_state': 1, 'heater_power': 1} # status commands sent to every patient's cable, and how often (s)
+statusMargin = 2      # bus time to leave free before each tick's samples are due when sending status commands, in ms
+diagnosticCommands = ('sw_version', 'hw_version', 'test') # sent to every patient's cable when the diagnostics are shown
+PIPELINE_COMMANDS = False # if True, send each tick's commands for one cable in one burst (see VentComms.Transaction)
+CABLE_QUEUES_REPLIES = False # if True, PIPELINE_COMMANDS also bursts to several cables; only for cables documented to queue replies
+maxQueuedSamples = 1000 # most samples held between acquisition thread and GUI before the oldest are dropped
+ACQUISITION_PROCESS = False # if True, sample and detect breaths in a separate process, so the GUI can't delay sampling
+sharedRingSize = 8192 # most samples held in shared memory between acquisition process and GUI
+diagnosticsMessageSize = 65536 # most bytes of diagnostics (as JSON) the acquisition process can send to the GUI
+RECORD_SESSION = False # if True, save every sample to a new session file in recordingsDir
+recordingsDir = 'recordings'
+EXPORT_SESSION = False # if True, export every sample and breath's stats to a new directory in exportDir (see VentExport.py)
+exportDir = 'exports'
+exportFormats = ('csv', 'columns') # 'csv' for spreadsheets, 'columns' for NumPy (see VentExport.readColumns)
+exportSyncInterval = 5 # how often to make sure the exported data is on disk, in seconds
+REPLAY_FILE = None    # path of a recorded session file to play back, instead of reading sensors or simulating
+replaySpeed = 1.0     # playback speed for REPLAY_FILE: 1.0 is real time, 2.0 twice as fast, 0 as fast as possible
+simSettings = {}      # lung model for the simulated patients, e.g. {'compliance': 40, 'leak': 0.5}; see VentSim.DEFAULTS
+simVariation = 0.2    # how much the simulated patients' lungs and breath rates differ, as a fraction
+simBlockSize = 100    # how many samples to simulate at once for each patient
+TELEMETRY_PORT = None # TCP port to stream live samples and breath stats on (see VentTelemetry.py), e.g. 5020; None for off
+telemetryHost = '127.0.0.1' # address to listen on for TELEMETRY_PORT: this Pi only; '0.0.0.0' for all (see README)
+maxTelemetryQueue = 256 # most messages waiting for a telemetry client before the oldest are dropped
+diagnosticsFile = None # file to save the timing and error diagnostics to (see VentDiagnostics.py), e.g. 'diagnostics.json'
+diagnosticsInterval = 10000 # how often to save them, in ms
 
 
 # Simple utility function to round a float to a specified number of digits (defaults to 2) and convert to string
@@ -37,19 +101,60 @@ def floatToStr(value, numDigits=2):
         v = round(value, numDigits)
     return str(v)
 
-# Simple average function that returns 0 if array is empty
-def avg(arr):
-    return 0 if (len(arr) == 0) else sum(arr)/len(arr)
+# Time between samples for each poll of the sensors, in ms
+def sampleInterval():
+    return 1000/highRateHz if HIGH_RATE else interval
+
+# How many samples cover the same time as [count] samples at the normal interval, so that the graphs
+# and moving windows span the same time in high-rate mode
+def samplesFor(count):
+    return max(1, round(count * interval / sampleInterval()))
+
+# Check whether a module generated by compileui.sh exists and is newer than all of the files it was made from
+def compiledUpToDate(moduleName, sources):
+    spec = importlib.util.find_spec(moduleName)
+    if spec is None or spec.origin is None:
+        return False
+    compiledTime = os.path.getmtime(spec.origin)
+    return all(os.path.getmtime(f) <= compiledTime for f in sources if os.path.exists(f))
+
+# Load the Qt Designer file [name].ui into [widget], making its widgets attributes of [widget] as uic.loadUi() does.
+# The class precompiled from it by compileui.sh (in ui_[name].py) is used if it is up to date,
+# as that is much faster than parsing the XML at startup.
+def loadUi(name, widget):
+    if compiledUpToDate('ui_' + name, [name + '.ui']):
+        module = importlib.import_module('ui_' + name)
+        uiClass = next(getattr(module, c) for c in dir(module) if c.startswith('Ui_'))
+        ui = uiClass()
+        ui.setupUi(widget)
+        widget.__dict__.update(vars(ui))
+    else:
+        from PyQt5 import uic
+        uic.loadUi(name + '.ui', widget)
+
+# Use the images compiled into resources_rc.py by compileui.sh if it is up to date, rather than opening each image file
+imageFiles = ['images/' + f for f in os.listdir('images')] if os.path.isdir('images') else []
+if compiledUpToDate('resources_rc', ['resources.qrc'] + imageFiles):
+    import resources_rc
+    imageDir = ':/images/'
+else:
+    imageDir = 'images/'
 
 
 
 # =========== Code for communication with sensors =============
 
-if REALSENSORS:
-    # The serial port access crashes in Windows - don't access it if simulating data
+ser = None # the serial port to the sensors, once it has been opened by openSerial()
+
+# Open the serial port to the sensors. This is done by main() and by the acquisition process, rather than when the
+# module is imported, so the acquisition process (which imports this module) doesn't try to open it a second time.
+# The serial port access crashes in Windows - don't access it if simulating data
+def openSerial():
+    global ser
+    import serial
     ser = serial.Serial(
              #port = 'COM3',          #number of device, numbering starts at zero.
-             port = '/dev/ttyUSB0',
+             port = SERIAL_PORT,
              baudrate=115200,            #baudrate
              bytesize=serial.EIGHTBITS,  #number of databits
              parity=serial.PARITY_NONE,  #enable parity checking
@@ -58,131 +163,117 @@ if REALSENSORS:
              xonxoff=0,                  #disable software flow control
              rtscts=0,                   #disable RTS/CTS flow control
          )
+    return ser
 
 
 def get_sw_version(address): # Get software version of cable    
-    command = bytearray(([address] + [0x01] + [0x00] + [0xB2]))
+    command = VentComms.buildCommand(address, 'sw_version')
     ser.write(command)
     data = ser.read(7)   
     return data.hex()
     
 def get_hw_version(address): # Default hardware version    
-    command = bytearray(([address] + [0x02] + [0x00] + [0x9F]))
+    command = VentComms.buildCommand(address, 'hw_version')
     ser.write(command)
     data = ser.read(6)   
     return data.hex()
     
 def test_command(address): # Default test command     
-    command = bytearray(([address] + [0x05] + [0x00] + [0x31]))
+    command = VentComms.buildCommand(address, 'test')
     ser.write(command)
     data = ser.read(6)   
     return data.hex()
 
-def get_pressure(address): # Get pressure value from pressure sensor
-    command = bytearray(([address] + [0x07] + [0x00] + [0xE8]))
+@diagnostics.timed('get_pressure')
+def get_pressure(address): # Get pressure value from pressure sensor [in CM H2O], or None if the reply was bad
+    command = VentComms.buildCommand(address, 'pressure')
     ser.write(command)
     data = ser.read(6)
-    if(data != ""):
-        reverse_data = data[::-1]
-        pres = reverse_data[1:3]
-        Dp_old = 0
-        if(pres.hex() != ""):
-            Dp = int(pres.hex(),16)
-            Dp_old = Dp
-        else:
-            Dp = Dp_old
-        P = 1.01972*(((Dp-1638)/32.7675)-200) # Apply scaling factor and convert to CM H2O
-        return P
-    else:
-        return 1
+    reply = VentComms.checkReply(data, address, 'pressure') # check length, header and checksum
+    if reply is None:
+        diagnostics.count('badFrames')
+    return VentComms.decodePressure(reply)
     
 def hard_reset_board(address): # Hard reset of comm board on Nicolay cable
-    command = bytearray(([address] + [0x0B] + [0x00] + [0x5C]))
+    command = VentComms.buildCommand(address, 'hard_reset_board')
     ser.write(command)
     data = ser.read(4);  
     return data.hex()
 
 def hard_reset_sensor(address): # Hard reset of sensors
-    command = bytearray(([address] + [0x0C] + [0x00] + [0xF2]))
+    command = VentComms.buildCommand(address, 'hard_reset_sensor')
     ser.write(command) #write the command
     data = ser.read(4)   
     return data.hex()
     
 def soft_reset_sensor(address): # Soft reset of sensors
-    command = bytearray(([address] + [0x0D] + [0x00] + [0x06]))
+    command = VentComms.buildCommand(address, 'soft_reset_sensor')
     ser.write(command)
     data = ser.read(4)  
     return data.hex()
 
 def start_flowsensor(address): # intialise flow sensor
-    command = bytearray(([address] + [0x0E] + [0x00] + [0x2B]))
+    command = VentComms.buildCommand(address, 'start_flowsensor')
     ser.write(command)
     data = ser.read(4)
     if(command==data):
         return True
     else: return False
 
-def get_flow(address): # Get flow value from flow sensor
-    command = bytearray(([address] + [0x10] + [0x00] + [0x28]))
+@diagnostics.timed('get_flow')
+def get_flow(address): # Get flow value from flow sensor [in litres per minute], or None if the reply was bad
+    command = VentComms.buildCommand(address, 'flow')
     ser.write(command)
     data = ser.read(8)
-    if(data != ""):
-       reverse_data = data[::-1]
-       flow = reverse_data[1:5]
-       F = int(flow.hex(),16) # convert to decimal
-       #compute two's complement (convert unsigned data to signed value)
-       if F >= 2**31:  # 2**31 = 2,147,483,648
-          F -= 2**32     # 2**32 = 4,294,967,296
-       # convert flow to litres per minute
-       F = F/1000
-       return F # return F value
-    else:
-        return 1
+    reply = VentComms.checkReply(data, address, 'flow') # check length, header and checksum
+    if reply is None:
+        diagnostics.count('badFrames')
+    return VentComms.decodeFlow(reply)
     
 def get_raw_flow(address): # Get raw flow value from flow sensor
-    command = bytearray(([address] + [0x11] + [0x00] + [0xDC]))
+    command = VentComms.buildCommand(address, 'raw_flow')
     ser.write(command)
     data = ser.read(6)   
     return data.hex()
 
 def get_flowsensor_scale(address): # Get scaling factor from flow sensor
-    command = bytearray(([address] + [0x12] + [0x00] + [0xF1]))
+    command = VentComms.buildCommand(address, 'flowsensor_scale')
     ser.write(command)
     data = ser.read(6)   
     return data.hex()
     
 def get_flowsensor_offset(address): # Get offset factor from flow sensor
-    command = bytearray(([address] + [0x13] + [0x00] + [0x05]))
+    command = VentComms.buildCommand(address, 'flowsensor_offset')
     ser.write(command)
     data = ser.read(6)   
     return data.hex()
     
 def get_heater_state(address): # Get current status of heater
-    command = bytearray(([address] + [0x14] + [0x00] + [0xAB]))
+    command = VentComms.buildCommand(address, 'heater_state')
     ser.write(command)
     data = ser.read(5)   
     return data.hex()
     
 def get_heater_power(address): # Get current power of heater [in percentage]
-    command = bytearray(([address] + [0x15] + [0x00] + [0x5F]))
+    command = VentComms.buildCommand(address, 'heater_power')
     ser.write(command)
     data = ser.read(5)   
     return data.hex()
     
 def set_heater_state(address, state): # Set current status of heater [0: OFF; 1: ON]
     if(state==0): # set heater off
-       command = bytearray(([address] + [0x14] + [0x01] + [0x00] + [0xE2]))
+       command = VentComms.buildCommand(address, 'heater_state', [0x00])
        ser.write(command)
        data = ser.read(5) #read the readings
     else: # set heater on
-       command = bytearray(([address] + [0x14] + [0x01] + [0x01] + [0xD3]))
+       command = VentComms.buildCommand(address, 'heater_state', [0x01])
        ser.write(command)
        data = ser.read(5)
        
     return data.hex()
     
 def get_temperature(address): # Get current temperatue [in Celcius]
-    command = bytearray(([address] + [0x16] + [0x00] + [0x72]))
+    command = VentComms.buildCommand(address, 'temperature')
     ser.write(command)
     data = ser.read(6)
     reverse_data = data[::-1]
@@ -190,19 +281,19 @@ def get_temperature(address): # Get current temperatue [in Celcius]
     return temp.hex() # convert the temp to hex
     
 def get_temperature_scale(address): # Get current scaling factor for temperature
-    command = bytearray(([address] + [0x18] + [0x00] + [0x1F]))
+    command = VentComms.buildCommand(address, 'temperature_scale')
     ser.write(command)
     data = ser.read(6)   
     return data.hex()
     
 def get_temperature_offset(address): # Get current offset factor for temperature
-    command = bytearray(([address] + [0x19] + [0x00] + [0xEB]))
+    command = VentComms.buildCommand(address, 'temperature_offset')
     ser.write(command)
     data = ser.read(6)   
     return data.hex()
 
 def force_temperature_update(address): # Force update of temperature on board calculation
-    command = bytearray(([address] + [0x1B] + [0x00] + [0x32]))
+    command = VentComms.buildCommand(address, 'force_temperature_update')
     ser.write(command)
     data = ser.read(6)   
     reverse_data = data[::-1]
@@ -210,6 +301,589 @@ def force_temperature_update(address): # Force update of temperature on board ca
     return temp.hex()
 
 
+# =========== Background data acquisition =============
+
+# Split the patients' addresses into the groups that take turns on the bus, of patientsPerTick each
+def groupAddresses(addresses):
+    addresses = list(addresses)
+    groupSize = patientsPerTick if patientsPerTick > 0 else len(addresses)
+    return [addresses[i:i+groupSize] for i in range(0, len(addresses), groupSize)]
+
+# The per-sample alarms for one patient (see VentAnalytics.SampleAlarms), with the settings above, starting at time
+# [start]. The sensor silence alarm is left out if [sensors] is False, e.g. when playing back a recording.
+def makeSampleAlarms(pressureLimit, start, sensors=True):
+    return SampleAlarms(pressureLimit, disconnectPressure, disconnectTime, apneaTime,
+                        silenceTime=silenceTime if sensors else None, debounce=pressureAlarmDebounce,
+                        hysteresis=alarmHysteresisPpeak, start=start)
+
+# Worker thread that owns the serial port and samples the sensors on its own clock.
+# Each sample is stored as an (address, timestamp, pressure, flow) tuple in a deque that the GUI thread drains.
+# A patient's sample that was missed, because its tick was skipped, is stored as (address, deadline, NaN, NaN).
+# deque.append() and deque.popleft() are atomic, so the two threads don't need a lock,
+# a slow sensor reply can't freeze the screen, and a slow redraw can't cost a sample.
+# With several patients on the bus, they are split into groups of patientsPerTick and one group is polled per tick.
+# If it is given a ReplaySource, the thread plays back the recorded samples instead.
+# Every sample is checked against the per-sample alarms as soon as it is read (see makeSampleAlarms()), and any
+# changes of alarm state are put in a second deque as (address, AlarmEvent). The high pressure limit is read from
+# [pressureLimit], a ctypes double that may be in shared memory; setPressureLimit() changes it.
+# When reading the sensors, the status commands in statusPolls, and any that are asked for with request(), are sent
+# in the bus time that is left after each tick's samples (see VentComms.StatusPoller), and their readings are put in
+# a third deque as (address, command name, timestamp, value).
+class AcquisitionThread(threading.Thread):
+
+    def __init__(self, period=interval, addresses=ADDRESSES, replay=None, pressureLimit=None):
+        super().__init__(daemon=True) # daemon, so a stuck serial read can't stop the app exiting
+        self.period = period/1000     # sampling period in seconds
+        self.samples = deque(maxlen=maxQueuedSamples)
+        self.alarms = deque(maxlen=maxAlarmEvents)
+        self.status = deque(maxlen=maxQueuedSamples)
+        self.requests = deque(maxlen=256) # one-off commands for the poller, as (address, name, payload)
+        self.poller = None
+        self.pressureLimit = pressureLimit if pressureLimit is not None else ctypes.c_double(math.nan)
+        start = time.monotonic()
+        self.sampleAlarms = {address: makeSampleAlarms(self.pressureLimit, start, replay is None)
+                             for address in addresses}
+        self.running = False
+        self.replay = replay
+        self.tickTime = diagnostics.histogram('acquisition') # time to take each tick's readings
+        self.tickLateness = diagnostics.histogram('tickLateness') # how long after its deadline each tick started
+        # Ticks are at absolute deadlines, so they don't drift; a tick whose readings take too long makes the next
+        # one late, and if that is more than a whole period late, the samples due in between are missed and counted.
+        # The samples' own timestamps show the gap, and PatientMonitor marks it on the graphs.
+        self.scheduler = DeadlineScheduler(self.period)
+        self.serialTime = diagnostics.histogram('serial')    # time for each transaction on the bus
+        self.statusTime = diagnostics.histogram('statusPoll') # time for each transaction of status commands
+
+        # Split the patients into the groups that take turns on the bus
+        addresses = list(addresses)
+        self.groups = groupAddresses(addresses)
+        self.nextGroup = 0
+        self.patientPeriod = period * len(self.groups) # time between samples for any one patient, in ms
+        if replay is not None:
+            self.patientPeriod = replay.period() or self.patientPeriod # as recorded
+
+        if replay is not None:
+            pass # nothing to set up, as the sensors aren't used
+        elif REALSENSORS:
+            # All the commands needed for one sample from every patient in a group, sent as a single transaction
+            self.transactions = []
+            for group in self.groups:
+                transaction = VentComms.Transaction(ser, PIPELINE_COMMANDS, queuesReplies=CABLE_QUEUES_REPLIES)
+                for address in group:
+                    transaction.add(address, 'flow')
+                    transaction.add(address, 'pressure')
+                self.transactions.append(transaction)
+            self.poller = VentComms.StatusPoller(addresses, statusPolls, start, ser.baudrate)
+        else:
+            # Simulate every patient together, a block of samples at a time; each patient's samples are in one row
+            self.simulator = LungSimulator(len(addresses), self.patientPeriod, variation=simVariation, **simSettings)
+            self.simRows = {address: i for i, address in enumerate(addresses)}
+            self.simColumn = simBlockSize - 1 # the last sample used from the block; at the end, so one is made first
+
+    def run(self):
+        self.running = True
+        if self.replay is not None:
+            self.runReplay()
+            return
+        while self.running:
+            tick = self.scheduler.wait()
+            tickStart = time.monotonic()
+            self.tickLateness.record(int(tick.late * 1e9))
+            if tick.missed:
+                diagnostics.count('missedTicks', tick.missed)
+                self.markGaps(tick)
+            try:
+                for address, pressure, flow in self.readSensors():
+                    if pressure is not None and flow is not None:
+                        if len(self.samples) == self.samples.maxlen:
+                            diagnostics.count('droppedSamples') # the GUI has fallen behind
+                        self.samples.append((address, tickStart, pressure, flow))
+                        self.checkAlarms(address, tickStart, pressure, flow)
+            except OSError: # includes serial.SerialException
+                diagnostics.count('serialErrors') # lose these samples, but keep sampling
+            # Check for sensors that have gone silent, whether or not there were any samples
+            now = time.monotonic()
+            for address, alarms in self.sampleAlarms.items():
+                for event in alarms.check(now):
+                    self.alarms.append((address, event))
+            if self.poller is not None:
+                self.pollStatus()
+            elapsed = time.monotonic() - tickStart
+            self.tickTime.record(int(elapsed * 1e9))
+            if elapsed > self.period:
+                diagnostics.count('tickOverruns')
+
+    # Queue a gap marker, (address, deadline, NaN, NaN), for each patient whose turn on the bus was at one of the
+    # deadlines that [tick] missed, at the first one they missed. The groups keep their turns on the grid of deadlines,
+    # so the groups that missed their turn are the ones due then.
+    def markGaps(self, tick):
+        for k in range(min(tick.missed, len(self.groups))):
+            group = (self.nextGroup + k) % len(self.groups)
+            deadline = tick.deadline - (tick.missed - k) * self.period
+            for address in self.groups[group]:
+                self.samples.append((address, deadline, math.nan, math.nan))
+        n = len(self.groups)
+        if not REALSENSORS:
+            # Skip the samples of every round of the groups that started at a missed deadline, so simulated time
+            # keeps up with the timestamps
+            self.advanceSimulation((self.nextGroup + tick.missed + n - 1) // n - (self.nextGroup + n - 1) // n)
+        self.nextGroup = (self.nextGroup + tick.missed) % n
+
+    # Move on [rounds] samples in the simulated blocks, simulating more when they run out
+    def advanceSimulation(self, rounds):
+        self.simColumn += rounds
+        while self.simColumn >= simBlockSize:
+            times, self.simPressure, self.simFlow = self.simulator.block(simBlockSize)
+            self.simColumn -= simBlockSize
+
+    # Get one pressure and flow reading from each patient in the next group, from the sensors or simulated
+    # Returns a list of (address, pressure, flow); a reading is None if the sensor's reply didn't arrive in full
+    def readSensors(self):
+        group = self.nextGroup
+        self.nextGroup = (group + 1) % len(self.groups)
+        readings = []
+        if REALSENSORS:
+            # Real mode, not simulation mode: read data from sensors
+            transaction = self.transactions[group]
+            start = time.perf_counter_ns()
+            # Don't wait past the next tick's deadline for a reply that was lost or cut short
+            replies = transaction.execute(timeout=self.scheduler.next - time.monotonic())
+            self.serialTime.record(time.perf_counter_ns() - start)
+            for name, n in transaction.errors.items():
+                if n:
+                    diagnostics.count(name, n) # timeouts, short reads, corrupt frames and resyncs
+            for i, address in enumerate(self.groups[group]):
+                flow = VentComms.decodeFlow(replies[2*i])
+                pressure = VentComms.decodePressure(replies[2*i+1])
+                readings.append((address, pressure, flow))
+        else:
+            # Simulation mode: every patient gets one sample per round of the groups
+            if group == 0:
+                self.advanceSimulation(1)
+            for address in self.groups[group]:
+                row = self.simRows[address]
+                readings.append((address, float(self.simPressure[row, self.simColumn]),
+                                 float(self.simFlow[row, self.simColumn])))
+        return readings
+
+    # Send whichever status commands fit in the bus time left before the next tick, and queue their readings
+    def pollStatus(self):
+        while self.requests:
+            self.poller.request(*self.requests.popleft())
+        now = time.monotonic()
+        slack = self.scheduler.next - now - statusMargin/1000
+        commands = self.poller.take(now, slack)
+        if self.poller.late:
+            diagnostics.count('lateStatusPolls', self.poller.late) # the bus had no room for them in time
+            self.poller.late = 0
+        if not commands:
+            return
+        transaction = VentComms.Transaction(ser, PIPELINE_COMMANDS, queuesReplies=CABLE_QUEUES_REPLIES)
+        for address, name, payload in commands:
+            transaction.add(address, name, payload)
+        start = time.perf_counter_ns()
+        try:
+            replies = transaction.execute(timeout=slack) # don't wait into the next tick for a missing reply
+        except OSError: # includes serial.SerialException
+            diagnostics.count('serialErrors')
+            return
+        self.statusTime.record(time.perf_counter_ns() - start)
+        now = time.monotonic()
+        for (address, name, payload), reply in zip(commands, replies):
+            value = VentComms.decodeStatus(reply, name)
+            if value is None:
+                diagnostics.count('missedStatus')
+            else:
+                self.status.append((address, name, now, value))
+
+    # Play back the recorded session: each sample is queued at its recorded time (scaled by replaySpeed),
+    # or as fast as the GUI takes them if replaySpeed is 0. Timestamps keep their recorded spacing,
+    # so stats such as the breath rate come out the same as when the session was recorded.
+    def runReplay(self):
+        records = self.replay.records
+        if len(records) == 0:
+            return
+        firstTime = float(records['time'][0])
+        start = time.monotonic()
+        for block in self.replay.blocks():
+            for address, t, pressure, flow in zip(block['address'].tolist(), block['time'].tolist(),
+                                                  block['pressure'].tolist(), block['flow'].tolist()):
+                if not self.running:
+                    return
+                elapsed = t - firstTime
+                if replaySpeed > 0:
+                    delay = start + elapsed/replaySpeed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                else:
+                    # Wait for the GUI to catch up rather than letting the queue drop samples
+                    while len(self.samples) >= maxQueuedSamples//2 and self.running:
+                        time.sleep(0.005)
+                self.samples.append((address, start + elapsed, pressure, flow))
+                self.checkAlarms(address, start + elapsed, pressure, flow)
+
+    # Check one sample against its patient's per-sample alarms
+    def checkAlarms(self, address, timestamp, pressure, flow):
+        for event in self.sampleAlarms[address].update(timestamp, pressure, flow, time.monotonic()):
+            self.alarms.append((address, event))
+
+    # The samples taken since the last call, as (address, timestamp, pressure, flow)
+    def readSamples(self):
+        samples = self.samples
+        while samples:
+            yield samples.popleft()
+
+    # The changes of per-sample alarm state since the last call, as (address, AlarmEvent)
+    def readAlarms(self):
+        alarms = self.alarms
+        while alarms:
+            yield alarms.popleft()
+
+    # Set the high pressure alarm limit, or None for no limit
+    def setPressureLimit(self, limit):
+        self.pressureLimit.value = limit if limit is not None else math.nan
+
+    # The status readings since the last call, as (address, command name, timestamp, value)
+    def readStatus(self):
+        status = self.status
+        while status:
+            yield status.popleft()
+
+    # Send a one-off command to the cable for sensor [address] when the bus has time, e.g. request(0x01, 'sw_version');
+    # its reply comes back from readStatus(). Nothing is sent unless the sensors are being read.
+    def request(self, address, name, payload=b''):
+        if name not in VentComms.COMMANDS:
+            raise ValueError("Unknown command: " + name)
+        self.requests.append((address, name, bytes(payload)))
+
+    # Breaths are detected by the GUI from the samples, so none come from here
+    def readBreaths(self):
+        return ()
+
+    # The thread records its diagnostics in the GUI's process already
+    def readDiagnostics(self):
+        pass
+
+    # Ask the thread to finish, and wait for it (at most one serial timeout plus one period)
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join(2)
+
+
+# Acquisition in a separate process, so that sampling has a core to itself and the GUI's redraws and garbage
+# collection can't delay it. The process runs an AcquisitionThread's sampling loop, detects each patient's breaths,
+# checks the per-sample alarms, polls the status commands, and writes the samples, breaths, alarms and status readings
+# into SharedRings, which the GUI reads from shared memory. The high pressure limit is a double in shared memory too,
+# and requested commands go to the process in another SharedRing.
+# It has the same interface as AcquisitionThread as far as MainWindow is concerned.
+# The process sends its diagnostics to the GUI in a SharedMessage about once a second, as JSON; call
+# readDiagnostics() to include the latest in the GUI's diagnostics.
+class AcquisitionProcess:
+
+    def __init__(self, period=interval, addresses=ADDRESSES, replayFile=None):
+        importShared()
+        addresses = list(addresses)
+        self.patientPeriod = period * len(groupAddresses(addresses)) # time between samples for any one patient, in ms
+        if replayFile:
+            self.patientPeriod = ReplaySource(replayFile).period() or self.patientPeriod # as recorded
+        self.sampleRing = VentShared.SharedRing(RECORD_DTYPE, sharedRingSize)
+        self.breathRing = VentShared.SharedRing(BREATH_DTYPE, 1024)
+        self.alarmRing = VentShared.SharedRing(VentShared.ALARM_DTYPE, 1024)
+        self.statusRing = VentShared.SharedRing(VentShared.STATUS_DTYPE, 1024)
+        self.commandRing = VentShared.SharedRing(VentShared.COMMAND_DTYPE, 256)
+        self.diagnosticsBlock = VentShared.SharedMessage(diagnosticsMessageSize)
+        # Spawn rather than fork, as forking a process with Qt and other threads running isn't safe
+        context = multiprocessing.get_context('spawn')
+        self.stopping = context.Event()
+        self.pressureLimit = context.RawValue(ctypes.c_double, math.nan)
+        self.process = context.Process(target=runAcquisitionProcess, daemon=True,
+                                       args=(self.sampleRing.name, self.breathRing.name, self.alarmRing.name,
+                                             self.statusRing.name, self.commandRing.name, self.diagnosticsBlock.name,
+                                             self.pressureLimit, period, addresses, replayFile, self.stopping))
+
+    def start(self):
+        self.process.start()
+
+    # The samples written since the last call, as (address, timestamp, pressure, flow)
+    def readSamples(self):
+        for block in self.sampleRing.read():
+            yield from zip(block['address'].tolist(), block['time'].tolist(),
+                           block['pressure'].tolist(), block['flow'].tolist())
+        if self.sampleRing.dropped:
+            diagnostics.count('droppedSamples', self.sampleRing.dropped) # the GUI has fallen behind
+            self.sampleRing.dropped = 0
+
+    # The breaths detected since the last call, as (address, BreathRecord)
+    def readBreaths(self):
+        for block in self.breathRing.read():
+            for record in block.tolist():
+                yield record[0], BreathRecord(*record[1:])
+
+    # The changes of per-sample alarm state since the last call, as (address, AlarmEvent)
+    def readAlarms(self):
+        for block in self.alarmRing.read():
+            for record in block.tolist():
+                yield VentShared.alarmFromRecord(record)
+
+    # Set the high pressure alarm limit, or None for no limit
+    def setPressureLimit(self, limit):
+        self.pressureLimit.value = limit if limit is not None else math.nan
+
+    # The status readings since the last call, as (address, command name, timestamp, value)
+    def readStatus(self):
+        for block in self.statusRing.read():
+            for address, command, t, value in block.tolist():
+                yield address, VentShared.COMMAND_NAMES[command], t, value
+
+    # Send a one-off command to the cable for sensor [address] when the bus has time (see AcquisitionThread.request())
+    def request(self, address, name, payload=b''):
+        if name not in VentComms.COMMANDS:
+            raise ValueError("Unknown command: " + name)
+        self.commandRing.append(VentShared.commandRecord(address, name, payload))
+
+    # Include the process's latest diagnostics in this process's, as 'acquisition'
+    def readDiagnostics(self):
+        if self.diagnosticsBlock is None:
+            return # stopped
+        message = self.diagnosticsBlock.read()
+        if message is not None:
+            diagnostics.setRemote('acquisition', json.loads(message))
+
+    # Ask the process to finish, wait for it, and free the shared memory
+    def stop(self):
+        if self.process.is_alive():
+            self.stopping.set()
+            self.process.join(2)
+            if self.process.is_alive():
+                self.process.terminate() # e.g. stuck in a serial read
+                self.process.join(1)
+        if self.sampleRing is not None:
+            self.readDiagnostics() # its final diagnostics, for the last dump
+            self.diagnosticsBlock.close()
+            self.sampleRing.close()
+            self.breathRing.close()
+            self.alarmRing.close()
+            self.statusRing.close()
+            self.commandRing.close()
+            self.sampleRing = self.breathRing = self.alarmRing = self.statusRing = self.commandRing = None
+            self.diagnosticsBlock = None
+
+
+# Import multiprocessing and VentShared, for an AcquisitionProcess or in the acquisition process itself
+def importShared():
+    global multiprocessing, VentShared
+    import multiprocessing
+    import VentShared
+
+# Where an AcquisitionThread's samples go in the acquisition process: into the shared sample ring,
+# and through the filters and a breath detector for each patient, with any breaths into the shared breath ring.
+# It looks enough like the thread's deque (append(), len() and maxlen) to be used in its place.
+# [period] is the time between samples for any one patient, in ms.
+class SharedSampleWriter:
+
+    def __init__(self, samples, breaths, addresses, period):
+        self.samples = samples
+        self.breaths = breaths
+        self.maxlen = samples.maxlen
+        self.detectors = {address: BreathDetector() for address in addresses}
+        self.filters = {address: makeFilters(period) for address in addresses}
+
+    def __len__(self):
+        return len(self.samples) # samples the GUI hasn't read yet
+
+    def append(self, sample):
+        address, timestamp, pressure, flow = sample
+        self.samples.append((timestamp, address, pressure, flow))
+        if math.isnan(pressure):
+            return # a gap marker, not a sample
+        pressFilter, flowFilter = self.filters[address]
+        breath = self.detectors[address].push(timestamp, pressFilter.push(pressure), flowFilter.push(flow))
+        if breath is not None:
+            self.breaths.append((address,) + breath)
+
+# Where an AcquisitionThread's alarm events go in the acquisition process: into the shared alarm ring
+class SharedAlarmWriter:
+
+    def __init__(self, alarms):
+        self.alarms = alarms
+
+    def append(self, alarm):
+        self.alarms.append(VentShared.alarmRecord(*alarm))
+
+# Where an AcquisitionThread's status readings go in the acquisition process: into the shared status ring
+class SharedStatusWriter:
+
+    def __init__(self, status):
+        self.status = status
+
+    def append(self, reading):
+        address, name, t, value = reading
+        self.status.append((address, VentShared.COMMAND_NAMES.index(name), t, value))
+
+# Where an AcquisitionThread gets its requested commands in the acquisition process: from the shared command ring.
+# It looks enough like the thread's deque (len() and popleft()) to be used in its place.
+class SharedCommandReader:
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.pending = deque()
+
+    def __len__(self):
+        if not self.pending:
+            for block in self.commands.read():
+                self.pending.extend(VentShared.commandFromRecord(record) for record in block.tolist())
+        return len(self.pending)
+
+    def popleft(self):
+        return self.pending.popleft()
+
+# The acquisition process: sample until told to stop, sending the diagnostics to the GUI every second
+def runAcquisitionProcess(sampleRingName, breathRingName, alarmRingName, statusRingName, commandRingName,
+                          diagnosticsName, pressureLimit, period, addresses, replayFile, stopping):
+    importShared()
+    if REALSENSORS and not replayFile:
+        openSerial() # main() has closed it in the GUI's process
+    samples = VentShared.SharedRing.attach(sampleRingName, RECORD_DTYPE)
+    breaths = VentShared.SharedRing.attach(breathRingName, BREATH_DTYPE)
+    alarms = VentShared.SharedRing.attach(alarmRingName, VentShared.ALARM_DTYPE)
+    status = VentShared.SharedRing.attach(statusRingName, VentShared.STATUS_DTYPE)
+    commands = VentShared.SharedRing.attach(commandRingName, VentShared.COMMAND_DTYPE)
+    diagnosticsBlock = VentShared.SharedMessage.attach(diagnosticsName)
+    acquisition = AcquisitionThread(period, addresses, ReplaySource(replayFile) if replayFile else None, pressureLimit)
+    acquisition.samples = SharedSampleWriter(samples, breaths, addresses, acquisition.patientPeriod)
+    acquisition.alarms = SharedAlarmWriter(alarms)
+    acquisition.status = SharedStatusWriter(status)
+    acquisition.requests = SharedCommandReader(commands)
+    def sendDiagnostics():
+        diagnosticsBlock.write(json.dumps(diagnostics.state()).encode())
+    def waitForStop():
+        while not stopping.wait(1):
+            sendDiagnostics()
+        acquisition.running = False
+    threading.Thread(target=waitForStop, daemon=True).start()
+    acquisition.run() # in this process's main thread
+    sendDiagnostics()
+    if ser is not None:
+        ser.close()
+    diagnosticsBlock.close()
+    samples.close()
+    breaths.close()
+    alarms.close()
+    status.close()
+    commands.close()
+
+
+# =========== Per-patient stats =============
+
+# Filters for a patient's (pressure, flow) before they are analysed, for samples [period] ms apart
+def makeFilters(period):
+    return (SignalFilter(period/1000, filterMedian, filterCutoffHz),
+            SignalFilter(period/1000, filterMedian, filterCutoffHz))
+
+# Everything that is tracked for one patient: recent timestamps, pressure and flow for the graphs,
+# the breath detector, the moving windows behind the Ppeak, PEEP and Vte values, and the alarms on them.
+# Each patient on the bus has one of these, whether or not they are the one on screen.
+# [period] is the expected time between this patient's samples in ms, which sets how many are kept for the graphs.
+# Changes in the alarms' states are logged in [alarmEvents].
+class PatientMonitor:
+
+    def __init__(self, address, name, period=interval, detectBreaths=True, alarmEvents=None):
+        self.address = address
+        self.name = name
+        points = samplesFor(graphPoints)
+        # Until real samples arrive, the graphs show evenly spaced times up to now
+        self.timeData = RingBuffer(points) # timestamps of the last [points] samples, in seconds
+        self.timeData.extend(time.monotonic() - (points - arange(points)) * period/1000)
+        self.period = period/1000
+        self.gaps = 0 # times samples have been missed, because their ticks were skipped
+        self.pressData = RingBuffer(points) # last [points] pressure values
+        self.flowData = RingBuffer(points)  # last [points] flow values
+        self.volData = RingBuffer(points)   # last [points] volumes, each since the start of its breath
+        self.volume = VolumeIntegrator()
+        self.loops = BreathLoops(samplesFor(round(maxLoopSeconds * 1000 / interval)))
+        self.pressFilter, self.flowFilter = makeFilters(period)
+        self.breaths = BreathDetector() if detectBreaths else None # None if breaths are given to addBreath() instead
+        self.lastBreath = None # BreathRecord for the most recent complete breath
+        self.status = {} # latest reading of each status command from the sensor cable: name -> (timestamp, value)
+        self.pressMax = RollingMax(points) # highest pressure on the graph
+        self.posPeaks = RollingMean(samplesFor(movingWindowPpeak))
+        self.PEEP = RollingMean(movingWindowPEEP)
+        self.expV = RollingMean(movingWindowVte)
+        # Alarm state machines for the Ppeak, Vte and PEEP values: they only report changes of state
+        self.pPeakAlarm = AlarmMonitor(name + ': Ppeak', alarmHysteresisPpeak, alarmDebounce, alarmEvents)
+        self.vteAlarm = AlarmMonitor(name + ': Vte', alarmHysteresisVte, alarmDebounce, alarmEvents)
+        self.PEEPAlarm = AlarmMonitor(name + ': PEEP', alarmHysteresisPEEP, alarmDebounce, alarmEvents)
+        # Long-term history of the stats for every breath (at most one a second): every breath for the last hour,
+        # and their min, max and mean for each minute of the last trendHours, for the trend graphs
+        self.breathTrends = TrendStore(('ppeak', 'peep', 'vte', 'rr'), 1, 3600, ((60, trendHours*3600),))
+
+    # Break the lines on the graphs at [timestamp], where a sample was missed, rather than joining across the gap
+    def addGap(self, timestamp):
+        self.gaps += 1
+        self.timeData.append(timestamp)
+        self.pressData.append(nan)
+        self.flowData.append(nan)
+        self.volData.append(nan)
+
+    # Update the stats with one sample; returns the BreathRecord if it completed a breath, otherwise None
+    def addSample(self, timestamp, pressure, flow):
+        # Keep the last [points] values for the graphs (the ring buffers discard the oldest)
+        # The graphs show the samples as they were measured, and everything else uses them filtered
+        self.timeData.append(timestamp)
+        self.pressData.append(pressure)  # Add the latest pressure value
+        self.flowData.append(flow)  # Add the latest flow value
+        pressure = self.pressFilter.push(pressure)
+        flow = self.flowFilter.push(flow)
+
+        # PEEP and tidal volume estimation, once per breath
+        breath = None
+        if self.breaths is not None:
+            breath = self.breaths.push(timestamp, pressure, flow)
+            if breath is not None:
+                self.addBreath(breath)
+
+        # Volume and loops, adding just this sample to each
+        volume = self.volume.push(timestamp, flow)
+        self.volData.append(volume)
+        if self.volume.newBreath:
+            self.loops.newBreath()
+        self.loops.add(pressure, flow, volume)
+
+        # Record last [movingWindowPpeak] intervals' peak pressure values for moving average
+        self.posPeaks.push(self.pressMax.push(pressure))
+        return breath
+
+    # Update the stats with a complete breath
+    def addBreath(self, breath):
+        self.PEEP.push(breath.peep) # add new value to moving window
+        self.expV.push(breath.vte) # add new tidal volume to moving window
+        self.lastBreath = breath
+        self.breathTrends.add(breath.end, breath.ppeak, breath.peep, breath.vte, breath.rr)
+
+    # Times of the samples on the graph, in seconds from the oldest one
+    # These are the real sample times, so the graph is drawn to scale even if samples are late or missed
+    def graphTimes(self):
+        t = self.timeData.view()
+        return t - t[0]
+
+    # Current moving averages
+    def ppeak(self):
+        return self.posPeaks.mean()
+
+    def vte(self):
+        return self.expV.mean()
+
+    def peep(self):
+        return self.PEEP.mean()
+
+    # Check the Ppeak, Vte and PEEP values against their alarm limits at time t; returns the alarms that changed state
+    def checkAlarms(self, t):
+        return [alarm for alarm, value in ((self.pPeakAlarm, self.ppeak()), (self.vteAlarm, self.vte()),
+                                           (self.PEEPAlarm, self.peep()))
+                if alarm.update(value, t) is not None]
+
+
 # ============== Main Vent GUI Window =================
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -232,21 +906,72 @@ class MainWindow(QtWidgets.QMainWindow):
         super(MainWindow, self).__init__(*args, **kwargs)
 
         #Load the UI Page
-        uic.loadUi('mainwindow.ui', self)
+        loadUi('mainwindow', self)
         self.showFullScreen();
 
         # Set up button icons: logo, home screen and alarm screen
-        self.gvsLogo.setPixmap(QPixmap('images/galwayventshare.jpg'))
-        self.btnAlarmScreen.setIcon(QIcon('images/alarmscreennot.png'))
+        self.gvsLogo.setPixmap(QPixmap(imageDir + 'galwayventshare.jpg'))
+        self.btnAlarmScreen.setIcon(QIcon(imageDir + 'alarmscreennot.png'))
         self.btnAlarmScreen.setIconSize(QtCore.QSize(70,70))
 
-        # Set up alarm icons
-        self.iconPPeakAlarm.setPixmap(QPixmap('images/alarmnotset.png'))
-        self.iconVteAlarm.setPixmap(QPixmap('images/alarmnotset.png'))
-        self.iconPEEPAlarm.setPixmap(QPixmap('images/alarmnotset.png'))
-
-        # Set up a timer to get new data at fixed intervals
+        # Set up alarm icons, loading each image once for all the alarms
+        self.alarmIcons = {ALARM_NOT_SET: QPixmap(imageDir + 'alarmnotset.png'),
+                           ALARM_NORMAL: QPixmap(imageDir + 'alarmset.png'),
+                           ALARM_ON: QPixmap(imageDir + 'alarmon.png')}
+        self.iconPPeakAlarm.setPixmap(self.alarmIcons[ALARM_NOT_SET])
+        self.iconVteAlarm.setPixmap(self.alarmIcons[ALARM_NOT_SET])
+        self.iconPEEPAlarm.setPixmap(self.alarmIcons[ALARM_NOT_SET])
+
+        # Samples come from a recorded session if REPLAY_FILE is set, otherwise from the sensors (or simulation)
+        replay = ReplaySource(REPLAY_FILE) if REPLAY_FILE else None
+        addresses = (replay.addresses() if replay else None) or ADDRESSES
+
+        # Sampling happens in the background; the GUI collects the samples on its own timer below
+        if ACQUISITION_PROCESS:
+            self.acquisition = AcquisitionProcess(sampleInterval(), addresses, REPLAY_FILE)
+        else:
+            self.acquisition = AcquisitionThread(sampleInterval(), addresses, replay)
+
+        # Every change in every patient's alarms is logged here
+        self.alarmEvents = deque(maxlen=maxAlarmEvents)
+
+        # One set of stats and alarms per patient; the graphs and stats on screen are for the selected patient
+        self.patients = {address: PatientMonitor(address, "Patient " + str(i+1), self.acquisition.patientPeriod,
+                                                 detectBreaths=not ACQUISITION_PROCESS, alarmEvents=self.alarmEvents)
+                         for i, address in enumerate(addresses)}
+        self.patient = self.patients[addresses[0]]
+        if len(self.patients) > 1:
+            # Button to switch between patients, between the alarm screen button and the pressure graph
+            self.btnPatient = QtWidgets.QPushButton(self.patient.name, self.centralwidget)
+            self.btnPatient.setGeometry(15,142,112,26)
+            self.btnPatient.setFlat(True)
+            self.btnPatient.setStyleSheet("QPushButton {color: white; font-weight: bold;}")
+            self.btnPatient.clicked.connect(self.showNextPatient)
+            self.btnPatient.show() # the window is already showing, so new widgets have to be shown
+
+        # Start sampling
+        self.acquisition.start()
+
+        # Save all of the samples if recording
+        self.recorder = SessionRecorder(newSessionPath(recordingsDir)) if RECORD_SESSION else None
+
+        # Export them and the breath stats, written in the background
+        self.exporter = None
+        if EXPORT_SESSION:
+            from VentExport import SessionExporter, newExportPath
+            self.exporter = SessionExporter(newExportPath(exportDir), exportFormats, syncInterval=exportSyncInterval)
+        self.writeErrorsShown = 0 # how many of the export and the recording are shown as stopped on the alarm banner
+
+        # Stream them to any telemetry clients
+        self.telemetry = None
+        if TELEMETRY_PORT is not None:
+            from VentTelemetry import TelemetryServer
+            self.telemetry = TelemetryServer(TELEMETRY_PORT, telemetryHost, maxQueued=maxTelemetryQueue)
+            self.telemetry.start()
+
+        # Set up a timer to process new data at fixed intervals
         self.timer = QtCore.QTimer()
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
         self.timer.setInterval(interval)
         self.timer.timeout.connect(self.updateData)
         self.timer.start()
@@ -255,11 +980,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.linePen = pg.mkPen(color='g', width=3)
 
         # Initialise graphs
-        self.timeData = array(range(graphPoints))*interval/1000 # time array is values in seconds
-        self.pressData = [0] * len(self.timeData) # make a list of zeros the same length as the timeData list
-        self.flowData = [0] * len(self.timeData) # make a list of zeros the same length as the timeData list
-        self.setupPressurePlot(self.timeData, self.pressData)
-        self.setupFlowPlot(self.timeData, self.flowData)
+        self.setupPressurePlot(self.patient.graphTimes(), self.patient.pressData.view())
+        self.setupFlowPlot(self.patient.graphTimes(), self.patient.flowData.view())
+        self.setupLoopPlots()
+        self.setupTrendPlots()
 
         # Alarm settings
         self.pPeakMaxAlarm = 45
@@ -271,19 +995,61 @@ class MainWindow(QtWidgets.QMainWindow):
         self.vteAlarmSet = False
         self.PEEPAlarmSet = False
 
-        # Some additional variables to calculate stats
-        # Note - moved some of these from being class variables to instance variables
-        self.timeCount = 0
-        self.prevFlow = 0
-        self.prevPress = 0
-        self.instV = 0
-        self.vteTimer = 0
-        self.insp = bool(False)
-        self.Exp = bool(False)
-        self.posPeaks = []
-        self.PEEP = []
-        self.expV = []
-        self.xSim = 0
+        # Banner over the graphs listing the per-sample alarms that are on for every patient, and the Ppeak, Vte and
+        # PEEP alarms that are on for the patients not shown
+        self.alarmBanner = QtWidgets.QLabel(self.centralwidget)
+        self.alarmBanner.setGeometry(130,170,660,30)
+        self.alarmBanner.setAlignment(QtCore.Qt.AlignCenter)
+        self.alarmBanner.setStyleSheet("QLabel {background-color: #ff0000; color: white; font-weight: bold; font-size: 16px;}")
+        self.alarmBanner.hide()
+        self.sampleAlarmsOn = {} # (patient name, alarm name): the AlarmEvent that set it off
+        self.alarmDetectTime = diagnostics.histogram('alarmDetection') # from an alarm's condition being met to it going on
+        self.alarmDisplayTime = diagnostics.histogram('alarmDisplay')  # from it going on to it being shown
+
+        # Redraw the graphs at a fixed rate, with however many samples have arrived since the last redraw,
+        # so the cost of drawing doesn't go up with the sampling rate
+        self.pressDirty = False
+        self.flowDirty = False
+        self.renderTimer = QtCore.QTimer()
+        self.renderTimer.setInterval(round(1000/displayFPS))
+        self.renderTimer.timeout.connect(self.renderGraphs)
+        self.renderTimer.start()
+
+        # Update the stats on screen at a fixed rate too
+        self.statsTimer = QtCore.QTimer()
+        self.statsTimer.setInterval(statsInterval)
+        self.statsTimer.timeout.connect(self.emitStats)
+        self.statsTimer.start()
+
+        # Timing of each stage on the GUI thread
+        self.updateTime = diagnostics.histogram('updateData')
+        self.analyticsTime = diagnostics.histogram('analytics')
+        self.renderTime = diagnostics.histogram('renderGraphs')
+        self.statsTime = diagnostics.histogram('emitStats')
+        self.tickPeriod = diagnostics.histogram('guiTickPeriod') # time between updateData() calls
+        self.lastTick = None
+
+        # Hidden diagnostics overlay, shown by tapping the logo three times (or pressing D) and hidden by tapping it,
+        # updated every second while it is shown
+        self.diagnosticsOverlay = QtWidgets.QLabel(self.centralwidget)
+        self.diagnosticsOverlay.setGeometry(self.centralwidget.rect())
+        self.diagnosticsOverlay.setAlignment(QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft)
+        self.diagnosticsOverlay.setStyleSheet("QLabel {background-color: rgba(0, 0, 0, 200); color: white; "
+                                              "font-family: monospace; font-size: 11px; padding: 8px;}")
+        self.diagnosticsOverlay.hide()
+        self.diagnosticsOverlay.installEventFilter(self)
+        self.logoTaps = deque(maxlen=3)
+        self.gvsLogo.installEventFilter(self)
+        self.diagnosticsTimer = QtCore.QTimer()
+        self.diagnosticsTimer.setInterval(1000)
+        self.diagnosticsTimer.timeout.connect(self.showDiagnostics)
+
+        # Save the diagnostics to a file periodically, if wanted
+        self.dumpTimer = QtCore.QTimer()
+        self.dumpTimer.setInterval(diagnosticsInterval)
+        self.dumpTimer.timeout.connect(self.dumpDiagnostics)
+        if diagnosticsFile:
+            self.dumpTimer.start()
 
         # Connect up signals to slots - custom signals
         self.newPress.connect(self.plotPressure)
@@ -295,147 +1061,452 @@ class MainWindow(QtWidgets.QMainWindow):
         # Connect up signals to slots - standard UI signals
         self.btnAlarmScreen.clicked.connect(self.showAlarmSettings)
 
+        # The alarm settings screen is built the first time it is needed, then kept and reused
+        self.alarmSettings = None
+
+    # The graphs only draw the part that is in view, and reduce long histories to about one point per pixel
+    # with peak-preserving downsampling (so short pressure spikes still show)
     def setupPressurePlot(self, hour, press):
-        self.pressureLine = self.pressGraphWidget.plot(hour, press, pen=self.linePen)
+        self.pressureLine = self.pressGraphWidget.plot(hour, press, pen=self.linePen, connect='finite') # gaps are NaN
+        self.pressGraphWidget.setDownsampling(auto=True, mode='peak')
+        self.pressGraphWidget.setClipToView(True)
         self.pressGraphWidget.setEnabled(False) # Disable all interaction - want output-only graph display
         self.pressGraphWidget.showGrid(x=False, y=True) # Horizontal grid lines including at y=0
 
     def setupFlowPlot(self, hour, flow):
-        self.flowLine = self.flowGraphWidget.plot(hour, flow, pen=self.linePen)
+        self.flowLine = self.flowGraphWidget.plot(hour, flow, pen=self.linePen, connect='finite')
+        self.flowGraphWidget.setDownsampling(auto=True, mode='peak')
+        self.flowGraphWidget.setClipToView(True)
         self.flowGraphWidget.setEnabled(False) # Disable all interaction - want output-only graph display
         self.flowGraphWidget.showGrid(x=False, y=True) # Horizontal grid lines including at y=0
 
+    # Volume graph, and P-V and F-V loops for the current and previous breaths, shown instead of the pressure and
+    # flow graphs when btnLoops is pressed
+    def setupLoopPlots(self):
+        self.volGraphWidget = pg.PlotWidget(self.centralwidget)
+        self.volGraphWidget.setGeometry(14,170,776,140)
+        self.volGraphWidget.setLabel('left', "Volume (mL)")
+        self.volumeLine = self.volGraphWidget.plot(self.patient.graphTimes(), self.patient.volData.view(), pen=self.linePen,
+                                                  connect='finite')
+        self.volGraphWidget.setDownsampling(auto=True, mode='peak')
+        self.volGraphWidget.setClipToView(True)
+
+        self.pvGraphWidget = pg.PlotWidget(self.centralwidget)
+        self.pvGraphWidget.setGeometry(14,330,383,140)
+        self.pvGraphWidget.setLabel('left', "Volume (mL)")
+        self.pvGraphWidget.setLabel('bottom', "Pressure (cm H2O)")
+        self.fvGraphWidget = pg.PlotWidget(self.centralwidget)
+        self.fvGraphWidget.setGeometry(407,330,383,140)
+        self.fvGraphWidget.setLabel('left', "Flow (L/min)")
+        self.fvGraphWidget.setLabel('bottom', "Volume (mL)")
+        # The previous breath's loop is drawn dimmer, behind the current one
+        previousPen = pg.mkPen(color=(0, 110, 0), width=2)
+        self.pvPrevious = self.pvGraphWidget.plot([], [], pen=previousPen)
+        self.pvLine = self.pvGraphWidget.plot([], [], pen=self.linePen)
+        self.fvPrevious = self.fvGraphWidget.plot([], [], pen=previousPen)
+        self.fvLine = self.fvGraphWidget.plot([], [], pen=self.linePen)
+
+        self.loopWidgets = (self.volGraphWidget, self.pvGraphWidget, self.fvGraphWidget)
+        self.waveformWidgets = (self.pressGraphWidget, self.flowGraphWidget, self.widget, self.widget_2)
+        for graph in self.loopWidgets:
+            graph.setEnabled(False) # Disable all interaction - want output-only graph display
+            graph.showGrid(x=False, y=True)
+            graph.hide()
+        self.showingLoops = False
+        self.previousDrawn = None # (patient address, breath count) of the previous loop drawn
+
+        # Button to switch to the next view, under the logo: it says which one that is
+        self.btnLoops = QtWidgets.QPushButton("Loops", self.centralwidget)
+        self.btnLoops.setGeometry(15,46,112,22)
+        self.btnLoops.setFlat(True)
+        self.btnLoops.setStyleSheet("QPushButton {color: white; font-weight: bold;}")
+        self.btnLoops.clicked.connect(self.showNextView)
+        self.btnLoops.show()
+
+    # Trend graphs of the selected patient's Ppeak, PEEP and Vte over the last trendHours, from their breath trends:
+    # the mean, with a band from the min to the max where breaths have been combined into minutes.
+    # They are shown after the loops, and redrawn every trendRefresh ms while they are shown.
+    def setupTrendPlots(self):
+        self.trendPlots = {}
+        bandBrush = pg.mkBrush(0, 110, 0, 120)
+        for i, (name, label) in enumerate((('ppeak', "Ppeak"), ('peep', "PEEP"), ('vte', "Vte"))):
+            graph = pg.PlotWidget(self.centralwidget)
+            graph.setGeometry(14,170+100*i,776,95)
+            graph.setLabel('left', label)
+            graph.setXRange(-trendHours, 0, padding=0)
+            graph.setEnabled(False) # Disable all interaction - want output-only graph display
+            graph.showGrid(x=True, y=True)
+            graph.hide()
+            low = graph.plot([], [], pen=None)
+            high = graph.plot([], [], pen=None)
+            graph.addItem(pg.FillBetweenItem(low, high, brush=bandBrush))
+            mean = graph.plot([], [], pen=self.linePen)
+            self.trendPlots[name] = (graph, low, high, mean)
+        self.trendPlots['vte'][0].setLabel('bottom', "Hours")
+        self.trendWidgets = tuple(graph for graph, low, high, mean in self.trendPlots.values())
+        self.showingTrends = False
+        self.trendTimer = QtCore.QTimer()
+        self.trendTimer.setInterval(trendRefresh)
+        self.trendTimer.timeout.connect(self.drawTrends)
+
+    # Redraw the trend graphs for the selected patient (slot for the trend timer)
+    @pyqtSlot()
+    def drawTrends(self):
+        now = time.monotonic()
+        for name, (graph, low, high, mean) in self.trendPlots.items():
+            trend = self.patient.breathTrends.query(name, now - trendHours*3600, maxPoints=trendPoints)
+            hours = (trend.times - now) / 3600
+            low.setData(hours, trend.min)
+            high.setData(hours, trend.max)
+            mean.setData(hours, trend.mean)
+
 
+    # Process every sample that the acquisition thread has collected since the last call
     def updateData(self):
-        if REALSENSORS:
-            # Real mode, not simulation mode: read data from sensors
-            flow = get_flow(ADDRESS)
-            pressure = get_pressure(ADDRESS)
-        else:
-            # Simulation mode: use random numbers
-            # Using cosine waves with random noise and period 2pi over 100 points
-            flow = 20 * math.cos(self.xSim / 50 * math.pi) - 10 + uniform(-3,3)
-            pressure = 5 * math.cos(self.xSim / 50 * math.pi) + 15 + uniform(-6,6)
-            self.xSim = 0 if (self.xSim >= 99) else self.xSim + 1 # wrap around 100 -> 0
-
-        # PEEP estimation
-        if(flow>=0 and self.prevFlow<0): # Detect zero crossing: negative to positive change
-            if(self.vteTimer>20): # Ignore if a cycle is too small
-               if len(self.PEEP) == movingWindowPEEP:
-                   self.PEEP = self.PEEP[1:] # disard old value from moving window
-               self.PEEP.append(self.prevPress) # add new value
-               if len(self.expV) == movingWindowVte:
-                   self.expV = self.expV[1:] # disard old value from moving window
-               self.expV.append(2286*(self.instV/(self.vteTimer*50))) # add new tidal volume
-
-            self.instV = 0
-            self.vteTimer = 0
-            self.insp = True
-            self.Exp = False
-
-        if(flow<0 and self.prevFlow>=0): # Detect zero crossing: Postive to negative change
-            self.insp = False
-            self.Exp = True
-
-        if(self.Exp == True): # for estimation of tidal volume
-            self.instV += -1*flow
-            self.vteTimer += 1
-
-        self.prevPress = pressure
-        self.prevFlow = flow
+        start = time.perf_counter_ns()
+        if self.lastTick is not None:
+            self.tickPeriod.record(start - self.lastTick)
+            if start - self.lastTick > 2 * interval * 1000000:
+                diagnostics.count('guiTickOverruns') # at least one tick was missed
+        self.lastTick = start
+        for address, timestamp, pressure, flow in self.acquisition.readSamples():
+            if math.isnan(pressure):
+                self.patients[address].addGap(timestamp) # samples were missed here
+                continue
+            if self.recorder is not None:
+                self.recorder.add(address, timestamp, pressure, flow)
+            if self.exporter is not None:
+                self.exporter.addSample(address, timestamp, pressure, flow)
+            if self.telemetry is not None:
+                self.telemetry.addSample(address, timestamp, pressure, flow)
+            self.processSample(address, timestamp, pressure, flow)
+        # Breaths detected in the acquisition process, if it is used
+        for address, breath in self.acquisition.readBreaths():
+            self.patients[address].addBreath(breath)
+            self.checkBreathAlarms(self.patients[address])
+            if self.exporter is not None:
+                self.exporter.addBreath(address, breath)
+            if self.telemetry is not None:
+                self.telemetry.addBreath(address, breath)
+        for address, event in self.acquisition.readAlarms():
+            self.showSampleAlarm(self.patients[address], event)
+        for address, name, timestamp, value in self.acquisition.readStatus():
+            self.patients[address].status[name] = (timestamp, value)
+        if self.telemetry is not None:
+            self.telemetry.flush() # one message per tick
+        if len(self.writeErrors()) != self.writeErrorsShown:
+            self.updateAlarmBanner()
+        self.updateTime.record(time.perf_counter_ns() - start)
+
+    # Update a patient's stats with one sample, and the graphs and stats on screen if it's the selected patient
+    def processSample(self, address, timestamp, pressure, flow):
+        patient = self.patients[address]
+        start = time.perf_counter_ns()
+        breath = patient.addSample(timestamp, pressure, flow)
+        self.analyticsTime.record(time.perf_counter_ns() - start)
+        if breath is not None:
+            self.checkBreathAlarms(patient)
+            if self.exporter is not None:
+                self.exporter.addBreath(address, breath)
+            if self.telemetry is not None:
+                self.telemetry.addBreath(address, breath)
+        if patient is not self.patient:
+            return
 
         # Emit messages to update pressure and flow graphs
         self.newPress.emit(pressure)
         self.newFlow.emit(flow)
 
-        # Record last [movingWindowPpeak] peak pressure values for moving average
-        if len(self.posPeaks) == movingWindowPpeak:
-            self.posPeaks = self.posPeaks[1:]
-        self.posPeaks.append(max(self.pressData))
-
-        # Emit messages (float and rounded to nearest int) to update stats on every 5th call (250ms)
-        self.timeCount += 1
-        if(self.timeCount>5):
-            e = avg(self.posPeaks)
-            self.newPpeak.emit(e)
-            self.newPpeakInt.emit(round(e))
-            e = avg(self.expV)
-            self.newVte.emit(e)
-            self.newVteInt.emit(round(e))
-            e = avg(self.PEEP)
-            self.newPEEP.emit(e)
-            self.newPEEPInt.emit(round(e))
-            self.timeCount = 0
-
-    # Update the pressure graph (slot for handling newPress signal)
+    # Emit the selected patient's stats (float and rounded to nearest int) (slot for the stats timer)
+    @pyqtSlot()
+    def emitStats(self):
+        start = time.perf_counter_ns()
+        e = self.patient.ppeak()
+        self.newPpeak.emit(e)
+        self.newPpeakInt.emit(round(e))
+        e = self.patient.vte()
+        self.newVte.emit(e)
+        self.newVteInt.emit(round(e))
+        e = self.patient.peep()
+        self.newPEEP.emit(e)
+        self.newPEEPInt.emit(round(e))
+        self.statsTime.record(time.perf_counter_ns() - start)
+
+    # Switch the graphs and stats on screen to the next patient (slot for btnPatient)
+    @pyqtSlot()
+    def showNextPatient(self):
+        addresses = list(self.patients)
+        nextAddress = addresses[(addresses.index(self.patient.address) + 1) % len(addresses)]
+        self.patient = self.patients[nextAddress]
+        self.btnPatient.setText(self.patient.name)
+        for alarm, frame, icon in self.statAlarmWidgets():
+            self.showAlarmState(alarm.state, frame, icon)
+        self.updateAlarmBanner()
+        self.pressDirty = True
+        self.flowDirty = True
+        if self.showingTrends:
+            self.drawTrends()
+        self.emitStats()
+
+    # Switch from the pressure and flow graphs to the volume graph and loops, then to the trends, then back
+    # (slot for btnLoops)
+    @pyqtSlot()
+    def showNextView(self):
+        if self.showingTrends:
+            self.showingTrends = False
+        elif self.showingLoops:
+            self.showingLoops = False
+            self.showingTrends = True
+        else:
+            self.showingLoops = True
+        showingWaveforms = not (self.showingLoops or self.showingTrends)
+        for widget in self.waveformWidgets:
+            widget.setVisible(showingWaveforms)
+        for widget in self.loopWidgets:
+            widget.setVisible(self.showingLoops)
+        for widget in self.trendWidgets:
+            widget.setVisible(self.showingTrends)
+        self.btnLoops.setText("Trends" if self.showingLoops else "Waveforms" if self.showingTrends else "Loops")
+        if self.showingTrends:
+            self.drawTrends()
+            self.trendTimer.start()
+        else:
+            self.trendTimer.stop()
+        self.pressDirty = True
+        self.flowDirty = True
+        self.renderGraphs()
+
+    # Mark the pressure graph as needing a redraw (slot for handling newPress signal)
     @pyqtSlot(float)
     def plotPressure(self, pressure):
-        self.pressData = self.pressData[1:]  # Remove the first
-        self.pressData.append(pressure)  # Add the latest pressure value
-        self.pressureLine.setData(self.timeData, self.pressData)  # Update the graph with the new data.
+        self.pressDirty = True
 
-    # Update the flow graph (slot for handling newFlow signal)
+    # Mark the flow graph as needing a redraw (slot for handling newFlow signal)
     @pyqtSlot(float)
     def plotFlow(self, flow):
-        self.flowData = self.flowData[1:]  # Remove the first
-        self.flowData.append(flow)  # Add the latest flow value
-        self.flowLine.setData(self.timeData, self.flowData)  # Update the graph with the new data.
+        self.flowDirty = True
+
+    # Redraw the graphs on screen that have new data (slot for the render timer)
+    @pyqtSlot()
+    def renderGraphs(self):
+        if not (self.pressDirty or self.flowDirty):
+            return
+        start = time.perf_counter_ns()
+        if self.showingTrends:
+            # Nothing to draw from the samples: the trends are redrawn by their own timer
+            self.pressDirty = False
+            self.flowDirty = False
+            return
+        times = self.patient.graphTimes() # all of the graphs have the same times
+        if self.showingLoops:
+            # Only the current breath's loop changes from sample to sample; the previous one changes once a breath
+            self.volumeLine.setData(times, self.patient.volData.view())
+            pressures, flows, volumes = self.patient.loops.currentLoop()
+            self.pvLine.setData(pressures, volumes)
+            self.fvLine.setData(volumes, flows)
+            drawn = (self.patient.address, self.patient.loops.breaths)
+            if drawn != self.previousDrawn:
+                pressures, flows, volumes = self.patient.loops.previousLoop()
+                self.pvPrevious.setData(pressures, volumes)
+                self.fvPrevious.setData(volumes, flows)
+                self.previousDrawn = drawn
+            self.pressDirty = False
+            self.flowDirty = False
+        if self.pressDirty:
+            self.pressureLine.setData(times, self.patient.pressData.view())  # Update the graph with the new data.
+            self.pressDirty = False
+        if self.flowDirty:
+            self.flowLine.setData(times, self.patient.flowData.view())  # Update the graph with the new data.
+            self.flowDirty = False
+        self.renderTime.record(time.perf_counter_ns() - start)
+
+    # Show or hide the diagnostics overlay
+    def toggleDiagnostics(self):
+        if self.diagnosticsOverlay.isVisible():
+            self.diagnosticsTimer.stop()
+            self.diagnosticsOverlay.hide()
+        else:
+            # Check the cables' versions and self-tests, in the bus time the samples leave free
+            for address in self.patients:
+                for name in diagnosticCommands:
+                    self.acquisition.request(address, name)
+            self.showDiagnostics()
+            self.diagnosticsOverlay.setGeometry(self.centralwidget.rect())
+            self.diagnosticsOverlay.show()
+            self.diagnosticsOverlay.raise_()
+            self.diagnosticsTimer.start()
+
+    # Update the diagnostics overlay (slot for the diagnostics timer)
+    @pyqtSlot()
+    def showDiagnostics(self):
+        self.acquisition.readDiagnostics()
+        lines = [diagnostics.report()]
+        for patient in self.patients.values():
+            if patient.status:
+                lines.append(patient.name + ": " + ", ".join(name + " " + VentComms.formatStatus(name, value)
+                                                             for name, (t, value) in sorted(patient.status.items())))
+        self.diagnosticsOverlay.setText("\n".join(lines))
+
+    # Save the diagnostics to diagnosticsFile (slot for the dump timer)
+    @pyqtSlot()
+    def dumpDiagnostics(self):
+        self.acquisition.readDiagnostics()
+        try:
+            diagnostics.dump(diagnosticsFile)
+        except OSError:
+            diagnostics.count('dumpErrors') # e.g. the disk is full; try again next time
+
+    # Show the diagnostics overlay when the logo is tapped three times within 2 seconds, and hide it when it is tapped
+    def eventFilter(self, obj, event):
+        if obj is self.diagnosticsOverlay and event.type() == QtCore.QEvent.MouseButtonPress:
+            self.toggleDiagnostics()
+            return True
+        if obj is self.gvsLogo and event.type() == QtCore.QEvent.MouseButtonPress:
+            now = time.monotonic()
+            self.logoTaps.append(now)
+            if len(self.logoTaps) == 3 and now - self.logoTaps[0] < 2:
+                self.logoTaps.clear()
+                self.toggleDiagnostics()
+            return True
+        return super().eventFilter(obj, event)
 
     # Change Ppeak value (slot for handling newPpeak signal)
     @pyqtSlot(float)
     def setPpeak(self, value):
         if self.pPeakAlarmSet:
             self.valPpeak.setText(floatToStr(value,1))
-            if value > self.pPeakMaxAlarm:
-                self.framePpeak.setStyleSheet(MainWindow.alarmStyle)
-                self.iconPPeakAlarm.setPixmap(QPixmap('images/alarmon.png'))
-            else:
-                self.framePpeak.setStyleSheet(MainWindow.normalStyle)
-                self.iconPPeakAlarm.setPixmap(QPixmap('images/alarmset.png'))
         else:
             self.valPpeak.setText("--")
 
-
     # Change Vte value (slot for handling newVte signal)
     @pyqtSlot(float)
     def setVte(self, value):
-        self.valVte.setText(floatToStr(value,0))
         if self.vteAlarmSet:
             self.valVte.setText(floatToStr(value,0))
-            if value < self.vteMinAlarm or value > self.vteMaxAlarm:
-                self.frameVte.setStyleSheet(MainWindow.alarmStyle)
-                self.iconVteAlarm.setPixmap(QPixmap('images/alarmon.png'))
-            else:
-                self.frameVte.setStyleSheet(MainWindow.normalStyle)
-                self.iconVteAlarm.setPixmap(QPixmap('images/alarmset.png'))
         else:
             self.valVte.setText("---")
 
     # Change PEEP value (slot for handling newPEEP signal)
     @pyqtSlot(float)
     def setPEEP(self, value):
-        self.valPeep.setText(floatToStr(value,1))
         if self.PEEPAlarmSet:
             self.valPeep.setText(floatToStr(value,1))
-            if value < self.PEEPMinAlarm or value > self.PEEPMaxAlarm:
-                self.framePEEP.setStyleSheet(MainWindow.alarmStyle)
-                self.iconPEEPAlarm.setPixmap(QPixmap('images/alarmon.png'))
-            else:
-                self.framePEEP.setStyleSheet(MainWindow.normalStyle)
-                self.iconPEEPAlarm.setPixmap(QPixmap('images/alarmset.png'))
         else:
             self.valPeep.setText("--")
 
-    # Quit out of the app by pressing ESC key
+    # The selected patient's Ppeak, Vte and PEEP alarms, each with the frame and icon that show it
+    def statAlarmWidgets(self):
+        return ((self.patient.pPeakAlarm, self.framePpeak, self.iconPPeakAlarm),
+                (self.patient.vteAlarm, self.frameVte, self.iconVteAlarm),
+                (self.patient.PEEPAlarm, self.framePEEP, self.iconPEEPAlarm))
+
+    # Check a patient's Ppeak, Vte and PEEP alarms after a breath, and show any changes
+    def checkBreathAlarms(self, patient):
+        changed = patient.checkAlarms(time.monotonic())
+        if not changed:
+            return
+        if patient is self.patient:
+            for alarm, frame, icon in self.statAlarmWidgets():
+                if alarm in changed:
+                    self.showAlarmState(alarm.state, frame, icon)
+        self.updateAlarmBanner()
+
+    # Restyle an alarm's frame and icon when its state changes; newState is None if it hasn't changed,
+    # so the style sheets (which are slow to apply) are only set on a change
+    def showAlarmState(self, newState, frame, icon):
+        if newState is None:
+            return
+        frame.setStyleSheet(MainWindow.alarmStyle if newState == ALARM_ON else MainWindow.normalStyle)
+        icon.setPixmap(self.alarmIcons[newState])
+
+    # Log a change in one of a patient's per-sample alarms, and show the ones that are on in the alarm banner
+    def showSampleAlarm(self, patient, event):
+        self.alarmEvents.append(event._replace(name=patient.name + ": " + event.name))
+        key = (patient.name, event.name)
+        if event.state == ALARM_ON:
+            self.sampleAlarmsOn[key] = event
+            if event.onset is not None:
+                self.alarmDetectTime.record(max(0, int((event.time - event.onset) * 1e9)))
+            self.alarmDisplayTime.record(max(0, int((time.monotonic() - event.time) * 1e9)))
+        else:
+            self.sampleAlarmsOn.pop(key, None)
+        self.updateAlarmBanner()
+
+    # Show the alarms that are on in the alarm banner, and an export or recording that has stopped, or hide it if
+    # there are none
+    def updateAlarmBanner(self):
+        alarms = [name + ": " + alarm for name, alarm in self.sampleAlarmsOn]
+        for patient in self.patients.values():
+            if patient is not self.patient:
+                alarms += [alarm.name for alarm in (patient.pPeakAlarm, patient.vteAlarm, patient.PEEPAlarm)
+                           if alarm.state == ALARM_ON]
+        errors = self.writeErrors()
+        self.writeErrorsShown = len(errors)
+        alarms += errors
+        if alarms:
+            self.alarmBanner.setText("   ".join(alarms))
+            self.alarmBanner.show()
+            self.alarmBanner.raise_()
+        else:
+            self.alarmBanner.hide()
+
+    # A message for the export and the recording if they have stopped because writing to the disk failed
+    def writeErrors(self):
+        return [name + " stopped: " + (writer.error.strerror or str(writer.error))
+                for name, writer in (("Export", self.exporter), ("Recording", self.recorder))
+                if writer is not None and writer.error is not None]
+
+    # Pass the alarm limits to every patient's alarm state machines (called when they are set on the alarm settings screen)
+    # The Ppeak limit is also the limit for the high pressure alarm on every sample
+    def alarmsChanged(self):
+        if self.pPeakAlarmSet:
+            self.acquisition.setPressureLimit(self.pPeakMaxAlarm)
+        for patient in self.patients.values():
+            if self.pPeakAlarmSet:
+                patient.pPeakAlarm.setLimits(None, self.pPeakMaxAlarm)
+            if self.vteAlarmSet:
+                patient.vteAlarm.setLimits(self.vteMinAlarm, self.vteMaxAlarm)
+            if self.PEEPAlarmSet:
+                patient.PEEPAlarm.setLimits(self.PEEPMinAlarm, self.PEEPMaxAlarm)
+            self.checkBreathAlarms(patient) # against the new limits straight away, rather than after the next breath
+
+    # Quit out of the app by pressing ESC key, and show the diagnostics by pressing D
     def keyPressEvent(self, e):
         if e.key() == QtCore.Qt.Key_Escape:
             self.close()
-
-    # Open the alarm settings screen
+        elif e.key() == QtCore.Qt.Key_D:
+            self.toggleDiagnostics()
+
+    # Stop sampling when the window is closed
+    def closeEvent(self, e):
+        self.timer.stop()
+        self.renderTimer.stop()
+        self.statsTimer.stop()
+        self.diagnosticsTimer.stop()
+        self.dumpTimer.stop()
+        self.trendTimer.stop()
+        self.acquisition.stop()
+        if diagnosticsFile:
+            self.dumpDiagnostics()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.exporter is not None:
+            self.exporter.close()
+        if self.telemetry is not None:
+            self.telemetry.stop()
+        super().closeEvent(e)
+
+    # Open the alarm settings screen: build it the first time, and just reset it to the current alarms after that
     def showAlarmSettings(self):
-        alarmSettings = AlarmSettings(self)
-        alarmSettings.setGeometry(0,0,800,480) # Ensure initial position is 0,0
-        alarmSettings.exec_()
+        if self.alarmSettings is None:
+            self.alarmSettings = AlarmSettings(self)
+        else:
+            # Calling this function twice because there seems to be a synchronisation issue (as in AlarmSettings.__init__)
+            self.alarmSettings.resetAlarms()
+            self.alarmSettings.resetAlarms()
+            self.alarmSettings.showFullScreen()
+        self.alarmSettings.setGeometry(0,0,800,480) # Ensure initial position is 0,0
+        self.alarmSettings.exec_()
 
 
 
@@ -447,11 +1518,11 @@ class AlarmSettings(QtWidgets.QDialog):
     # Design settings
     barStyle = "QProgressBar { background-color: black; border: 0px solid grey; border-radius: 0px; text-align: center; } QProgressBar::chunk {background-color: white; height: 1px;}"
     whiteButtonStyle = "QPushButton { background-color: white; border: 3px solid white; border-radius: 10px;}"
-    sliderMaxNotSetStyle = "QSlider::groove:vertical { background: transparent; width: 0px; margin: 0px -22px;} QSlider::handle:vertical {image: url(images/maxhollow.png); height: 30px;}"
-    sliderMaxSetStyle = "QSlider::groove:vertical { background: transparent; width: 0px; margin: 0px -22px;} QSlider::handle:vertical {image: url(images/maxfilled.png); height: 30px;}"
+    sliderMaxNotSetStyle = "QSlider::groove:vertical { background: transparent; width: 0px; margin: 0px -22px;} QSlider::handle:vertical {image: url(" + imageDir + "maxhollow.png); height: 30px;}"
+    sliderMaxSetStyle = "QSlider::groove:vertical { background: transparent; width: 0px; margin: 0px -22px;} QSlider::handle:vertical {image: url(" + imageDir + "maxfilled.png); height: 30px;}"
     # NOTE for testing of slider masks, changing background to a visible colour
-    sliderMinNotSetStyle = "QSlider::groove:vertical { background: transparent; width: 3px; margin: 0px -22px;} QSlider::handle:vertical {image: url(images/minhollow.png); height: 30px;}"
-    sliderMinSetStyle = "QSlider::groove:vertical { background: transparent; width: 3px; margin: 0px -22px;} QSlider::handle:vertical {image: url(images/minfilled.png); height: 30px;}"
+    sliderMinNotSetStyle = "QSlider::groove:vertical { background: transparent; width: 3px; margin: 0px -22px;} QSlider::handle:vertical {image: url(" + imageDir + "minhollow.png); height: 30px;}"
+    sliderMinSetStyle = "QSlider::groove:vertical { background: transparent; width: 3px; margin: 0px -22px;} QSlider::handle:vertical {image: url(" + imageDir + "minfilled.png); height: 30px;}"
 
     # Sliders are a key feature of this screen. Each slider consists of:
         # A QSlider with a custom wedge-shaped slider marker
@@ -469,7 +1540,7 @@ class AlarmSettings(QtWidgets.QDialog):
         self.mainWin = parent
 
         #Load the UI Page
-        uic.loadUi('alarmsettings.ui', self)
+        loadUi('alarmsettings', self)
         self.showFullScreen();
 
         # Flags for when alarm settings are changed
@@ -480,14 +1551,14 @@ class AlarmSettings(QtWidgets.QDialog):
         self.vteMaxChanged = False
 
         # Set up button icons: confirm and cancel with white backgrounds
-        self.btnConfirm.setIcon(QIcon('images/tick.png'))
+        self.btnConfirm.setIcon(QIcon(imageDir + 'tick.png'))
         self.btnConfirm.setIconSize(QtCore.QSize(100,50))
         self.btnConfirm.setStyleSheet(AlarmSettings.whiteButtonStyle)
         self.btnConfirm.setEnabled(True)
 
         # Set up button icons: logo, home screen and alarm screen
-        self.gvsLogo.setPixmap(QPixmap('images/galwayventshare.jpg'))
-        self.btnAlarmScreen.setIcon(QIcon('images/alarmscreen.png'))
+        self.gvsLogo.setPixmap(QPixmap(imageDir + 'galwayventshare.jpg'))
+        self.btnAlarmScreen.setIcon(QIcon(imageDir + 'alarmscreen.png'))
         self.btnAlarmScreen.setIconSize(QtCore.QSize(70,70))
 
         # Button signals and slots
@@ -497,6 +1568,7 @@ class AlarmSettings(QtWidgets.QDialog):
         self.btnConfirm.clicked.connect(self.updateAlarmsAndClose)
 
         # Configure the vertical bars and join sensor values to them
+        # (the main window keeps this dialog for reuse, so these stay connected for as long as it runs)
         # pPeak bar
         self.pPeakBar.setStyleSheet(AlarmSettings.barStyle)
         self.pPeakBar.setMinimum(0);
@@ -664,6 +1736,7 @@ class AlarmSettings(QtWidgets.QDialog):
             self.mainWin.vteMinAlarm = self.vteMinSlider.value()
             self.mainWin.vteMaxAlarm = self.vteMaxSlider.value()
             self.mainWin.vteAlarmSet = True
+        self.mainWin.alarmsChanged()
         # Close this window
         self.accept()
 
@@ -705,25 +1778,19 @@ class AlarmSettings(QtWidgets.QDialog):
         return round(pixPos)
 
 
-    def __del__(self):
-        # This is called when the dialog is closed
-        # Need to disconnect slots connected to signals before closing the dialog
-        self.mainWin.newPpeakInt.disconnect(self.pPeakBar.setValue)
-        self.mainWin.newPEEPInt.disconnect(self.PEEPBar.setValue)
-        self.mainWin.newVteInt.disconnect(self.vteBar.setValue)
-
 
 
 # ============== main() funcion =======================
 
 def main():
     if REALSENSORS:
-       # Check the status of port and open for communication
-       if(ser.isOpen()==True):
-            ser.close()
-       ser.open()
-       # specify the address of the RS485 adapter cable
-       start_flowsensor(ADDRESS)
+       # Open the port for communication
+       openSerial()
+       # specify the address of the RS485 adapter cable for each patient
+       for address in ADDRESSES:
+           start_flowsensor(address)
+       if ACQUISITION_PROCESS and not REPLAY_FILE:
+           ser.close() # the acquisition process opens it for itself
 
     # Launch the application window
     app = QtWidgets.QApplication(sys.argv)
@@ -732,9 +1799,10 @@ def main():
     window.show()
 
     # Run until the exit message
-    sys.exit(app.exec_())
-    if REALSENSORS:
+    ret = app.exec_()
+    if ser is not None:
         ser.close()
+    sys.exit(ret)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,160 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# Recording sessions of pressure and flow samples to a compact binary file, and playing them back.
+
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+
+from VentAnalytics import BreathRecord
+from VentDiagnostics import diagnostics
+
+
+# =========== Session file format =============
+
+# A session file is a 24-byte header followed by fixed-size 17-byte records, one per sample, in the order received.
+# Header: 8-byte magic string, then the wall-clock time (time.time()) and the sample clock time (time.monotonic())
+# when the file was created, as little-endian doubles, so that sample times can be converted to dates.
+# Record: sample time (double, seconds on the monotonic clock), sensor address (byte),
+# pressure (float, cm H2O) and flow (float, L/min), all little-endian with no padding.
+MAGIC = b'GVSREC1\0'
+HEADER = struct.Struct('<8sdd')
+RECORD = struct.Struct('<dBff')
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('address', 'u1'), ('pressure', '<f4'), ('flow', '<f4')])
+
+# The stats for one breath as a NumPy record, e.g. in an export or passed from the acquisition process:
+# the sensor address, then the fields of a BreathRecord
+BREATH_DTYPE = np.dtype([('address', 'u1')] + [(name, '<f8') for name in BreathRecord._fields])
+
+
+# =========== Recording =============
+
+# Appends samples to a session file, in batches of [batchSize] so the disk isn't written on every sample.
+# As in VentExport.SessionExporter, add() only packs the sample into a preallocated batch, and full batches are
+# written by a background thread, which gives them back once they are written, so the GUI never waits for the disk.
+# If the writer falls more than [batches] behind, the full batch is dropped and counted; if writing fails, the
+# error is kept in [error] and counted, and the rest of the samples are dropped.
+# Call close() (or flush()) to write out the last partial batch.
+class SessionRecorder:
+
+    def __init__(self, path, batchSize=256, batches=16):
+        self.path = path
+        self.batchSize = batchSize
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(HEADER.pack(MAGIC, time.time(), time.monotonic()))
+        self.spare = queue.SimpleQueue()
+        for i in range(batches - 1):
+            self.spare.put(bytearray(RECORD.size * batchSize))
+        self.batch = bytearray(RECORD.size * batchSize)
+        self.count = 0 # records in the current batch
+        self.dropped = 0 # records dropped because the writer couldn't keep up
+        self.error = None # the OSError that stopped the writer, if any
+        self.queue = queue.SimpleQueue() # (batch, records) for the writer, or None to stop
+        self.writeTime = diagnostics.histogram('recordWrite')
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Add one sample
+    def add(self, address, timestamp, pressure, flow):
+        RECORD.pack_into(self.batch, self.count * RECORD.size, timestamp, address, pressure, flow)
+        self.count += 1
+        if self.count == self.batchSize:
+            self.flush()
+
+    # Hand the samples added so far to the writer, and start filling a spare batch
+    def flush(self):
+        if self.count == 0:
+            return
+        try:
+            spare = self.spare.get_nowait()
+        except queue.Empty:
+            self.dropped += self.count
+            diagnostics.count('recordDropped', self.count)
+            self.count = 0
+            return
+        self.queue.put((self.batch, self.count))
+        self.batch = spare
+        self.count = 0
+
+    # Write everything that is left, and stop the writer
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    # The writer thread: write each batch, until told to stop or the disk fails
+    def run(self):
+        for batch, count in iter(self.queue.get, None):
+            if self.error is None:
+                start = time.perf_counter_ns()
+                try:
+                    self.file.write(memoryview(batch)[:count * RECORD.size])
+                    self.file.flush()
+                except OSError as e:
+                    self.error = e
+                    diagnostics.count('recordErrors')
+                self.writeTime.record(time.perf_counter_ns() - start)
+            else:
+                diagnostics.count('recordDropped', count)
+            self.spare.put(batch)
+        try:
+            self.file.close()
+        except OSError as e:
+            self.error = self.error or e
+
+
+# Make a new session file name in [directory], based on the current date and time
+def newSessionPath(directory):
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, time.strftime('session-%Y%m%d-%H%M%S.gvs'))
+
+
+# =========== Replay =============
+
+# Read-only access to a recorded session, memory-mapped so that even a long session opens instantly
+# and only the parts that are used are read from disk.
+# records is a NumPy structured array with fields time, address, pressure and flow.
+class ReplaySource:
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, self.wallStart, self.clockStart = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(path + " is not a session recording")
+        # Ignore a partial record at the end, left if the recording stopped mid-write
+        count = (os.path.getsize(path) - HEADER.size) // RECORD.size
+        if count > 0:
+            self.records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER.size, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    # The sensor addresses that appear in the recording, in ascending order
+    def addresses(self):
+        return [int(a) for a in np.unique(self.records['address'])]
+
+    # Typical time between one patient's samples, in ms (from the start of the recording), or None if not known
+    def period(self):
+        if len(self.records) == 0:
+            return None
+        first = self.records[:10000]
+        times = first['time'][first['address'] == first['address'][0]]
+        if len(times) < 2:
+            return None
+        return float(np.median(np.diff(times))) * 1000
+
+    # Arrays of (times, pressures, flows) for one patient, e.g. for BreathDetector.processBlock()
+    def patient(self, address):
+        r = self.records[self.records['address'] == address]
+        return r['time'].astype(np.float64), r['pressure'].astype(np.float64), r['flow'].astype(np.float64)
+
+    # Go through the recording in blocks of up to [size] records
+    def blocks(self, size=4096):
+        for start in range(0, len(self.records), size):
+            yield self.records[start:start+size]
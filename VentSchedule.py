@@ -0,0 +1,58 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# Timing for the sampling loop. Ticks are on a fixed grid of absolute deadlines, so the errors in each sleep
+# don't add up to drift, and every tick that starts late or doesn't happen at all is counted.
+
+import time
+from collections import namedtuple
+
+
+# One tick from DeadlineScheduler.wait(): the deadline it was due at, how late it started (s), and how many
+# deadlines before it were missed altogether
+Tick = namedtuple('Tick', ['deadline', 'late', 'missed'])
+
+
+# Ticks every [period] seconds at absolute deadlines: start, start + period, start + 2 * period, ...
+# If the work for a tick runs past the next deadline (an overrun), that tick starts straight away to catch up.
+# If it runs past more than one, there is no way to take the samples that were due then, so those deadlines are
+# skipped and counted as missed, and the next tick is the one due most recently: the grid is kept, and the caller
+# is told about the gap, rather than time being quietly lost.
+# [clock] and [sleep] can be replaced, e.g. to test it without waiting.
+class DeadlineScheduler:
+
+    def __init__(self, period, clock=time.monotonic, sleep=time.sleep):
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self.start = None
+        self.next = None    # deadline of the next tick
+        self.last = None    # deadline of the last one
+        self.ticks = 0      # ticks so far
+        self.overruns = 0   # ticks that were already due when wait() was called
+        self.missed = 0     # deadlines skipped altogether
+
+    # Wait for the next deadline, and return the Tick for it
+    def wait(self):
+        now = self.clock()
+        if self.next is None:
+            self.start = self.next = now
+        behind = now - self.next
+        missed = 0
+        if behind > 0:
+            self.overruns += 1
+            missed = int(behind // self.period)
+            self.next += missed * self.period
+            self.missed += missed
+        else:
+            self.sleep(-behind)
+            now = self.clock()
+        deadline = self.last = self.next
+        self.next += self.period
+        self.ticks += 1
+        return Tick(deadline, max(0.0, now - deadline), missed)
+
+    # Ticks per second between the first tick and the last, counting only those that happened
+    def rate(self):
+        if self.ticks < 2:
+            return 0.0
+        return (self.ticks - 1) / (self.last - self.start)
@@ -0,0 +1,193 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# Ring buffers in shared memory, for passing samples, breaths, alarms and status readings from the acquisition process
+# to the GUI process, and status commands back, without pickling or copying them through a pipe.
+
+from multiprocessing import shared_memory
+import numpy as np
+
+from VentAnalytics import AlarmEvent, SAMPLE_ALARMS, ALARM_STATES
+from VentComms import COMMANDS
+
+
+# Samples and breaths are stored in a SharedRing as VentRecorder.RECORD_DTYPE and BREATH_DTYPE records
+
+# Alarm events as stored in a SharedRing: the sensor address, the alarm and its new state (as indexes into
+# VentAnalytics.SAMPLE_ALARMS and ALARM_STATES), then the event's time, value and onset (NaN if None)
+ALARM_DTYPE = np.dtype([('address', 'u1'), ('alarm', 'u1'), ('state', 'u1'),
+                        ('time', '<f8'), ('value', '<f8'), ('onset', '<f8')])
+
+# The ALARM_DTYPE record for an AlarmEvent from the patient with sensor [address]
+def alarmRecord(address, event):
+    return (address, SAMPLE_ALARMS.index(event.name), ALARM_STATES.index(event.state), event.time, event.value,
+            event.onset if event.onset is not None else np.nan)
+
+# (address, AlarmEvent) from an ALARM_DTYPE record (as a tuple)
+def alarmFromRecord(record):
+    address, alarm, state, t, value, onset = record
+    return address, AlarmEvent(t, SAMPLE_ALARMS[alarm], ALARM_STATES[state], value, None if onset != onset else onset)
+
+# Command names, in the order of their indexes in the records below
+COMMAND_NAMES = list(COMMANDS)
+
+# Status readings as stored in a SharedRing: the sensor address, the command (as an index into COMMAND_NAMES),
+# then the time of the reading and its value from VentComms.decodeStatus()
+STATUS_DTYPE = np.dtype([('address', 'u1'), ('command', 'u1'), ('time', '<f8'), ('value', '<f8')])
+
+# Commands to send, as stored in a SharedRing: the sensor address, the command, and up to 4 bytes of payload
+COMMAND_DTYPE = np.dtype([('address', 'u1'), ('command', 'u1'), ('length', 'u1'), ('payload', 'u1', (4,))])
+
+# The COMMAND_DTYPE record for command [name] to sensor [address]
+def commandRecord(address, name, payload=b''):
+    payload = bytes(payload)
+    return (address, COMMAND_NAMES.index(name), len(payload), tuple(payload.ljust(4, b'\0')))
+
+# (address, name, payload) from a COMMAND_DTYPE record (as a tuple)
+def commandFromRecord(record):
+    address, command, length, payload = record
+    return address, COMMAND_NAMES[command], bytes(payload[:length])
+
+
+# Ring buffer of NumPy records in a shared memory block, for one writer process and one reader process.
+# The block starts with four counters, [records written, records read, capacity, records started], then the records.
+# The writer only ever changes the started count, then a record, then the written count, and the reader only the
+# read count, so no lock is needed. len() is how many records are waiting to be read; if the reader falls more than
+# [capacity] records behind, the oldest are overwritten, and counted in [dropped] when it next reads.
+# As with SharedMessage, the reader checks the started count after copying the records, so that any the writer
+# came round to while they were being copied are dropped rather than returned part old and part new.
+# Make it with a dtype and capacity in one process, and attach() to it by name in a process started from that one
+# by multiprocessing, so that both share a resource tracker and the ring is only removed once.
+class SharedRing:
+
+    HEADER = 64 # bytes, to keep the records aligned
+
+    def __init__(self, dtype, capacity, name=None):
+        self.dtype = np.dtype(dtype)
+        size = self.HEADER + capacity * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.owner = True
+        self.setup(capacity)
+        self.counters[:] = (0, 0, capacity, 0)
+
+    # Attach to a ring made by another process
+    @classmethod
+    def attach(cls, name, dtype):
+        ring = cls.__new__(cls)
+        ring.dtype = np.dtype(dtype)
+        ring.shm = shared_memory.SharedMemory(name=name)
+        ring.owner = False
+        ring.setup(None)
+        return ring
+
+    # Map the counters and records onto the shared memory; the capacity is read from it if not given
+    def setup(self, capacity):
+        self.counters = np.ndarray((4,), np.uint64, buffer=self.shm.buf)
+        self.capacity = capacity if capacity is not None else int(self.counters[2])
+        self.records = np.ndarray((self.capacity,), self.dtype, buffer=self.shm.buf, offset=self.HEADER)
+        self.maxlen = self.capacity
+        self.dropped = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # Records waiting to be read
+    def __len__(self):
+        return int(self.counters[0] - self.counters[1])
+
+    # Add one record, given as a tuple of its fields (writer only)
+    def append(self, record):
+        written = int(self.counters[0])
+        self.counters[3] = written + 1
+        self.records[written % self.capacity] = record
+        self.counters[0] = written + 1
+
+    # Take every record written since the last read (reader only). Returns a list of arrays (one, or none if
+    # nothing was written), oldest first, copied out of the shared memory.
+    def read(self):
+        written = int(self.counters[0])
+        last = int(self.counters[1])
+        start = max(last, written - self.capacity)
+        self.counters[1] = written
+        if written == start:
+            return []
+        block = self.records.take(np.arange(start, written), mode='wrap')
+        # Record n is overwritten by record n + capacity, so drop any that the writer started on while copying
+        safe = min(written, max(start, int(self.counters[3]) - self.capacity))
+        self.dropped += safe - last
+        block = block[safe - start:]
+        return [block] if len(block) else []
+
+    # Detach from the ring, and remove it if this process made it
+    def close(self):
+        # The arrays must go before the block can be closed
+        self.counters = None
+        self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# A block of shared memory holding one message of up to [size] bytes, which one process replaces from time to time
+# and another reads the latest of, e.g. the acquisition process's diagnostics.
+# The block starts with two counters, [sequence number, message length], then the message. The writer makes the
+# sequence number odd while it is changing the message, so the reader can tell if it read part of an old message
+# and part of a new one, and leaves it until the next read.
+# Make and attach to it in the same way as a SharedRing.
+class SharedMessage:
+
+    HEADER = 16 # bytes
+
+    def __init__(self, size, name=None):
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=self.HEADER + size)
+        self.owner = True
+        self.setup()
+        self.counters[:] = (0, 0)
+
+    # Attach to a message block made by another process
+    @classmethod
+    def attach(cls, name):
+        block = cls.__new__(cls)
+        block.shm = shared_memory.SharedMemory(name=name)
+        block.owner = False
+        block.setup()
+        return block
+
+    def setup(self):
+        self.counters = np.ndarray((2,), np.uint64, buffer=self.shm.buf)
+        self.capacity = self.shm.size - self.HEADER
+        self.lastRead = 0 # sequence number of the last message read
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # Replace the message with [data] (writer only); returns False if it is too big to fit
+    def write(self, data):
+        if len(data) > self.capacity:
+            return False
+        sequence = int(self.counters[0])
+        self.counters[0] = sequence + 1
+        self.shm.buf[self.HEADER:self.HEADER + len(data)] = data
+        self.counters[1] = len(data)
+        self.counters[0] = sequence + 2
+        return True
+
+    # The message, if it has been replaced since the last read and isn't being written now; otherwise None
+    def read(self):
+        sequence = int(self.counters[0])
+        if sequence == self.lastRead or sequence % 2:
+            return None
+        length = int(self.counters[1])
+        data = bytes(self.shm.buf[self.HEADER:self.HEADER + length])
+        if int(self.counters[0]) != sequence:
+            return None # it changed while it was being read
+        self.lastRead = sequence
+        return data
+
+    # Detach from the block, and remove it if this process made it
+    def close(self):
+        self.counters = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
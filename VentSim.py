@@ -0,0 +1,110 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# Simulated patients on a pressure-controlled ventilator, for running and load-testing without sensors.
+# Samples for all of the patients are generated together in blocks with NumPy, much faster than real time.
+
+import numpy as np
+
+
+# =========== Lung model =============
+
+# Default settings for each simulated patient. Any of these can be given to LungSimulator
+# as a single value for every patient, or as a sequence with one value per patient.
+DEFAULTS = {
+    'compliance': 30.0,   # lung compliance, mL/cm H2O
+    'resistance': 10.0,   # airway resistance, cm H2O/(L/s)
+    'pip': 20.0,          # inspiratory pressure set on the ventilator, cm H2O
+    'peep': 5.0,          # PEEP set on the ventilator, cm H2O
+    'rate': 15.0,         # breaths per minute
+    'ie': 0.5,            # I:E ratio, as inspiratory time / expiratory time (0.5 is 1:2)
+    'leak': 0.0,          # leak between the sensor and the patient, L/min per cm H2O of airway pressure
+    'pressureNoise': 0.2, # standard deviation of the pressure sensor noise, cm H2O
+    'flowNoise': 0.5,     # standard deviation of the flow sensor noise, L/min
+}
+
+# Settings that are varied from patient to patient when a LungSimulator is made with variation > 0
+VARIED = ('compliance', 'resistance', 'rate')
+
+
+# A group of simulated patients, each a single-compartment lung (one resistance and one compliance)
+# ventilated with a square wave of pressure: pip during inspiration and peep during expiration.
+# The lung fills and empties exponentially, with time constant resistance x compliance, and the
+# volume and flow at every sample come from the closed-form steady-state solution, so a block
+# of any length is a few array operations with no loop over samples.
+# The sensors see the airway pressure and the flow into the patient plus any leak, with noise added.
+# A disconnected patient reads as zero pressure and flow (plus noise) until they are reconnected.
+# Changing a setting takes effect immediately, as if the patient were already breathing steadily with it.
+class LungSimulator:
+
+    # [count] patients, sampled every [period] ms, starting at time [start] (s).
+    # Each patient's compliance, resistance and rate is scaled by a random factor of up to +/- [variation],
+    # and their breaths start at a random point in the cycle, so that they aren't all in step.
+    def __init__(self, count, period, start=0.0, variation=0.0, seed=None, **settings):
+        unknown = set(settings) - set(DEFAULTS)
+        if unknown:
+            raise ValueError("Unknown simulator settings: " + ", ".join(sorted(unknown)))
+        self.count = count
+        self.period = period/1000 # in seconds
+        self.time = start # time of the next sample
+        self.rng = np.random.default_rng(seed)
+        self.settings = {}
+        for name, default in DEFAULTS.items():
+            self.set(name, settings.get(name, default))
+        if variation > 0:
+            for name in VARIED:
+                self.settings[name] *= self.rng.uniform(1 - variation, 1 + variation, count)
+        self.offset = self.rng.uniform(0, 60, count) # start of each patient's breathing, s
+        self.disconnectedUntil = np.full(count, -np.inf) # time each patient is reconnected
+
+    # Change a setting, for every patient (a single value) or each one (a sequence of [count] values)
+    def set(self, name, value):
+        if name not in DEFAULTS:
+            raise ValueError("Unknown simulator setting: " + name)
+        self.settings[name] = np.broadcast_to(np.asarray(value, dtype=np.float64), (self.count,)).copy()
+
+    # Disconnect patient [i] (0 to count-1) for [duration] seconds from now, in simulated time
+    def disconnect(self, i, duration):
+        self.disconnectedUntil[i] = self.time + duration
+
+    # Generate the next [n] samples for every patient.
+    # Returns (times, pressures, flows): times has shape (n,), in seconds; pressures (cm H2O)
+    # and flows (L/min) have shape (count, n), with one row per patient.
+    def block(self, n):
+        times = self.time + np.arange(n) * self.period
+        self.time += n * self.period
+        pressure, flow = self.sample(times)
+        return times, pressure, flow
+
+    # Pressure and flow for every patient at any [times] (an array, in seconds), e.g. to answer sensor requests
+    # as they arrive. Returns (pressures, flows), each with shape (count, len(times)).
+    def sample(self, times):
+        times = np.asarray(times, dtype=np.float64)
+        s = {name: value[:, None] for name, value in self.settings.items()} # one row per patient
+
+        # Where each sample falls in its patient's breath cycle
+        cycle = 60 / s['rate']
+        inspTime = cycle * s['ie'] / (1 + s['ie'])
+        expTime = cycle - inspTime
+        pos = (times + self.offset[:, None]) % cycle
+        insp = pos < inspTime
+
+        # Volume above the end-expiratory volume (mL), in the steady state
+        tau = s['resistance'] * s['compliance'] / 1000 # time constant, s
+        full = s['compliance'] * (s['pip'] - s['peep']) # volume if inspiration went on for ever
+        a = np.exp(-inspTime / tau)
+        b = np.exp(-expTime / tau)
+        inspStartVolume = b * full * (1 - a) / (1 - a * b) # volume left at the end of expiration
+        expStartVolume = full + (inspStartVolume - full) * a # volume at the end of inspiration
+        volume = np.where(insp, full + (inspStartVolume - full) * np.exp(-pos / tau),
+                          expStartVolume * np.exp(-(pos - inspTime) / tau))
+
+        # What the sensors see
+        pressure = np.where(insp, s['pip'], s['peep'])
+        lungFlow = np.where(insp, full - volume, -volume) / tau # mL/s
+        flow = lungFlow * (60/1000) + s['leak'] * pressure # L/min
+        disconnected = times < self.disconnectedUntil[:, None]
+        pressure = np.where(disconnected, 0.0, pressure)
+        flow = np.where(disconnected, 0.0, flow)
+        pressure = pressure + self.rng.standard_normal(pressure.shape) * s['pressureNoise']
+        flow = flow + self.rng.standard_normal(flow.shape) * s['flowNoise']
+        return pressure, flow
@@ -0,0 +1,233 @@
+# Developed for the Galway Vent Share project: www.galwayventshare.com
+
+# Streaming live samples and breath stats over TCP, e.g. to a central nurse-station display.
+# The server runs an asyncio event loop in its own thread, so the GUI and acquisition never wait for the network.
+#
+# To watch a running unit from the command line (a simple test client):
+#     python3 VentTelemetry.py --connect 127.0.0.1:5020
+
+import argparse
+import asyncio
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+from VentRecorder import RECORD
+
+
+# =========== Message format =============
+
+# Every message is a 5-byte header, [message type (byte), payload length (uint32)], then the payload.
+# All values are little-endian with no padding.
+# HELLO, sent once when a client connects: magic string, wall-clock time (time.time()) and sample clock time
+# (time.monotonic()) when it was sent, as doubles, then the unit's name in UTF-8, so that sample times can be
+# converted to dates and the station knows which unit it is.
+# SAMPLES: any number of sample records in the same format as a session recording (VentRecorder.RECORD):
+# time (double), sensor address (byte), pressure (float, cm H2O) and flow (float, L/min).
+# BREATH: the stats for one complete breath (see VentAnalytics.BreathRecord).
+MAGIC = b'GVSTEL1\0'
+FRAME_HEADER = struct.Struct('<BI')
+HELLO = struct.Struct('<8sdd')
+BREATH = struct.Struct('<Bdddffffff') # address, start, expStart, end, ppeak, peep, vti, vte, rr, ie
+MSG_HELLO = 1
+MSG_SAMPLES = 2
+MSG_BREATH = 3
+
+
+# Make one message
+def encodeMessage(msgType, payload):
+    return FRAME_HEADER.pack(msgType, len(payload)) + payload
+
+# Make a BREATH message for a BreathRecord from the patient with sensor [address]
+def encodeBreath(address, breath):
+    return encodeMessage(MSG_BREATH, BREATH.pack(address, breath.start, breath.expStart, breath.end,
+                                                 breath.ppeak, breath.peep, breath.vti, breath.vte, breath.rr, breath.ie))
+
+
+# =========== Server =============
+
+# One connected client: the messages waiting to be sent to it, at most [maxQueued] of them.
+# If the client can't keep up, the oldest waiting messages are dropped (and counted),
+# so a slow client only loses data itself and never holds anything else up.
+class TelemetryClient:
+
+    def __init__(self, writer, maxQueued):
+        self.writer = writer
+        self.queue = deque(maxlen=maxQueued)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.task = None # the task sending to this client
+
+    def put(self, message):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(message)
+        self.ready.set()
+
+
+# Serves live data to any number of clients on [port]. Samples added with addSample() are batched,
+# and sent as one SAMPLES message when flush() is called (e.g. once per GUI tick).
+# It only listens on [host], by default this unit alone. The stream has no authentication or encryption, so only
+# listen on every network interface ('0.0.0.0') on a network that only trusted stations can join.
+# Every method apart from start() and stop() can be called often: none of them wait for the network.
+class TelemetryServer:
+
+    def __init__(self, port, host='127.0.0.1', name=None, maxQueued=256, batchSize=256):
+        self.port = port
+        self.host = host
+        self.name = name if name is not None else socket.gethostname()
+        self.maxQueued = maxQueued
+        self.batchSize = batchSize
+        self.batch = bytearray(RECORD.size * batchSize)
+        self.count = 0 # samples in the current batch
+        self.clients = set()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.listening = threading.Event()
+
+    # Start serving in a background thread, and wait until it is listening
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.listening.wait(5)
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        self.stopping = asyncio.Event()
+        self.server = await asyncio.start_server(self.serveClient, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1] # the real port, if it was 0 (any free port)
+        self.listening.set()
+        await self.stopping.wait()
+
+        # Disconnect every client, and let their tasks finish
+        self.server.close()
+        tasks = []
+        for client in list(self.clients):
+            client.writer.transport.abort()
+            client.ready.set()
+            tasks.append(client.task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    # Stop serving, and disconnect every client
+    def stop(self):
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            self.thread.join(2)
+
+    # Send messages to one client, as fast as it takes them
+    async def serveClient(self, reader, writer):
+        client = TelemetryClient(writer, self.maxQueued)
+        client.task = asyncio.current_task()
+        hello = HELLO.pack(MAGIC, time.time(), time.monotonic()) + self.name.encode('utf-8')
+        client.put(encodeMessage(MSG_HELLO, hello))
+        self.clients.add(client)
+        try:
+            while not self.stopping.is_set():
+                await client.ready.wait()
+                client.ready.clear()
+                messages = list(client.queue)
+                client.queue.clear()
+                writer.write(b''.join(messages))
+                await writer.drain() # waits here, not in the GUI, if the client is slow
+        except (ConnectionError, OSError):
+            pass # the client went away
+        finally:
+            self.clients.discard(client)
+            writer.close()
+
+    # Queue a message for every client (called in the server's thread)
+    def broadcast(self, message):
+        for client in self.clients:
+            client.put(message)
+
+    # Queue a message for every client, from any thread
+    def send(self, message):
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.broadcast, message)
+
+    # Add one sample to the next SAMPLES message
+    def addSample(self, address, timestamp, pressure, flow):
+        RECORD.pack_into(self.batch, self.count * RECORD.size, timestamp, address, pressure, flow)
+        self.count += 1
+        if self.count == self.batchSize:
+            self.flush()
+
+    # Send the stats for a complete breath
+    def addBreath(self, address, breath):
+        self.send(encodeBreath(address, breath))
+
+    # Send the samples added so far
+    def flush(self):
+        if self.count > 0:
+            self.send(encodeMessage(MSG_SAMPLES, bytes(self.batch[:self.count * RECORD.size])))
+            self.count = 0
+
+    # How many messages have been dropped for the clients connected now, because they were too slow
+    def dropped(self):
+        return sum(client.dropped for client in self.clients)
+
+
+# =========== Client =============
+
+# Read messages from a connected socket until it closes, yielding (message type, payload) for each one
+def readMessages(sock):
+    buffer = bytearray()
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        buffer += data
+        start = 0
+        while len(buffer) - start >= FRAME_HEADER.size:
+            msgType, length = FRAME_HEADER.unpack_from(buffer, start)
+            end = start + FRAME_HEADER.size + length
+            if end > len(buffer):
+                break
+            yield msgType, memoryview(buffer)[start + FRAME_HEADER.size:end].tobytes()
+            start = end
+        del buffer[:start]
+
+# Decode a SAMPLES payload into a list of (time, address, pressure, flow)
+def decodeSamples(payload):
+    return list(RECORD.iter_unpack(payload))
+
+# Decode a BREATH payload into (address, start, expStart, end, ppeak, peep, vti, vte, rr, ie)
+def decodeBreath(payload):
+    return BREATH.unpack(payload)
+
+
+# Connect to a unit and print what it sends: a summary of the samples each second, and every breath
+def main():
+    parser = argparse.ArgumentParser(description="Print the live data from a VentGUI telemetry server")
+    parser.add_argument('--connect', default='127.0.0.1:5020', help="host:port of the unit")
+    args = parser.parse_args()
+    host, port = args.connect.rsplit(':', 1)
+    with socket.create_connection((host, int(port))) as sock:
+        samples = 0
+        lastReport = time.monotonic()
+        for msgType, payload in readMessages(sock):
+            if msgType == MSG_HELLO:
+                magic, wallTime, clockTime = HELLO.unpack_from(payload)
+                print("Connected to", payload[HELLO.size:].decode('utf-8'))
+            elif msgType == MSG_SAMPLES:
+                samples += len(payload) // RECORD.size
+            elif msgType == MSG_BREATH:
+                address, start, expStart, end, ppeak, peep, vti, vte, rr, ie = decodeBreath(payload)
+                print("Patient %d: Ppeak %.1f PEEP %.1f Vte %.0f RR %.1f" % (address, ppeak, peep, vte, rr))
+            if time.monotonic() - lastReport >= 1:
+                print(samples, "samples")
+                samples = 0
+                lastReport = time.monotonic()
+
+if __name__ == '__main__':
+    main()
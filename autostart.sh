@@ -10,6 +10,9 @@ echo "Note: ventilator application must be in /home/pi/VentGUI/VentGUI.py"
 echo "To disable the auto-start, press Ctrl-Alt-F1 on a connected keyboard, "
 echo "run noautostart.sh, and it will change the configuration and reboot."
 
+# Precompile the screens and images so that the app starts faster
+/home/pi/VentGUI/compileui.sh
+
 cp /home/pi/VentGUI/xsession.txt /home/pi/.xsession
 cp /home/pi/VentGUI/xsessionrc.txt /home/pi/.xsessionrc
 
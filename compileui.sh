@@ -0,0 +1,10 @@
+## This precompiles the screens designed in Qt Designer (*.ui) and the images (resources.qrc) into Python modules,
+## so that the ventilator app starts up faster.
+## Run it again after changing any of the .ui files or images. Until then, VentGUI.py notices that
+## the compiled versions are out of date and loads the .ui files and images directly, as before.
+## Needs the PyQt5 tools; on the Raspberry Pi: sudo apt install pyqt5-dev-tools
+
+cd "$(dirname "$0")"
+python3 -m PyQt5.uic.pyuic -o ui_mainwindow.py mainwindow.ui
+python3 -m PyQt5.uic.pyuic -o ui_alarmsettings.py alarmsettings.ui
+python3 -m PyQt5.pyrcc_main -o resources_rc.py resources.qrc
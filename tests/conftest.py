@@ -0,0 +1,5 @@
+# Let the tests import the Vent modules from the directory above, however pytest is run
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
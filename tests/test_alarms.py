@@ -0,0 +1,120 @@
+# Tests for the alarms in VentAnalytics.py: AlarmMonitor's debounce and hysteresis, and how soon SampleAlarms
+# goes on after each condition is met, fed with synthetic samples.
+# Run them from the top directory with: python3 -m pytest
+
+import ctypes
+import math
+
+import pytest
+
+from VentAnalytics import AlarmMonitor, SampleAlarms, ALARM_NOT_SET, ALARM_NORMAL, ALARM_ON
+from VentAnalytics import PRESSURE_HIGH, DISCONNECT, APNEA, SENSOR_SILENT
+from VentSim import LungSimulator
+
+PERIOD = 0.05 # seconds between samples, as at VentGUI.py's default 20 Hz
+
+
+# Feed SampleAlarms the samples (pressure, flow) from time [start], one every PERIOD, checking each one as it
+# arrives; returns the time after the last sample and every AlarmEvent
+def feed(alarms, samples, start=0.0):
+    events = []
+    t = start
+    for pressure, flow in samples:
+        events += alarms.update(t, pressure, flow, t)
+        t += PERIOD
+    return t, events
+
+# Breathing samples from a simulated patient, starting at time [start]
+def breathing(seconds, start=0.0):
+    sim = LungSimulator(1, PERIOD * 1000, start=start, seed=1)
+    times, pressures, flows = sim.block(round(seconds / PERIOD))
+    return list(zip(pressures[0].tolist(), flows[0].tolist()))
+
+def testMonitorDebounceAndHysteresis():
+    events = []
+    alarm = AlarmMonitor('Ppeak', hysteresis=1, debounce=3, events=events)
+    assert alarm.update(25, 0) is None # no limits yet
+    alarm.setLimits(None, 20)
+    assert alarm.update(15, 1) == ALARM_NORMAL
+    assert events == [] # being armed isn't logged
+    # Two updates above the limit, then one inside it: not enough in a row to go on
+    assert [alarm.update(v, 2 + i) for i, v in enumerate([25, 25, 15])] == [None, None, None]
+    assert alarm.state == ALARM_NORMAL
+    # On after three in a row
+    assert [alarm.update(25, 5 + i, onset=5) for i in range(3)] == [None, None, ALARM_ON]
+    assert events[-1].state == ALARM_ON and events[-1].time == 7 and events[-1].onset == 5
+    # Inside the limit but not by the hysteresis margin: stays on
+    for i in range(5):
+        assert alarm.update(19.5, 10 + i) is None
+    # Back inside by the margin for three updates in a row: off
+    assert [alarm.update(18.5, 20 + i) for i in range(3)] == [None, None, ALARM_NORMAL]
+    assert [(e.state, e.time) for e in events] == [(ALARM_ON, 7), (ALARM_NORMAL, 22)]
+    # Clearing the limits takes effect straight away
+    alarm.setLimits(None, None)
+    assert alarm.update(25, 30) == ALARM_NOT_SET
+
+# High pressure goes on (debounce - 1) samples after the first sample above the limit, and off once it is
+# back below the limit by the hysteresis for [debounce] samples
+@pytest.mark.parametrize('debounce', [1, 3])
+def testPressureHigh(debounce):
+    alarms = SampleAlarms(ctypes.c_double(20), debounce=debounce, hysteresis=1)
+    t, events = feed(alarms, [(15, 0)] * 10)
+    assert events == [] # armed, but not logged
+    onset = t
+    t, events = feed(alarms, [(25, 0)] * 10, t)
+    assert [(e.name, e.state) for e in events] == [(PRESSURE_HIGH, ALARM_ON)]
+    assert events[0].onset == pytest.approx(onset)
+    assert events[0].time - events[0].onset == pytest.approx((debounce - 1) * PERIOD)
+    t, events = feed(alarms, [(19.5, 0)] * 10, t)
+    assert events == [] # not below the limit by the hysteresis
+    cleared = t
+    t, events = feed(alarms, [(18.5, 0)] * 10, t)
+    assert [(e.name, e.state) for e in events] == [(PRESSURE_HIGH, ALARM_NORMAL)]
+    assert events[0].time == pytest.approx(cleared + (debounce - 1) * PERIOD)
+
+# With no limit (NaN), high pressure never alarms
+def testPressureHighNoLimit():
+    alarms = SampleAlarms(ctypes.c_double(math.nan))
+    t, events = feed(alarms, [(80, 0)] * 10)
+    assert events == []
+
+# A disconnect goes on within one sample of the pressure having been low for disconnectTime, and off on the
+# first sample back above disconnectPressure
+def testDisconnect():
+    alarms = SampleAlarms(ctypes.c_double(math.nan), disconnectPressure=2, disconnectTime=1.0)
+    t, events = feed(alarms, [(5, 0)] * 10)
+    assert events == []
+    t, events = feed(alarms, [(0.5, 0)] * 40, t)
+    assert [(e.name, e.state) for e in events] == [(DISCONNECT, ALARM_ON)]
+    assert 0 <= events[0].time - events[0].onset <= PERIOD
+    t, events = feed(alarms, [(5, 0)], t)
+    assert [(e.name, e.state) for e in events] == [(DISCONNECT, ALARM_NORMAL)]
+
+# Apnea goes on within one sample of apneaTime without a breath, and off at the next breath
+def testApnea():
+    alarms = SampleAlarms(ctypes.c_double(math.nan), apneaTime=10)
+    t, events = feed(alarms, breathing(20))
+    assert events == []
+    lastBreath = alarms.lastBreath
+    t, events = feed(alarms, [(5, 0)] * round(15 / PERIOD), t)
+    assert [(e.name, e.state) for e in events] == [(APNEA, ALARM_ON)]
+    assert events[0].onset == pytest.approx(lastBreath + 10)
+    assert 0 <= events[0].time - events[0].onset <= PERIOD
+    t, events = feed(alarms, breathing(20, t), t)
+    assert [(e.name, e.state) for e in events] == [(APNEA, ALARM_NORMAL)]
+
+# Sensor silence goes on at the first check() after silenceTime without a sample, and off at the next sample
+def testSensorSilence():
+    alarms = SampleAlarms(ctypes.c_double(math.nan), silenceTime=1.0)
+    t, events = feed(alarms, [(5, 0)] * 10)
+    lastSample = t - PERIOD
+    events = []
+    now = t
+    while not events:
+        events = alarms.check(now)
+        now += PERIOD
+    assert [(e.name, e.state) for e in events] == [(SENSOR_SILENT, ALARM_ON)]
+    assert 0 < events[0].time - events[0].onset <= PERIOD
+    assert events[0].onset == pytest.approx(lastSample + 1.0)
+    t, events = feed(alarms, [(5, 0)], now)
+    assert [(e.name, e.state) for e in events] == [(SENSOR_SILENT, ALARM_NORMAL)]
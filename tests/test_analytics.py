@@ -0,0 +1,62 @@
+# Tests for VentAnalytics.py, checked against simulated patients (VentSim.py) whose true breathing is known.
+# Run them from the top directory with: python3 -m pytest
+
+import numpy as np
+import pytest
+
+from VentAnalytics import BreathDetector, SignalFilter
+from VentSim import LungSimulator
+
+
+# Two minutes of samples from three simulated patients, each breathing at their own rate
+def simulate(rate, ie, hz, seed=2):
+    sim = LungSimulator(3, 1000/hz, seed=seed, variation=0.2, rate=rate, ie=ie)
+    times, pressures, flows = sim.block(hz * 120)
+    return sim, times, pressures, flows
+
+# Each breath's RR and I:E should be the simulated patient's, to within the timing of one sample,
+# with no breaths split in two by the noise around zero flow
+@pytest.mark.parametrize('rate, ie', [(15, 0.5), (20, 1.0), (10, 0.33)])
+@pytest.mark.parametrize('hz', [20, 200])
+def testBreathTiming(rate, ie, hz):
+    sim, times, pressures, flows = simulate(rate, ie, hz)
+    for row in range(3):
+        trueRate = sim.settings['rate'][row]
+        records = BreathDetector().processBlock(times, pressures[row], flows[row])
+        # Every whole breath in the two minutes, apart from the first (which may have started before the samples)
+        assert len(records) >= int(trueRate * 2) - 2
+        cycle = 60 / trueRate
+        for record in records:
+            assert abs(record.end - record.start - cycle) <= 1.5 / hz
+            assert record.rr == pytest.approx(trueRate, rel=0.02)
+            inspTime = cycle * ie / (1 + ie)
+            assert abs(record.expStart - record.start - inspTime) <= 1.5 / hz
+            assert record.ie == pytest.approx(ie, rel=0.05)
+
+# The same, after the filters that VentGUI.py puts pressure and flow through by default (filterMedian = 3 and
+# filterCutoffHz = 5), which leave slower swings around zero flow than the raw noise
+@pytest.mark.parametrize('rate, ie', [(15, 0.5), (20, 1.0)])
+@pytest.mark.parametrize('hz', [20, 200])
+def testFilteredBreathTiming(rate, ie, hz):
+    sim, times, pressures, flows = simulate(rate, ie, hz)
+    for row in range(3):
+        trueRate = sim.settings['rate'][row]
+        pressure = SignalFilter(1/hz, 3, 5).processBlock(pressures[row]).copy()
+        flow = SignalFilter(1/hz, 3, 5).processBlock(flows[row]).copy()
+        records = BreathDetector().processBlock(times, pressure, flow)
+        assert len(records) >= int(trueRate * 2) - 2
+        for record in records:
+            assert record.rr == pytest.approx(trueRate, rel=0.02)
+            assert record.ie == pytest.approx(ie, rel=0.05)
+
+# push() one sample at a time gives the same breaths as processBlock(), however the samples are split into blocks
+def testPushMatchesBlocks():
+    sim, times, pressures, flows = simulate(15, 0.5, 50)
+    pushed = BreathDetector()
+    expected = [r for i in range(len(times)) for r in [pushed.push(times[i], pressures[0, i], flows[0, i])] if r]
+    detector = BreathDetector()
+    records = []
+    for i in range(0, len(times), 37):
+        records += detector.processBlock(times[i:i+37], pressures[0, i:i+37], flows[0, i:i+37])
+    assert len(records) == len(expected)
+    np.testing.assert_allclose(np.array(records), np.array(expected))
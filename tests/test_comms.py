@@ -0,0 +1,119 @@
+# Tests for VentComms.py: checksums, finding and decoding reply frames, and transactions on the shared bus.
+# Run them from the top directory with: python3 -m pytest
+
+import struct
+
+import pytest
+
+from VentComms import COMMANDS, Transaction, buildCommand, crc8, crc8Bitwise, validFrame, findFrame, checkReply
+from VentComms import decodePressure, decodeFlow, decodeStatus
+from VentEmulator import replyFrame
+
+
+# A serial port that records what is written to it and gives back the replies it was loaded with
+class FakePort:
+
+    def __init__(self, replies=b''):
+        self.baudrate = 115200
+        self.timeout = 1
+        self.replies = bytearray(replies)
+        self.writes = []
+
+    def reset_input_buffer(self):
+        pass
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+
+    def read(self, n):
+        data = bytes(self.replies[:n])
+        del self.replies[:n]
+        return data
+
+def flowReply(address):
+    return replyFrame(address, COMMANDS['flow'][0], bytes(4))
+
+def pressureReply(address, raw=8192):
+    return replyFrame(address, COMMANDS['pressure'][0], struct.pack('<H', raw))
+
+# CRC-8 with polynomial 0x31, against published check values. These use an initial value of 0xFF, where the cable
+# uses 0, which is the same as XORing 0xFF into the first byte: Sensirion's example (0xBEEF gives 0x92) and the
+# check value of CRC-8/NRSC-5 ('123456789' gives 0xF7)
+def testCrc8():
+    assert crc8(bytes([0xBE ^ 0xFF, 0xEF])) == 0x92
+    assert crc8(bytes([ord('1') ^ 0xFF]) + b'23456789') == 0xF7
+    assert crc8(b'') == 0
+    data = bytes(range(256)) * 2
+    assert crc8(data) == crc8Bitwise(data)
+    assert buildCommand(1, 'flow') == bytes([1, 0x10, 0, crc8(bytes([1, 0x10, 0]))])
+
+# A reply is only valid with the right address, command, payload length and checksum, and all of its bytes
+def testValidFrame():
+    reply = pressureReply(1)
+    assert validFrame(reply, 0, 1, 'pressure')
+    assert checkReply(reply, 1, 'pressure') == reply
+    assert not validFrame(reply, 0, 2, 'pressure') # another cable's reply
+    assert not validFrame(reply, 0, 1, 'test') # same length, another command
+    assert not validFrame(reply[:-1], 0, 1, 'pressure') # truncated
+    wrongLength = bytearray(reply)
+    wrongLength[2] = 3
+    wrongLength[-1] = crc8(wrongLength[:-1])
+    assert not validFrame(bytes(wrongLength), 0, 1, 'pressure')
+    corrupt = bytearray(reply)
+    corrupt[3] ^= 0x04
+    assert not validFrame(bytes(corrupt), 0, 1, 'pressure')
+    assert checkReply(bytes(corrupt), 1, 'pressure') is None
+
+# A reply is found after garbage, after the end of a reply that lost its start, and after a header
+# that isn't followed by a valid frame
+@pytest.mark.parametrize('prefix', [b'\x00\xff\x13', flowReply(1)[3:], pressureReply(1)[:4],
+                                    bytes([1, COMMANDS['pressure'][0], 2, 0])])
+def testFindFrameResyncs(prefix):
+    data = prefix + pressureReply(1)
+    assert findFrame(data, 0, 1, 'pressure') == len(prefix)
+    assert findFrame(data, 0, 1, 'pressure', limit=len(prefix) + 1) == len(prefix)
+    assert findFrame(data, 0, 1, 'pressure', limit=len(prefix)) == -1 # only looking before it
+    assert findFrame(data, 0, 2, 'pressure') == -1
+
+# A lost byte in a burst loses that reply only: the ones after it are found further on
+def testTransactionResync():
+    burst = pressureReply(1, 1000)[1:] + flowReply(1) + pressureReply(1, 2000)
+    port = FakePort(burst + bytes(1))
+    transaction = Transaction(port, pipelined=True)
+    transaction.add(1, 'pressure')
+    transaction.add(1, 'flow')
+    transaction.add(1, 'pressure')
+    replies = transaction.execute()
+    assert replies[0] is None
+    assert bytes(replies[1]) == flowReply(1)
+    assert bytes(replies[2]) == pressureReply(1, 2000)
+    assert transaction.errors['badFrames'] == 1
+    assert transaction.errors['resyncs'] == 1
+
+def testDecode():
+    assert decodePressure(pressureReply(1, 1638)) == pytest.approx(-200 * 1.01972)
+    assert decodeFlow(replyFrame(1, COMMANDS['flow'][0], struct.pack('<i', -12345))) == pytest.approx(-12.345)
+    assert decodePressure(None) is None and decodeFlow(pressureReply(1)) is None
+    # Temperatures are taken to be little-endian hundredths of a degree (see decodeStatus())
+    temperature = replyFrame(1, COMMANDS['temperature'][0], struct.pack('<H', 3712))
+    assert decodeStatus(temperature, 'temperature') == pytest.approx(37.12)
+    assert decodeStatus(replyFrame(1, COMMANDS['sw_version'][0], bytes([1, 2, 3])), 'sw_version') == 0x010203
+    assert decodeStatus(buildCommand(1, 'start_flowsensor'), 'start_flowsensor') == 1
+    assert decodeStatus(None, 'temperature') is None
+
+# Pipelining is off unless asked for, and then only bursts the commands to one cable, unless the cables queue replies
+def testBursting():
+    port = FakePort(flowReply(1) + flowReply(2))
+    assert not Transaction(port).pipelined
+    transaction = Transaction(port, pipelined=True)
+    transaction.add(1, 'flow')
+    assert transaction.bursting
+    transaction.add(2, 'flow')
+    assert not transaction.bursting
+    replies = transaction.execute()
+    assert port.writes == [buildCommand(1, 'flow'), buildCommand(2, 'flow')] # a command at a time
+    assert [bytes(r) for r in replies] == [flowReply(1), flowReply(2)]
+    transaction = Transaction(port, pipelined=True, queuesReplies=True)
+    transaction.add(1, 'flow')
+    transaction.add(2, 'flow')
+    assert transaction.bursting
@@ -0,0 +1,54 @@
+# Tests for SessionExporter in VentExport.py: what is written in each format, and stopping when writing fails.
+# Run them from the top directory with: python3 -m pytest
+
+import os
+import time
+
+import numpy as np
+
+from VentAnalytics import BreathRecord
+from VentDiagnostics import diagnostics
+from VentExport import SessionExporter, ColumnWriter, readColumns
+
+
+# Every sample and breath added ends up in the columnar files, and in the CSV files under a header
+def testExport(tmp_path):
+    directory = str(tmp_path / 'export')
+    exporter = SessionExporter(directory)
+    for i in range(1000):
+        exporter.addSample(1 + i % 2, 100.0 + i * 0.01, i * 0.5, -i * 0.25)
+    exporter.addBreath(2, BreathRecord(100.0, 101.0, 103.0, 25.0, 5.0, 500.0, 480.0, 20.0, 0.5))
+    exporter.close()
+    assert exporter.error is None and exporter.samples.dropped == 0
+    samples = readColumns(directory, 'samples')
+    assert np.array_equal(samples['address'], 1 + np.arange(1000) % 2)
+    assert np.allclose(samples['flow'], -np.arange(1000) * 0.25)
+    breaths = readColumns(directory, 'breaths')
+    assert breaths['address'].tolist() == [2] and breaths['vte'].tolist() == [480.0]
+    with open(os.path.join(directory, 'samples.csv')) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "time,patient,pressure,flow" and len(lines) == 1001
+    assert lines[2].endswith(",2,0.50,-0.25")
+
+# A disk error stops the export, and is kept and counted rather than killing the writer thread
+def testWriteError(tmp_path, monkeypatch):
+    def full(self, table, rows):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(ColumnWriter, 'write', full)
+    errors = diagnostics.counters.get('exportErrors', 0)
+    exporter = SessionExporter(str(tmp_path / 'export'), formats=('columns',), batchSize=16)
+    for i in range(100):
+        exporter.addSample(1, i * 0.01, 0.0, 0.0)
+    exporter.flush()
+    deadline = time.monotonic() + 5
+    while exporter.error is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert exporter.thread.is_alive() # still running, giving batches back
+    assert exporter.error.errno == 28
+    assert diagnostics.counters['exportErrors'] == errors + 1
+    # Rows added after the error are discarded, not queued or counted as dropped
+    for i in range(100):
+        exporter.addSample(1, 1 + i * 0.01, 0.0, 0.0)
+    assert exporter.samples.dropped == 0
+    exporter.close()
+    assert not exporter.thread.is_alive()
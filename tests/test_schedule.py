@@ -0,0 +1,78 @@
+# Tests for DeadlineScheduler in VentSchedule.py: deadlines on a fixed grid, the late and missed counts, and the rate.
+# Run them from the top directory with: python3 -m pytest
+
+import pytest
+
+from VentSchedule import DeadlineScheduler
+
+
+# A clock that only moves when told to, or when the scheduler sleeps; each sleep overshoots by [oversleep]
+class FakeClock:
+
+    def __init__(self, oversleep=0.0):
+        self.now = 100.0
+        self.oversleep = oversleep
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        assert seconds >= 0
+        self.now += seconds + self.oversleep
+
+def makeScheduler(oversleep=0.0):
+    clock = FakeClock(oversleep)
+    return DeadlineScheduler(0.01, clock=clock, sleep=clock.sleep), clock
+
+# Sleeps that overshoot make each tick a little late, but the deadlines stay on the grid and don't drift
+def testNoDrift():
+    scheduler, clock = makeScheduler(oversleep=0.002)
+    ticks = [scheduler.wait() for _ in range(1000)]
+    for i, tick in enumerate(ticks):
+        assert tick.deadline == pytest.approx(100.0 + i * 0.01)
+        assert tick.missed == 0
+    assert all(tick.late == pytest.approx(0.002) for tick in ticks[1:])
+    assert clock.now == pytest.approx(100.0 + 999 * 0.01 + 0.002)
+    assert scheduler.overruns == 0 and scheduler.missed == 0
+
+# Work that runs past the next deadline, but not the one after, makes that tick late without missing any
+def testLate():
+    scheduler, clock = makeScheduler()
+    scheduler.wait()
+    clock.now += 0.015
+    tick = scheduler.wait()
+    assert tick.deadline == pytest.approx(100.01)
+    assert tick.late == pytest.approx(0.005)
+    assert tick.missed == 0
+    assert scheduler.overruns == 1 and scheduler.missed == 0
+    # The tick after is back on time
+    tick = scheduler.wait()
+    assert tick.deadline == pytest.approx(100.02) and tick.late == pytest.approx(0.0)
+
+# Work that runs past several deadlines skips them, counts them as missed, and ticks at the most recent one
+def testMissed():
+    scheduler, clock = makeScheduler()
+    scheduler.wait()
+    clock.now += 0.0355
+    tick = scheduler.wait()
+    assert tick.missed == 2
+    assert tick.deadline == pytest.approx(100.03)
+    assert tick.late == pytest.approx(0.0055)
+    assert scheduler.overruns == 1 and scheduler.missed == 2
+    tick = scheduler.wait()
+    assert tick.deadline == pytest.approx(100.04) and tick.missed == 0
+    assert scheduler.ticks == 3
+
+# The rate counts the ticks that happened over the time between the first deadline and the last
+def testRate():
+    scheduler, clock = makeScheduler(oversleep=0.001)
+    assert scheduler.rate() == 0.0
+    for _ in range(101):
+        scheduler.wait()
+    assert scheduler.rate() == pytest.approx(100.0)
+    # 5 missed deadlines in the next second leave 95 ticks in it
+    clock.now += 0.06
+    for _ in range(95):
+        scheduler.wait()
+    assert scheduler.missed == 5
+    assert scheduler.rate() == pytest.approx(195 / 2.0)
@@ -0,0 +1,87 @@
+# Tests for SharedRing in VentShared.py, with the writer in another process: wrapping round the ring, the reader
+# falling behind, and records the writer comes round to while they're being read.
+# Run them from the top directory with: python3 -m pytest
+
+import multiprocessing
+
+import numpy as np
+
+from VentShared import SharedRing
+
+
+# Each record holds its own sequence number several times over, so one that is part old and part new shows up
+RECORD = np.dtype([('n', '<u8'), ('copies', '<u8', (15,))])
+
+def record(n):
+    return (n, (n,) * 15)
+
+# The writer process: for each count from [orders], append that many more records and say so
+def writeRecords(name, orders, done):
+    ring = SharedRing.attach(name, RECORD)
+    n = 0
+    for count in iter(orders.get, None):
+        for _ in range(count):
+            ring.append(record(n))
+            n += 1
+        done.put(n)
+    ring.close()
+
+def startWriter(ring):
+    context = multiprocessing.get_context('spawn')
+    orders, done = context.Queue(), context.Queue()
+    process = context.Process(target=writeRecords, args=(ring.name, orders, done), daemon=True)
+    process.start()
+    return process, orders, done
+
+# The sequence numbers read, checking that every record is whole and they're in order with no repeats
+def readNumbers(ring):
+    numbers = []
+    for block in ring.read():
+        assert np.all(block['copies'] == block['n'][:, None])
+        numbers.extend(block['n'].tolist())
+    assert numbers == sorted(set(numbers))
+    return numbers
+
+# Reads that wrap round the end of the ring, and a reader that falls more than the capacity behind
+def testWrapAndOverrun():
+    ring = SharedRing(RECORD, 8)
+    process, orders, done = startWriter(ring)
+    try:
+        orders.put(5)
+        assert done.get(timeout=30) == 5
+        assert len(ring) == 5
+        assert readNumbers(ring) == list(range(5))
+        assert ring.read() == [] and len(ring) == 0
+        orders.put(6) # records 5 to 10, in slots 5, 6, 7, 0, 1, 2
+        done.get(timeout=30)
+        assert readNumbers(ring) == list(range(5, 11))
+        assert ring.dropped == 0
+        orders.put(20) # records 11 to 30, of which only the last 8 are left
+        done.get(timeout=30)
+        assert len(ring) == 20
+        assert readNumbers(ring) == list(range(23, 31))
+        assert ring.dropped == 12
+        orders.put(None)
+        process.join(30)
+    finally:
+        ring.close()
+
+# A writer going flat out round a small ring while it is read: every record read is whole, and every record
+# written is either read or counted as dropped
+def testConcurrentWrites():
+    ring = SharedRing(RECORD, 16)
+    process, orders, done = startWriter(ring)
+    try:
+        orders.put(200000)
+        orders.put(None)
+        numbers = []
+        while process.is_alive():
+            numbers.extend(readNumbers(ring))
+        process.join(30)
+        numbers.extend(readNumbers(ring))
+        assert done.get(timeout=30) == 200000
+        assert numbers == sorted(set(numbers))
+        assert numbers[-1] == 199999
+        assert len(numbers) + ring.dropped == 200000
+    finally:
+        ring.close()
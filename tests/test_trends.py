@@ -0,0 +1,66 @@
+# Tests for TrendStore in VentAnalytics.py: the rollups into coarser levels, and which level a query reads.
+# Run them from the top directory with: python3 -m pytest
+
+import numpy as np
+import pytest
+
+from VentAnalytics import TrendStore
+
+
+# Ten minutes of one value a second, with raw values for a minute, 10-second buckets for 5 minutes and
+# 1-minute buckets for an hour
+def makeStore():
+    store = TrendStore(('a', 'b'), 1, 60, ((10, 300), (60, 3600)))
+    times = np.arange(600.0)
+    values = np.sin(times / 17) * 10
+    for t, value in zip(times, values):
+        store.add(t, value, -value)
+    return store, times, values
+
+# Each bucket holds the min, max and mean of the values in it, on every level
+def testRollups():
+    store, times, values = makeStore()
+    for width, start in ((10, 310), (60, 0)):
+        trend = store.query('a', start, maxPoints=(600 - start) // width)
+        assert np.all(np.diff(trend.times) == width) and len(trend.times) >= 8
+        for t, low, high, mean in zip(*trend):
+            bucket = values[(times >= t) & (times < t + width)]
+            assert low == pytest.approx(bucket.min())
+            assert high == pytest.approx(bucket.max())
+            assert mean == pytest.approx(bucket.mean())
+    # The other channel is kept separately
+    trend = store.query('b', 0, maxPoints=10)
+    assert trend.mean == pytest.approx(-store.query('a', 0, maxPoints=10).mean)
+
+# A query reads the most detailed level that goes back far enough and fits in maxPoints
+def testQueryLevels():
+    store, times, values = makeStore()
+    # The raw values only go back a minute
+    trend = store.query('a', 550)
+    assert np.array_equal(trend.times, times[550:])
+    assert np.array_equal(trend.mean, values[550:])
+    assert np.array_equal(trend.min, trend.max)
+    # Five minutes back needs the 10-second buckets; ten minutes back needs the 1-minute buckets
+    assert np.all(np.diff(store.query('a', 400).times) == 10)
+    assert np.all(np.diff(store.query('a', 0).times) == 60)
+    # Too many raw values for maxPoints, so the 10-second buckets
+    trend = store.query('a', 560, maxPoints=20)
+    assert np.all(np.diff(trend.times) == 10) and len(trend.times) <= 20
+    # Only the buckets in the time asked for
+    trend = store.query('a', 100, 200, maxPoints=10)
+    assert trend.times[0] >= 100 and trend.times[-1] <= 200
+
+# A level that hasn't discarded anything yet goes back far enough, however long ago [start] is
+def testQueryBeforeHistory():
+    store = TrendStore(('a',), 1, 60, ((10, 300),))
+    for t in range(30):
+        store.add(float(t), float(t))
+    trend = store.query('a', -3600)
+    assert np.array_equal(trend.times, np.arange(30.0))
+
+# Memory is capped by maxBytes, with every level keeping proportionally less
+def testMemoryBudget():
+    full = TrendStore(('a', 'b'), 0.05, 300, ((1, 6*3600), (60, 7*24*3600)))
+    capped = TrendStore(('a', 'b'), 0.05, 300, ((1, 6*3600), (60, 7*24*3600)), maxBytes=1000000)
+    assert full.nbytes() > 1000000 >= capped.nbytes()
+    assert capped.nbytes() > 900000